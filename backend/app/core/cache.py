@@ -1,20 +1,187 @@
 """
 Redis缓存服务模块
 提供缓存操作、消息队列（Pub/Sub）功能
+Redis故障时由熔断器快速失败，并使用进程内兜底存储
 """
 import redis
 import json
-from typing import Any, Optional, List, Set
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, List, Set
 from datetime import timedelta
 from app.core.config import settings
 
 
+# 熔断期间可由进程内存储兜底的Key（L1推荐缓存、黑名单、类别/作者不喜欢）
+# 整Key匹配，避免误收同前缀的其他Key（如反向索引 rec:user:{id}:books）
+FALLBACK_KEY_PATTERN = re.compile(r"(rec:user|blacklist:user|dislike:category:user|dislike:author:user):\d+")
+
+# 仅当锁仍由自己持有时删除
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class LocalFallbackStore:
+    """
+    有界的进程内兜底存储（LRU + TTL）
+    
+    Redis正常时对兜底Key做写穿镜像，熔断期间直接读写本地；
+    熔断期间的写入不会回放到Redis
+    """
+    
+    def __init__(self, max_keys: int = 1000):
+        self.max_keys = max_keys
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def accepts(key: str) -> bool:
+        """判断Key是否需要兜底"""
+        return FALLBACK_KEY_PATTERN.fullmatch(key) is not None
+    
+    def _get_entry(self, key: str) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at < time.time():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+    
+    def _put_entry(self, key: str, value: Any, ttl: Optional[float] = None):
+        expires_at = time.time() + ttl if ttl else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_keys:
+            self._data.popitem(last=False)
+    
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._get_entry(key)
+            return value if isinstance(value, str) else None
+    
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        with self._lock:
+            self._put_entry(key, value, ttl)
+    
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._data.pop(key, None) is not None
+    
+    def smembers(self, key: str) -> Set[str]:
+        with self._lock:
+            value = self._get_entry(key)
+            return set(value) if isinstance(value, set) else set()
+    
+    def replace_set(self, key: str, members: Set[str]):
+        with self._lock:
+            self._put_entry(key, set(members))
+    
+    def sadd(self, key: str, *values: str) -> int:
+        with self._lock:
+            members = self._get_entry(key)
+            if not isinstance(members, set):
+                members = set()
+            before = len(members)
+            members.update(values)
+            self._put_entry(key, members)
+            return len(members) - before
+    
+    def srem(self, key: str, *values: str) -> int:
+        with self._lock:
+            members = self._get_entry(key)
+            if not isinstance(members, set):
+                return 0
+            before = len(members)
+            members.difference_update(values)
+            return before - len(members)
+
+
+class CircuitBreaker:
+    """
+    Redis熔断器
+    
+    第一次连接/超时错误即打开熔断，期间所有操作快速失败；
+    后台线程按间隔探测（PING），成功后关闭熔断
+    """
+    
+    def __init__(self, probe: Callable[[], bool], reset_interval: float = 5.0):
+        self._probe = probe
+        self.reset_interval = reset_interval
+        self.opened_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self._lock = threading.Lock()
+        self._probe_thread: Optional[threading.Thread] = None
+        self._close_listeners: List[Callable[[], None]] = []
+    
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+    
+    def trip(self, error: Exception):
+        """打开熔断并启动后台探测"""
+        with self._lock:
+            if self.is_open:
+                return
+            self.opened_at = time.time()
+            self.last_error = str(error)
+            print(f"Redis circuit opened: {error}")
+            self._probe_thread = threading.Thread(target=self._probe_loop, daemon=True)
+            self._probe_thread.start()
+    
+    def add_close_listener(self, callback: Callable[[], None]):
+        """注册熔断恢复（打开 -> 关闭）时的回调，如Redis故障切换后检查数据是否丢失"""
+        self._close_listeners.append(callback)
+    
+    def close(self):
+        with self._lock:
+            was_open = self.is_open
+            if was_open:
+                print(f"Redis circuit closed after {time.time() - self.opened_at:.1f}s")
+            self.opened_at = None
+            self.last_error = None
+        if not was_open:
+            return
+        for callback in self._close_listeners:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Redis circuit close listener error: {e}")
+    
+    def _probe_loop(self):
+        while self.is_open:
+            time.sleep(self.reset_interval)
+            if self._probe():
+                self.close()
+    
+    def status(self) -> dict:
+        return {
+            "state": "open" if self.is_open else "closed",
+            "open_seconds": round(time.time() - self.opened_at, 1) if self.is_open else 0,
+            "last_error": self.last_error
+        }
+
+
 class RedisCache:
     """Redis缓存服务"""
     
     def __init__(self):
         self._client: Optional[redis.Redis] = None
+        self._blocking_client: Optional[redis.Redis] = None
+        self._raw_client: Optional[redis.Redis] = None
+        self._scripts: dict = {}
         self._pubsub: Optional[redis.client.PubSub] = None
+        self.fallback = LocalFallbackStore(settings.REDIS_FALLBACK_MAX_KEYS)
+        self.breaker = CircuitBreaker(self._ping, settings.REDIS_CIRCUIT_RESET_INTERVAL)
     
     @property
     def client(self) -> redis.Redis:
@@ -26,63 +193,129 @@ class RedisCache:
                 db=settings.REDIS_DB,
                 password=settings.REDIS_PASSWORD,
                 decode_responses=True,
-                socket_timeout=5,
-                socket_connect_timeout=5,
-                retry_on_timeout=True
+                socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=settings.REDIS_SOCKET_TIMEOUT
             )
         return self._client
     
+    @property
+    def blocking_client(self) -> redis.Redis:
+        """
+        获取用于阻塞命令（BRPOP、Pub/Sub）的客户端
+        不设置读超时，避免阻塞等待被误判为故障；连接超时与普通客户端一致
+        """
+        if self._blocking_client is None:
+            self._blocking_client = redis.Redis(
+                host=settings.REDIS_HOST,
+                port=settings.REDIS_PORT,
+                db=settings.REDIS_DB,
+                password=settings.REDIS_PASSWORD,
+                decode_responses=True,
+                socket_connect_timeout=settings.REDIS_SOCKET_TIMEOUT
+            )
+        return self._blocking_client
+    
+    @property
+    def raw_client(self) -> redis.Redis:
+        """
+        获取不解码响应的客户端（用于读取位图等二进制值）
+        """
+        if self._raw_client is None:
+            self._raw_client = redis.Redis(
+                host=settings.REDIS_HOST,
+                port=settings.REDIS_PORT,
+                db=settings.REDIS_DB,
+                password=settings.REDIS_PASSWORD,
+                decode_responses=False,
+                socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=settings.REDIS_SOCKET_TIMEOUT
+            )
+        return self._raw_client
+    
+    def _ping(self) -> bool:
+        """探测Redis是否可用（不经过熔断器）"""
+        try:
+            return bool(self.client.ping())
+        except Exception:
+            return False
+    
     def is_connected(self) -> bool:
         """检查Redis连接是否正常"""
+        if self.breaker.is_open:
+            return False
         try:
             self.client.ping()
             return True
-        except (redis.ConnectionError, redis.TimeoutError):
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            self.breaker.trip(e)
             return False
     
+    def _call(self, op: str, func: Callable[[], Any], default: Any, fallback: Callable[[], Any] = None) -> Any:
+        """
+        执行Redis命令
+        
+        熔断打开时不访问网络，直接返回兜底值；
+        连接/超时错误会打开熔断，其他错误只记录日志
+        """
+        if self.breaker.is_open:
+            return fallback() if fallback else default
+        try:
+            return func()
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            self.breaker.trip(e)
+            return fallback() if fallback else default
+        except Exception as e:
+            print(f"Redis {op} error: {e}")
+            return default
+    
     # ==================== 基础缓存操作 ====================
     
     def get(self, key: str) -> Optional[str]:
         """获取缓存值"""
-        try:
-            return self.client.get(key)
-        except Exception as e:
-            print(f"Redis GET error: {e}")
-            return None
+        def run():
+            if not self.fallback.accepts(key):
+                return self.client.get(key)
+            # 兜底Key同时取剩余生存时间，镜像与Redis同时过期
+            pipe = self.client.pipeline(transaction=False)
+            pipe.get(key)
+            pipe.pttl(key)
+            value, pttl = pipe.execute()
+            if value is not None:
+                self.fallback.set(key, value, pttl / 1000 if pttl > 0 else None)
+            return value
+        return self._call("GET", run, None, lambda: self.fallback.get(key))
     
     def set(self, key: str, value: str, ttl: Optional[int] = None) -> bool:
         """设置缓存值"""
-        try:
+        if self.fallback.accepts(key):
+            self.fallback.set(key, value, ttl)
+        
+        def run():
             if ttl:
                 return self.client.setex(key, ttl, value)
             return self.client.set(key, value)
-        except Exception as e:
-            print(f"Redis SET error: {e}")
-            return False
+        return self._call("SET", run, False, lambda: self.fallback.accepts(key))
+    
+    def set_nx(self, key: str, value: str, ttl: int) -> bool:
+        """仅当key不存在时设置（用于简单互斥锁）"""
+        return self._call("SET NX", lambda: bool(self.client.set(key, value, nx=True, ex=ttl)), False)
     
     def delete(self, key: str) -> bool:
         """删除缓存"""
-        try:
-            return self.client.delete(key) > 0
-        except Exception as e:
-            print(f"Redis DELETE error: {e}")
-            return False
+        local = self.fallback.delete(key)
+        return self._call("DELETE", lambda: self.client.delete(key) > 0, False, lambda: local)
     
     def exists(self, key: str) -> bool:
         """检查key是否存在"""
-        try:
-            return self.client.exists(key) > 0
-        except Exception as e:
-            print(f"Redis EXISTS error: {e}")
-            return False
+        return self._call("EXISTS", lambda: self.client.exists(key) > 0, False)
+    
+    def expire(self, key: str, ttl: int) -> bool:
+        """设置key的过期时间（秒）"""
+        return self._call("EXPIRE", lambda: self.client.expire(key, ttl), False)
     
     def ttl(self, key: str) -> int:
         """获取key的剩余生存时间（秒）"""
-        try:
-            return self.client.ttl(key)
-        except Exception as e:
-            print(f"Redis TTL error: {e}")
-            return -2
+        return self._call("TTL", lambda: self.client.ttl(key), -2)
     
     # ==================== JSON缓存操作 ====================
     
@@ -109,114 +342,174 @@ class RedisCache:
     
     def sadd(self, key: str, *values: str) -> int:
         """添加元素到Set"""
-        try:
-            return self.client.sadd(key, *values)
-        except Exception as e:
-            print(f"Redis SADD error: {e}")
-            return 0
+        local = self.fallback.sadd(key, *values) if self.fallback.accepts(key) else 0
+        return self._call("SADD", lambda: self.client.sadd(key, *values), 0, lambda: local)
     
     def srem(self, key: str, *values: str) -> int:
         """从Set中移除元素"""
-        try:
-            return self.client.srem(key, *values)
-        except Exception as e:
-            print(f"Redis SREM error: {e}")
-            return 0
+        local = self.fallback.srem(key, *values) if self.fallback.accepts(key) else 0
+        return self._call("SREM", lambda: self.client.srem(key, *values), 0, lambda: local)
     
     def sismember(self, key: str, value: str) -> bool:
         """检查元素是否在Set中"""
-        try:
-            return self.client.sismember(key, value)
-        except Exception as e:
-            print(f"Redis SISMEMBER error: {e}")
-            return False
+        return self._call(
+            "SISMEMBER",
+            lambda: self.client.sismember(key, value),
+            False,
+            lambda: value in self.fallback.smembers(key)
+        )
     
     def smembers(self, key: str) -> Set[str]:
         """获取Set中所有元素"""
-        try:
-            return self.client.smembers(key)
-        except Exception as e:
-            print(f"Redis SMEMBERS error: {e}")
-            return set()
+        def run():
+            members = self.client.smembers(key)
+            if self.fallback.accepts(key):
+                self.fallback.replace_set(key, members)
+            return members
+        return self._call("SMEMBERS", run, set(), lambda: self.fallback.smembers(key))
+    
+    def smembers_many(self, *keys: str) -> List[Set[str]]:
+        """批量获取多个Set的元素（一次Pipeline往返）"""
+        def run():
+            pipe = self.client.pipeline(transaction=False)
+            for key in keys:
+                pipe.smembers(key)
+            results = pipe.execute()
+            for key, members in zip(keys, results):
+                if self.fallback.accepts(key):
+                    self.fallback.replace_set(key, members)
+            return results
+        return self._call(
+            "SMEMBERS pipeline",
+            run,
+            [set() for _ in keys],
+            lambda: [self.fallback.smembers(key) for key in keys]
+        )
     
     def scard(self, key: str) -> int:
         """获取Set的元素数量"""
-        try:
-            return self.client.scard(key)
-        except Exception as e:
-            print(f"Redis SCARD error: {e}")
-            return 0
+        return self._call("SCARD", lambda: self.client.scard(key), 0, lambda: len(self.fallback.smembers(key)))
+    
+    # ==================== 位图操作（用于排除集合） ====================
+    
+    def mget_bytes(self, *keys: str) -> List[Optional[bytes]]:
+        """批量获取二进制值（不存在的Key返回None）"""
+        return self._call("MGET", lambda: self.raw_client.mget(keys), [None for _ in keys])
+    
+    def set_bytes(self, key: str, value: bytes) -> bool:
+        """设置二进制值"""
+        return self._call("SET", lambda: self.raw_client.set(key, value), False)
+    
+    def setbit_many(self, key: str, offsets: List[int], value: int = 1) -> bool:
+        """批量设置位图中的位（一次Pipeline往返）"""
+        def run():
+            pipe = self.client.pipeline(transaction=False)
+            for offset in offsets:
+                pipe.setbit(key, offset, value)
+            pipe.execute()
+            return True
+        return self._call("SETBIT pipeline", run, False)
+    
+    # ==================== Lua脚本 ====================
+    
+    def run_script(self, script: str, keys: List[str], args: List[Any] = None, default: Any = None) -> Any:
+        """执行Lua脚本（EVALSHA，脚本未加载时自动回退为EVAL）"""
+        def run():
+            registered = self._scripts.get(script)
+            if registered is None:
+                registered = self._scripts[script] = self.client.register_script(script)
+            return registered(keys=keys, args=args or [])
+        return self._call("EVALSHA", run, default)
+    
+    def acquire_lock(self, key: str, ttl: int) -> Optional[str]:
+        """
+        获取分布式锁（SET NX EX）
+        
+        Returns:
+            成功时返回持有者令牌，释放时需要提供；失败返回None
+        """
+        token = uuid.uuid4().hex
+        return token if self.set_nx(key, token, ttl) else None
+    
+    def release_lock(self, key: str, token: str) -> bool:
+        """释放分布式锁（仅当令牌匹配时删除，避免误删过期后被他人持有的锁）"""
+        return bool(self.run_script(RELEASE_LOCK_SCRIPT, keys=[key], args=[token], default=0))
+    
+    # ==================== Pipeline批量操作 ====================
+    
+    def execute_pipeline(self, build: Callable[[Any], None], transaction: bool = False) -> List[Any]:
+        """
+        批量执行命令（一次网络往返）
+        
+        Args:
+            build: 回调函数，接收pipeline对象并向其追加命令
+            transaction: 是否以MULTI/EXEC事务执行
+            
+        Returns:
+            各命令结果列表，出错时返回空列表
+        """
+        def run():
+            pipe = self.client.pipeline(transaction=transaction)
+            build(pipe)
+            return pipe.execute()
+        return self._call("PIPELINE", run, [])
     
     # ==================== Hash操作（用于用户行为计数） ====================
     
     def hget(self, name: str, key: str) -> Optional[str]:
         """获取Hash字段值"""
-        try:
-            return self.client.hget(name, key)
-        except Exception as e:
-            print(f"Redis HGET error: {e}")
-            return None
+        return self._call("HGET", lambda: self.client.hget(name, key), None)
     
     def hset(self, name: str, key: str, value: str) -> int:
         """设置Hash字段值"""
-        try:
-            return self.client.hset(name, key, value)
-        except Exception as e:
-            print(f"Redis HSET error: {e}")
-            return 0
+        return self._call("HSET", lambda: self.client.hset(name, key, value), 0)
     
     def hincrby(self, name: str, key: str, amount: int = 1) -> int:
         """Hash字段值增加"""
-        try:
-            return self.client.hincrby(name, key, amount)
-        except Exception as e:
-            print(f"Redis HINCRBY error: {e}")
-            return 0
+        return self._call("HINCRBY", lambda: self.client.hincrby(name, key, amount), 0)
     
     def hgetall(self, name: str) -> dict:
         """获取Hash所有字段"""
-        try:
-            return self.client.hgetall(name)
-        except Exception as e:
-            print(f"Redis HGETALL error: {e}")
-            return {}
+        return self._call("HGETALL", lambda: self.client.hgetall(name), {})
     
     def hdel(self, name: str, *keys: str) -> int:
         """删除Hash字段"""
-        try:
-            return self.client.hdel(name, *keys)
-        except Exception as e:
-            print(f"Redis HDEL error: {e}")
-            return 0
+        return self._call("HDEL", lambda: self.client.hdel(name, *keys), 0)
     
     # ==================== Pub/Sub消息队列 ====================
     
     def publish(self, channel: str, message: Any) -> int:
         """发布消息到频道"""
-        try:
-            if isinstance(message, (dict, list)):
-                message = json.dumps(message, ensure_ascii=False)
-            return self.client.publish(channel, message)
-        except Exception as e:
-            print(f"Redis PUBLISH error: {e}")
-            return 0
+        if isinstance(message, (dict, list)):
+            message = json.dumps(message, ensure_ascii=False)
+        return self._call("PUBLISH", lambda: self.client.publish(channel, message), 0)
     
     def subscribe(self, *channels: str) -> redis.client.PubSub:
         """订阅频道"""
+        if self.breaker.is_open:
+            raise redis.ConnectionError("Redis circuit is open")
         try:
-            pubsub = self.client.pubsub()
+            pubsub = self.blocking_client.pubsub()
             pubsub.subscribe(*channels)
             return pubsub
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            self.breaker.trip(e)
+            raise
         except Exception as e:
             print(f"Redis SUBSCRIBE error: {e}")
             raise
     
     def psubscribe(self, *patterns: str) -> redis.client.PubSub:
         """模式订阅"""
+        if self.breaker.is_open:
+            raise redis.ConnectionError("Redis circuit is open")
         try:
-            pubsub = self.client.pubsub()
+            pubsub = self.blocking_client.pubsub()
             pubsub.psubscribe(*patterns)
             return pubsub
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            self.breaker.trip(e)
+            raise
         except Exception as e:
             print(f"Redis PSUBSCRIBE error: {e}")
             raise
@@ -225,51 +518,105 @@ class RedisCache:
     
     def lpush(self, key: str, *values: str) -> int:
         """从左侧插入列表"""
-        try:
-            return self.client.lpush(key, *values)
-        except Exception as e:
-            print(f"Redis LPUSH error: {e}")
-            return 0
+        return self._call("LPUSH", lambda: self.client.lpush(key, *values), 0)
     
     def rpush(self, key: str, *values: str) -> int:
         """从右侧插入列表"""
-        try:
-            return self.client.rpush(key, *values)
-        except Exception as e:
-            print(f"Redis RPUSH error: {e}")
-            return 0
+        return self._call("RPUSH", lambda: self.client.rpush(key, *values), 0)
     
     def lpop(self, key: str) -> Optional[str]:
         """从左侧弹出元素"""
-        try:
-            return self.client.lpop(key)
-        except Exception as e:
-            print(f"Redis LPOP error: {e}")
-            return None
+        return self._call("LPOP", lambda: self.client.lpop(key), None)
     
     def rpop(self, key: str) -> Optional[str]:
         """从右侧弹出元素"""
-        try:
-            return self.client.rpop(key)
-        except Exception as e:
-            print(f"Redis RPOP error: {e}")
-            return None
+        return self._call("RPOP", lambda: self.client.rpop(key), None)
     
     def brpop(self, keys: List[str], timeout: int = 0) -> Optional[tuple]:
         """阻塞式从右侧弹出元素"""
-        try:
-            return self.client.brpop(keys, timeout)
-        except Exception as e:
-            print(f"Redis BRPOP error: {e}")
+        if self.breaker.is_open:
+            # 熔断期间避免调用方空转
+            time.sleep(min(timeout or 1, 1))
             return None
+        return self._call("BRPOP", lambda: self.blocking_client.brpop(keys, timeout), None)
     
     def llen(self, key: str) -> int:
         """获取列表长度"""
-        try:
-            return self.client.llen(key)
-        except Exception as e:
-            print(f"Redis LLEN error: {e}")
+        return self._call("LLEN", lambda: self.client.llen(key), 0)
+    
+    # ==================== Stream操作（用于可靠事件队列） ====================
+    
+    def xgroup_create(self, stream: str, group: str) -> bool:
+        """创建消费者组（Stream不存在时一并创建，组已存在视为成功）"""
+        def run():
+            try:
+                self.client.xgroup_create(stream, group, id="0", mkstream=True)
+            except redis.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+            return True
+        return self._call("XGROUP CREATE", run, False)
+    
+    def xreadgroup(
+        self, group: str, consumer: str, streams: Dict[str, str], count: int = 10, block: Optional[int] = None
+    ) -> List[tuple]:
+        """
+        以消费者组身份读取消息
+        
+        Returns:
+            [(stream, [(entry_id, fields), ...]), ...]
+        """
+        if self.breaker.is_open:
+            # 熔断期间避免调用方空转
+            time.sleep(min((block or 1000) / 1000, 1))
+            return []
+        
+        def run():
+            try:
+                return self.blocking_client.xreadgroup(group, consumer, streams, count=count, block=block) or []
+            except redis.ResponseError as e:
+                # Stream或消费者组被删除（如FLUSHDB）后自动重建
+                if "NOGROUP" not in str(e):
+                    raise
+                for stream in streams:
+                    self.xgroup_create(stream, group)
+                return []
+        return self._call("XREADGROUP", run, [])
+    
+    def xack(self, stream: str, group: str, *entry_ids: str) -> int:
+        """确认消息已处理"""
+        if not entry_ids:
             return 0
+        return self._call("XACK", lambda: self.client.xack(stream, group, *entry_ids), 0)
+    
+    def xautoclaim(self, stream: str, group: str, consumer: str, min_idle_time: int, count: int = 10) -> List[tuple]:
+        """
+        认领空闲超过 min_idle_time 毫秒的待确认消息（消费者崩溃后由其他消费者接手）
+        
+        Returns:
+            [(entry_id, fields), ...]
+        """
+        def run():
+            result = self.client.xautoclaim(stream, group, consumer, min_idle_time, start_id="0-0", count=count)
+            return [(entry_id, fields) for entry_id, fields in result[1] if fields]
+        return self._call("XAUTOCLAIM", run, [])
+    
+    def xinfo_groups(self, stream: str) -> List[dict]:
+        """获取Stream上各消费者组的状态（pending、lag等）"""
+        return self._call("XINFO GROUPS", lambda: self.client.xinfo_groups(stream), [])
+    
+    def xpending_summary(self, stream: str, group: str) -> dict:
+        """获取消费者组待确认消息摘要（pending、min、max、consumers）"""
+        return self._call("XPENDING", lambda: self.client.xpending(stream, group), {})
+    
+    def xrange(self, stream: str, min: str = "-", max: str = "+", count: Optional[int] = None) -> List[tuple]:
+        """
+        按ID范围读取消息（min 以 "(" 开头表示不含该ID）
+        
+        Returns:
+            [(entry_id, fields), ...]
+        """
+        return self._call("XRANGE", lambda: self.client.xrange(stream, min=min, max=max, count=count), [])
     
     # ==================== 缓存Key生成辅助方法 ====================
     
@@ -278,11 +625,36 @@ class RedisCache:
         """生成推荐缓存Key"""
         return f"rec:user:{user_id}"
     
+    @staticmethod
+    def recommendation_computed_key(user_id: int) -> str:
+        """生成推荐缓存完整计算时间Key"""
+        return f"rec:computed:user:{user_id}"
+    
+    @staticmethod
+    def book_users_key(book_id: int) -> str:
+        """生成反向索引Key（书籍 -> 缓存列表包含该书的用户）"""
+        return f"rec:book:{book_id}:users"
+    
+    @staticmethod
+    def user_books_key(user_id: int) -> str:
+        """生成用户已索引书籍Key（用于更新反向索引时求差集）"""
+        return f"rec:user:{user_id}:books"
+    
     @staticmethod
     def blacklist_key(user_id: int) -> str:
         """生成黑名单Key"""
         return f"blacklist:user:{user_id}"
     
+    @staticmethod
+    def seen_bitmap_key(user_id: int) -> str:
+        """生成已看过书籍位图Key"""
+        return f"excl:seen:user:{user_id}"
+    
+    @staticmethod
+    def blacklist_bitmap_key(user_id: int) -> str:
+        """生成黑名单位图Key"""
+        return f"excl:blacklist:user:{user_id}"
+    
     @staticmethod
     def click_count_key(user_id: int) -> str:
         """生成点击计数Key"""
@@ -293,6 +665,51 @@ class RedisCache:
         """生成曝光计数Key"""
         return f"exposure:user:{user_id}"
     
+    @staticmethod
+    def exposure_click_key(user_id: int) -> str:
+        """生成曝光后点击计数Key"""
+        return f"exposure:clicks:user:{user_id}"
+    
+    @staticmethod
+    def exposure_pending_key(user_id: int) -> str:
+        """生成待落库曝光增量Key"""
+        return f"exposure:pending:user:{user_id}"
+    
+    @staticmethod
+    def similarity_penalty_key(user_id: int) -> str:
+        """生成相似书籍惩罚Key"""
+        return f"penalty:user:{user_id}"
+    
+    @staticmethod
+    def history_key(user_id: int) -> str:
+        """生成推荐历史列表Key"""
+        return f"rec:history:user:{user_id}"
+    
+    @staticmethod
+    def history_category_key(user_id: int) -> str:
+        """生成推荐历史类别频次Key"""
+        return f"rec:history:category:user:{user_id}"
+    
+    @staticmethod
+    def history_author_key(user_id: int) -> str:
+        """生成推荐历史作者频次Key"""
+        return f"rec:history:author:user:{user_id}"
+    
+    @staticmethod
+    def user_lock_key(user_id: int) -> str:
+        """生成用户推荐重算锁Key"""
+        return f"lock:recompute:user:{user_id}"
+    
+    @staticmethod
+    def worker_metrics_key(worker_id: str) -> str:
+        """生成Worker指标快照Key"""
+        return f"metrics:worker:{worker_id}"
+    
+    @staticmethod
+    def category_profile_key(user_id: int) -> str:
+        """生成用户类别画像Key"""
+        return f"profile:category:user:{user_id}"
+    
     @staticmethod
     def category_dislike_key(user_id: int) -> str:
         """生成类别不喜欢Key"""
@@ -308,6 +725,13 @@ class RedisCache:
         if self._client:
             self._client.close()
             self._client = None
+            self._scripts.clear()
+        if self._blocking_client:
+            self._blocking_client.close()
+            self._blocking_client = None
+        if self._raw_client:
+            self._raw_client.close()
+            self._raw_client = None
 
 
 # 全局Redis缓存实例
@@ -2,7 +2,7 @@
 统一配置管理模块
 """
 import os
-from typing import Optional
+from typing import Dict, Optional
 from pydantic_settings import BaseSettings
 from functools import lru_cache
 
@@ -27,19 +27,40 @@ class Settings(BaseSettings):
     REDIS_PORT: int = 6379
     REDIS_DB: int = 0
     REDIS_PASSWORD: Optional[str] = None
+    REDIS_SOCKET_TIMEOUT: float = 1.0  # Per-command socket timeout (seconds)
+    REDIS_CIRCUIT_RESET_INTERVAL: float = 5.0  # Probe interval while the circuit is open (seconds)
+    BLACKLIST_CHECK_INTERVAL: float = 30.0  # How often to check for a cold Redis and rebuild blacklists (seconds)
+    REDIS_FALLBACK_MAX_KEYS: int = 1000  # In-process fallback store capacity
     
     # Cache Configuration
     CACHE_L1_TTL: int = 300  # 5 minutes for L1 (Redis)
     CACHE_L2_TTL: int = 3600  # 1 hour for L2 (MySQL)
     CACHE_L3_TTL: int = 86400  # 24 hours for L3
+    CACHE_POOL_SIZE: int = 30  # Cached pool size (visible list + backup candidates)
+    CACHE_POOL_REFILL_THRESHOLD: int = 10  # Recompute only when the filtered pool drops below this
+    
+    # Graph Sync Configuration
+    SYNC_BATCH_SIZE: int = 1000  # Rows per UNWIND write transaction when bulk-syncing to Neo4j
     
     # Recommendation Configuration
     RECOMMENDATION_LIMIT: int = 10
     CLICK_INVALIDATION_THRESHOLD: int = 3  # Invalidate cache after 3 clicks
+    EXCLUSION_OVERFETCH_MAX: int = 200  # Max extra rows fetched up front to cover bitmap-excluded books
+    EXCLUSION_FETCH_MAX: int = 3200  # Max LIMIT when refetching because too few rows survived the bitmap
     
     # Negative Feedback Configuration
     IMPLICIT_NEGATIVE_EXPOSURE_THRESHOLD: int = 10  # Add to blacklist after 10 exposures without click
     SOFT_PENALTY_FACTOR: float = 0.1  # Score penalty per exposure
+    SIMILARITY_MATRIX_PATH: str = "data/book_similarity.npz"  # Precomputed sparse book-similarity matrix
+    SIMILARITY_TOP_K: int = 20  # Neighbours kept per book in the similarity matrix
+    NEIGHBORHOOD_PATH: str = "data/book_neighborhood"  # Directory of the memory-mapped book neighbourhood table
+    NEIGHBORHOOD_CATEGORY_CAP: int = 20  # Same-category neighbours kept per book
+    NEIGHBORHOOD_AUTHOR_CAP: int = 10  # Same-author neighbours kept per book
+    NEIGHBORHOOD_COREAD_CAP: int = 10  # Co-interaction neighbours kept per book
+    NEIGHBORHOOD_REBUILD_INTERVAL: float = 3600.0  # Seconds between neighbourhood table rebuilds in workers
+    SIMILARITY_PENALTY_WEIGHT: float = 0.5  # Max score reduction for books similar to rejected ones
+    EXPOSURE_FLUSH_INTERVAL: float = 5.0  # Seconds between flushes of buffered exposure counts to MySQL
+    EXPOSURE_FLUSH_BATCH: int = 500  # Max users drained from the dirty set per flush round
     
     # Diversity Configuration
     DIVERSITY_PRIMARY_RATIO: float = 0.4
@@ -47,6 +68,21 @@ class Settings(BaseSettings):
     DIVERSITY_EXPLORE_RATIO: float = 0.2
     DIVERSITY_POPULAR_RATIO: float = 0.1
     MMR_LAMBDA: float = 0.5  # Balance between relevance and diversity
+    DPP_THETA: float = 0.7  # DPP relevance/diversity trade-off (0-1), higher favours relevance
+    RECOMMENDATION_HISTORY_WINDOW: int = 50  # Recent recommendations kept for sliding-window dedup
+    RECOMMENDATION_HISTORY_PERSIST_INTERVAL: float = 60.0  # Seconds between history writes to MySQL
+    
+    # Worker Configuration
+    WORKER_CONCURRENCY: int = 4  # Recompute threads per worker process
+    WORKER_USER_LOCK_TTL: int = 120  # Seconds before a per-user recompute lock expires
+    WORKER_BATCH_SIZE: int = 10  # Events fetched per XREADGROUP call
+    WORKER_COALESCE_WINDOW: float = 1.0  # Seconds a user's events are held and merged into one recompute
+    WORKER_PRIORITY_WEIGHTS: Dict[int, int] = {3: 6, 2: 3, 1: 1}  # Weighted round-robin share per priority level
+    WORKER_PRIORITY_AGING: float = 30.0  # Seconds of backlog age that raise a level's weight by one
+    WORKER_METRICS_INTERVAL: float = 10.0  # Seconds between worker metric snapshots written to Redis
+    WORKER_METRICS_PORT: int = 0  # Port for the worker's Prometheus endpoint (0 disables it)
+    EVENT_STREAM_MAXLEN: int = 100000  # Approximate cap on the invalidation stream length
+    EVENT_STREAM_CLAIM_IDLE: int = 300  # Seconds before an unacknowledged event is reclaimed from its consumer
     
     class Config:
         env_file = ".env"
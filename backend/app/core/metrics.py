@@ -0,0 +1,165 @@
+"""
+进程内指标模块
+提供线程安全的计数器、仪表盘和直方图，支持导出摘要和Prometheus文本格式
+"""
+import bisect
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+# 延迟直方图桶（秒）
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 负载大小直方图桶（字节）
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+# 缓存条目年龄直方图桶（秒）
+AGE_BUCKETS = (60, 300, 900, 1800, 3600, 7200, 21600, 43200, 86400)
+# 事件出队延迟直方图桶（秒）
+LAG_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _label_key(labels: Optional[Dict[str, str]]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+
+class Histogram:
+    """固定桶直方图"""
+    
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个为 +Inf
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def quantile(self, q: float) -> float:
+        """按桶上界估算分位数"""
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            cumulative += c
+            if cumulative >= target:
+                return self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+        return self.buckets[-1]
+    
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99)
+        }
+
+
+class MetricsRegistry:
+    """指标注册表"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._gauges: Dict[str, Dict[tuple, float]] = {}
+        self._histograms: Dict[str, Dict[tuple, Histogram]] = {}
+    
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None, amount: float = 1):
+        """计数器增加"""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+    
+    def set_gauge(self, name: str, value: float, labels: Optional[Dict[str, str]] = None):
+        """设置仪表盘值"""
+        with self._lock:
+            self._gauges.setdefault(name, {})[_label_key(labels)] = value
+    
+    def observe(
+        self,
+        name: str,
+        value: float,
+        labels: Optional[Dict[str, str]] = None,
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        """记录直方图观测值"""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = Histogram(buckets)
+            hist.observe(value)
+    
+    def counter_value(self, name: str, **labels) -> float:
+        """按标签子集汇总计数器"""
+        wanted = set(_label_key(labels))
+        with self._lock:
+            return sum(v for k, v in self._counters.get(name, {}).items() if wanted <= set(k))
+    
+    def histogram(self, name: str, **labels) -> Optional[Histogram]:
+        """获取指定标签的直方图"""
+        with self._lock:
+            return self._histograms.get(name, {}).get(_label_key(labels))
+    
+    def snapshot(self) -> Dict[str, List[dict]]:
+        """导出所有指标（JSON友好格式）"""
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(k), "value": v}
+                    for name, series in self._counters.items() for k, v in series.items()
+                ],
+                "gauges": [
+                    {"name": name, "labels": dict(k), "value": v}
+                    for name, series in self._gauges.items() for k, v in series.items()
+                ],
+                "histograms": [
+                    {"name": name, "labels": dict(k), **h.summary()}
+                    for name, series in self._histograms.items() for k, h in series.items()
+                ]
+            }
+    
+    def render_prometheus(self) -> str:
+        """导出Prometheus文本格式"""
+        def fmt(labels: tuple, extra: Optional[Tuple[str, str]] = None) -> str:
+            pairs = list(labels) + ([extra] if extra else [])
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+        
+        lines = []
+        with self._lock:
+            for name, series in self._counters.items():
+                lines.append(f"# TYPE {name} counter")
+                for k, v in series.items():
+                    lines.append(f"{name}{fmt(k)} {v}")
+            for name, series in self._gauges.items():
+                lines.append(f"# TYPE {name} gauge")
+                for k, v in series.items():
+                    lines.append(f"{name}{fmt(k)} {v}")
+            for name, series in self._histograms.items():
+                lines.append(f"# TYPE {name} histogram")
+                for k, h in series.items():
+                    cumulative = 0
+                    for bound, c in zip(list(h.buckets) + ["+Inf"], h.counts):
+                        cumulative += c
+                        lines.append(f"{name}_bucket{fmt(k, ('le', str(bound)))} {cumulative}")
+                    lines.append(f"{name}_sum{fmt(k)} {h.sum}")
+                    lines.append(f"{name}_count{fmt(k)} {h.count}")
+        return "\n".join(lines) + "\n"
+    
+    def reset(self):
+        """清空所有指标"""
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+# 全局指标注册表
+metrics = MetricsRegistry()
@@ -1,4 +1,5 @@
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import sys
@@ -9,6 +10,12 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.routers import recommend, books, auth, users, admin
 from app.core.database import engine, Base
+from app.core.cache import redis_cache
+from app.core.metrics import metrics
+from app.services.exposure_service import exposure_flusher
+from app.services.history_service import history_persister
+from app.services.blacklist_service import blacklist_watcher
+from app.services.worker_stats_service import refresh_queue_gauges
 
 # Create tables if not exist (though init_full_data.py is preferred)
 Base.metadata.create_all(bind=engine)
@@ -42,13 +49,32 @@ if not os.path.exists(static_dir):
     os.makedirs(static_dir)
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
+@app.on_event("startup")
+def start_background_tasks():
+    exposure_flusher.start()
+    history_persister.start()
+    # Redis为冷状态时（启动时或运行中被清空、故障切换）后台重建黑名单，不阻塞启动
+    blacklist_watcher.start()
+
+@app.on_event("shutdown")
+def stop_background_tasks():
+    exposure_flusher.stop()
+    history_persister.stop()
+    blacklist_watcher.stop()
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the Knowledge Graph Book Recommendation System API"}
 
 @app.get("/health")
 def health_check():
-    return {"status": "ok"}
+    return {"status": "ok", "redis": redis_cache.breaker.status()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    # 附带实时队列深度，用于按积压扩缩容Worker（Worker自身的指标通过 --metrics-port 抓取）
+    refresh_queue_gauges()
+    return metrics.render_prometheus()
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, Float, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, Text, Float, DateTime, ForeignKey, Boolean, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.core.database import Base
@@ -139,6 +139,9 @@ class RecommendationHistory(Base):
 class ExposureLog(Base):
     """曝光记录表（用于隐式负反馈）"""
     __tablename__ = "exposure_logs"
+    __table_args__ = (
+        UniqueConstraint("user_id", "book_id", name="uk_user_book"),  # 批量写入依赖 ON DUPLICATE KEY UPDATE
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
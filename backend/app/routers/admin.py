@@ -1,11 +1,15 @@
 from typing import List
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from sqlalchemy.orm import Session
 from app.core.database import get_db, get_neo4j_session
 from app.core.deps import get_current_admin_user
 from app.models.sql import User, Book, Rating, Interaction
 from app.schemas.base import UserResponse, BookCreate, BookResponse
 from app.services.sync_service import SyncService
+from app.services.cache_service import CacheService
+from app.services.profile_service import category_names
+from app.services.worker_stats_service import get_worker_stats
+from app.core.cache import redis_cache
 from neo4j import Session as Neo4jSession
 
 router = APIRouter()
@@ -24,7 +28,8 @@ def get_stats(
         "users": user_count,
         "books": book_count,
         "interactions": interaction_count,
-        "ratings": rating_count
+        "ratings": rating_count,
+        "worker": get_worker_stats(include_workers=False)
     }
 
 @router.get("/users", response_model=List[UserResponse])
@@ -87,6 +92,77 @@ def create_book(
     
     return db_book
 
+@router.post("/books/import")
+def import_books(
+    books_in: List[BookCreate],
+    db: Session = Depends(get_db),
+    neo4j: Neo4jSession = Depends(get_neo4j_session),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """批量导入书籍：一次写入MySQL，再按 SYNC_BATCH_SIZE 分批UNWIND同步到Neo4j"""
+    if not books_in:
+        raise HTTPException(status_code=400, detail="No books to import")
+    
+    # 1. Save to MySQL (flush to get ids)
+    db_books = [Book(**book_in.model_dump()) for book_in in books_in]
+    db.add_all(db_books)
+    db.flush()
+    book_ids = [db_book.id for db_book in db_books]
+    names = {
+        category_id: category_names.get(db, category_id)
+        for category_id in {db_book.category_id for db_book in db_books}
+    }
+    
+    # 2. Sync to Neo4j in batches before commit; MERGE is idempotent, so a failed import can simply be retried
+    try:
+        sync_stats = SyncService(neo4j).sync_books(db_books, names)
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=502, detail=f"Neo4j sync failed: {e}")
+    db.commit()
+    
+    return {
+        "status": "success",
+        "imported": len(db_books),
+        "book_ids": book_ids,
+        "sync": sync_stats
+    }
+
+@router.get("/cache/stats")
+def get_cache_stats(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """L1/L2缓存的命中率、延迟和负载大小统计（当前API进程）"""
+    stats = CacheService.get_cache_stats()
+    stats["redis_circuit"] = redis_cache.breaker.status()
+    return stats
+
+@router.get("/workers/stats")
+def get_workers_stats(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """推荐Worker指标：各优先级队列深度和延迟、重算耗时、成功/失败数、去重与合并节省（所有存活Worker）"""
+    return get_worker_stats()
+
+@router.post("/books/{book_id}/cache/evict")
+def evict_book_from_cache(
+    book_id: int,
+    mode: str = Query(default="patch", description="patch: 从缓存列表中移除该书, invalidate: 失效受影响用户的缓存"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """通过反向索引只处理缓存列表中包含该书的用户（书籍下架、封面缺失等）"""
+    if mode not in ("patch", "invalidate"):
+        raise HTTPException(status_code=400, detail="mode must be 'patch' or 'invalidate'")
+    
+    cache_service = CacheService(db)
+    if mode == "invalidate":
+        affected = cache_service.invalidate_book(book_id)
+    else:
+        affected = cache_service.evict_book(book_id)
+    
+    return {"status": "success", "mode": mode, "affected_users": affected}
+
 @router.delete("/reviews/{review_id}")
 def delete_review(
     review_id: int,
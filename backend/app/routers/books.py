@@ -7,11 +7,16 @@ from app.core.deps import get_current_active_user
 from app.models.sql import Book, User, Interaction, Rating, SearchLog, Category, NegativeFeedback
 from app.schemas.base import (
     BookResponse, InteractionBase, RatingBase, SearchLogCreate,
-    NegativeFeedbackCreate, NegativeFeedbackResponse
+    NegativeFeedbackCreate, NegativeFeedbackResponse, ExposureLogCreate
 )
 from app.services.sync_service import SyncService
 from app.services.event_service import event_service, EventType
 from app.services.cache_service import CacheService
+from app.services.blacklist_service import BlacklistService
+from app.services.exclusion_service import exclusion_service
+from app.services.negative_feedback_service import NegativeFeedbackService
+from app.services.profile_service import ProfileService
+from app.services.similarity_service import similarity_service
 from neo4j import Session as Neo4jSession
 
 router = APIRouter()
@@ -75,12 +80,11 @@ def search_books(
     except Exception as e:
         print(f"Failed to sync search to Neo4j: {e}")
     
-    # 1.6 触发缓存失效事件（搜索行为，部分失效）
+    # 1.6 部分失效：由Worker异步重算缓存中的搜索关联片段，图谱+LLM片段保持不变
     event_service.publish_cache_invalidation(
         user_id=current_user.id,
         event_type=EventType.SEARCH,
-        priority=1,  # 普通优先级
-        extra_data={"query": search.query}
+        priority=1
     )
 
     # 2. Perform Search (Simple LIKE for now)
@@ -129,7 +133,13 @@ def create_interaction(
     sync = SyncService(neo4j)
     sync.sync_interaction(current_user.id, interaction.book_id, interaction.interaction_type)
     
-    # 3. 触发缓存失效事件
+    # 3. 更新已看过位图
+    exclusion_service.mark_seen(current_user.id, interaction.book_id)
+    
+    # 4. 累加用户类别画像
+    ProfileService(db).record_interaction(current_user.id, interaction.book_id)
+    
+    # 5. 触发缓存失效事件
     event_type = EventType.CLICK if interaction.interaction_type == "click" else EventType.COLLECT
     priority = 3 if interaction.interaction_type == "collect" else 1  # 收藏行为高优先级
     event_service.publish_cache_invalidation(
@@ -182,6 +192,9 @@ def create_review(
     sync = SyncService(neo4j)
     sync.sync_rating(current_user.id, book_id, rating.rating)
     
+    # 更新已看过位图
+    exclusion_service.mark_seen(current_user.id, book_id)
+    
     # 触发缓存失效事件（评分是高价值行为，立即失效）
     event_service.publish_cache_invalidation(
         user_id=current_user.id,
@@ -254,13 +267,24 @@ def create_negative_feedback(
     except Exception as e:
         print(f"Failed to sync negative feedback to Neo4j: {e}")
     
-    # 触发缓存失效事件
-    event_service.publish_cache_invalidation(
-        user_id=current_user.id,
-        event_type=EventType.NEGATIVE_FEEDBACK,
-        book_id=book_id,
-        priority=3  # 高优先级
-    )
+    # 更新Redis黑名单（推荐读取时据此过滤缓存）
+    blacklist = BlacklistService(db, neo4j)
+    blacklist.add_to_blacklist(current_user.id, book_id, feedback.feedback_type, feedback.reason)
+    if feedback.feedback_type == "wrong_category" and book.category:
+        blacklist.add_category_dislike(current_user.id, book.category.name)
+    elif feedback.feedback_type == "wrong_author" and book.author:
+        blacklist.add_author_dislike(current_user.id, book.author)
+    similarity_service.invalidate_user(current_user.id)
+    
+    # 缓存列表在读取时过滤，只有过滤后缓存池低于阈值才触发全量重算
+    exclusions = blacklist.get_exclusion_snapshot(current_user.id)
+    if CacheService(db).needs_recompute(current_user.id, exclusions):
+        event_service.publish_cache_invalidation(
+            user_id=current_user.id,
+            event_type=EventType.NEGATIVE_FEEDBACK,
+            book_id=book_id,
+            priority=3  # 高优先级
+        )
     
     # 添加书籍标题到响应
     db_feedback.book_title = book.title
@@ -295,7 +319,8 @@ def get_my_negative_feedback(
 def delete_negative_feedback(
     book_id: int,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    neo4j: Neo4jSession = Depends(get_neo4j_session)
 ):
     """
     删除负反馈（软删除）
@@ -313,12 +338,52 @@ def delete_negative_feedback(
     feedback.is_active = False
     db.commit()
     
-    # 触发缓存失效（因为可能需要重新推荐这本书）
-    event_service.publish_cache_invalidation(
-        user_id=current_user.id,
-        event_type=EventType.NEGATIVE_FEEDBACK,
-        book_id=book_id,
-        priority=2
-    )
+    # 移出Redis黑名单；缓存池在读取时过滤，书籍若仍在池中会自动恢复，无需重算
+    blacklist = BlacklistService(db, neo4j)
+    blacklist.remove_from_blacklist(current_user.id, book_id)
+    book = feedback.book
+    if book and feedback.feedback_type in ("wrong_category", "wrong_author"):
+        # 仍有同类别/同作者的有效负反馈时保留不喜欢标记
+        others = db.query(NegativeFeedback).join(Book).filter(
+            NegativeFeedback.user_id == current_user.id,
+            NegativeFeedback.feedback_type == feedback.feedback_type,
+            NegativeFeedback.is_active == True
+        )
+        if feedback.feedback_type == "wrong_category" and book.category:
+            if not others.filter(Book.category_id == book.category_id).count():
+                blacklist.remove_category_dislike(current_user.id, book.category.name)
+        elif feedback.feedback_type == "wrong_author" and book.author:
+            if not others.filter(Book.author == book.author).count():
+                blacklist.remove_author_dislike(current_user.id, book.author)
+    
+    similarity_service.invalidate_user(current_user.id)
+    
+    try:
+        SyncService(neo4j).remove_negative_feedback(current_user.id, book_id)
+    except Exception as e:
+        print(f"Failed to remove negative feedback from Neo4j: {e}")
     
     return {"status": "success", "message": "Negative feedback removed"}
+
+
+# ==================== 曝光API ====================
+
+@router.post("/exposures")
+def record_exposures(
+    exposure: ExposureLogCreate,
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db),
+    neo4j: Neo4jSession = Depends(get_neo4j_session)
+):
+    """
+    批量记录曝光（一页卡片一次请求）
+    计数先写入Redis，由后台线程批量落库
+    """
+    service = NegativeFeedbackService(db, neo4j)
+    feedbacks = service.record_exposures(current_user.id, exposure.book_ids)
+    
+    return {
+        "status": "success",
+        "recorded": len(set(exposure.book_ids)),
+        "implicit_feedbacks": len(feedbacks)
+    }
@@ -35,7 +35,7 @@ def recommend_books(
     user_id: int,
     limit: int = Query(default=10, ge=1, le=50, description="推荐数量"),
     enable_diversity: bool = Query(default=True, description="是否启用多样性控制"),
-    diversity_mode: str = Query(default="quota", description="多样性模式: quota, mmr, none"),
+    diversity_mode: str = Query(default="quota", description="多样性模式: quota, mmr, dpp, none"),
     force_refresh: bool = Query(default=False, description="是否强制刷新缓存"),
     db: Session = Depends(get_db), 
     neo4j: Neo4jSession = Depends(get_neo4j_session)
@@ -49,6 +49,7 @@ def recommend_books(
     - diversity_mode: 多样性模式
         - quota: 类别配额算法（默认）
         - mmr: MMR算法
+        - dpp: 行列式点过程（DPP）
         - none: 不控制多样性
     - force_refresh: 是否强制刷新缓存
     """
@@ -126,7 +126,7 @@ class RecommendationRequest(BaseModel):
     """推荐请求（支持多样性参数）"""
     limit: int = 10
     enable_diversity: bool = True  # 是否启用多样性控制
-    diversity_mode: str = "quota"  # quota: 类别配额, mmr: MMR算法, none: 不控制
+    diversity_mode: str = "quota"  # quota: 类别配额, mmr: MMR算法, dpp: 行列式点过程, none: 不控制
     mmr_lambda: float = 0.5       # MMR算法的λ参数（相关性和多样性的平衡）
     exclude_seen: bool = True     # 是否排除已看过的书籍
     include_explore: bool = True  # 是否包含探索类别
@@ -2,13 +2,25 @@
 黑名单服务
 使用Redis Set存储用户黑名单，支持同步到Neo4j
 """
-from typing import Set, List, Optional
+import threading
+import time
+from typing import Set, List, Dict, Optional, Any
 from sqlalchemy.orm import Session
 from neo4j import Session as Neo4jSession
 
 from app.core.cache import redis_cache
-from app.models.sql import NegativeFeedback, Book
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.models.sql import NegativeFeedback, Book, Category
 from app.services.sync_service import SyncService
+from app.services.exclusion_service import exclusion_service
+
+
+# 全量重建完成标记；Redis被清空后该Key消失，据此判断需要重建
+BLACKLIST_REBUILT_KEY = "blacklist:rebuilt"
+# 全量重建互斥锁，避免多个进程同时重建
+BLACKLIST_REBUILD_LOCK_KEY = "blacklist:rebuilding"
+BLACKLIST_REBUILD_LOCK_TTL = 600
 
 
 class BlacklistService:
@@ -51,6 +63,7 @@ class BlacklistService:
         try:
             key = self.cache.blacklist_key(user_id)
             result = self.cache.sadd(key, str(book_id))
+            exclusion_service.set_blacklisted(user_id, [book_id], True)
             
             if result > 0:
                 print(f"Added book {book_id} to blacklist for user {user_id}")
@@ -61,6 +74,30 @@ class BlacklistService:
             print(f"Failed to add to blacklist: {e}")
             return False
     
+    def add_many_to_blacklist(self, user_id: int, book_ids: List[int]) -> int:
+        """
+        批量将书籍加入用户黑名单（一次SADD写入）
+        
+        Returns:
+            新加入的数量
+        """
+        book_ids = list(dict.fromkeys(book_ids))
+        if not book_ids:
+            return 0
+        
+        try:
+            key = self.cache.blacklist_key(user_id)
+            result = self.cache.sadd(key, *[str(b) for b in book_ids])
+            exclusion_service.set_blacklisted(user_id, book_ids, True)
+            
+            if result > 0:
+                print(f"Added {result} books to blacklist for user {user_id}")
+            return result
+            
+        except Exception as e:
+            print(f"Failed to add to blacklist: {e}")
+            return 0
+    
     def remove_from_blacklist(self, user_id: int, book_id: int) -> bool:
         """
         从黑名单移除书籍
@@ -68,6 +105,7 @@ class BlacklistService:
         try:
             key = self.cache.blacklist_key(user_id)
             result = self.cache.srem(key, str(book_id))
+            exclusion_service.set_blacklisted(user_id, [book_id], False)
             
             if result > 0:
                 print(f"Removed book {book_id} from blacklist for user {user_id}")
@@ -78,6 +116,33 @@ class BlacklistService:
             print(f"Failed to remove from blacklist: {e}")
             return False
     
+    def remove_many_from_blacklist(self, user_books: Dict[int, List[int]]) -> int:
+        """
+        批量从多个用户的黑名单移除书籍（一次Pipeline往返）
+        
+        受影响用户的黑名单位图直接删除，下次读取时从Set重建
+        
+        Args:
+            user_books: {用户ID: [书籍ID, ...]}
+            
+        Returns:
+            实际移除的数量
+        """
+        user_books = {u: books for u, books in user_books.items() if books}
+        if not user_books:
+            return 0
+        
+        def build(pipe):
+            for user_id, book_ids in user_books.items():
+                key = self.cache.blacklist_key(user_id)
+                values = [str(b) for b in book_ids]
+                self.cache.fallback.srem(key, *values)
+                pipe.srem(key, *values)
+                pipe.delete(self.cache.blacklist_bitmap_key(user_id))
+        
+        results = self.cache.execute_pipeline(build)
+        return sum(results[::2]) if results else 0
+    
     def is_blacklisted(self, user_id: int, book_id: int) -> bool:
         """
         检查书籍是否在用户黑名单中
@@ -139,6 +204,28 @@ class BlacklistService:
             print(f"Add author dislike error: {e}")
             return False
     
+    def remove_category_dislike(self, user_id: int, category_name: str) -> bool:
+        """
+        移除不喜欢的类别
+        """
+        try:
+            key = self.cache.category_dislike_key(user_id)
+            return self.cache.srem(key, category_name) > 0
+        except Exception as e:
+            print(f"Remove category dislike error: {e}")
+            return False
+    
+    def remove_author_dislike(self, user_id: int, author_name: str) -> bool:
+        """
+        移除不喜欢的作者
+        """
+        try:
+            key = self.cache.author_dislike_key(user_id)
+            return self.cache.srem(key, author_name) > 0
+        except Exception as e:
+            print(f"Remove author dislike error: {e}")
+            return False
+    
     def get_disliked_categories(self, user_id: int) -> Set[str]:
         """
         获取不喜欢的类别列表
@@ -161,8 +248,87 @@ class BlacklistService:
             print(f"Get disliked authors error: {e}")
             return set()
     
+    def get_exclusion_snapshot(self, user_id: int) -> Dict[str, Set]:
+        """
+        获取用户的排除快照（黑名单 + 不喜欢的类别/作者）
+        一次Pipeline往返读取三个Set，用于读时过滤缓存的推荐列表
+        
+        Returns:
+            {"books": {1, 2}, "categories": {"科幻"}, "authors": {"刘慈欣"}}
+        """
+        try:
+            book_ids, categories, authors = self.cache.smembers_many(
+                self.cache.blacklist_key(user_id),
+                self.cache.category_dislike_key(user_id),
+                self.cache.author_dislike_key(user_id)
+            )
+            return {
+                "books": {int(id) for id in book_ids if id.isdigit()},
+                "categories": set(categories),
+                "authors": set(authors)
+            }
+        except Exception as e:
+            print(f"Get exclusion snapshot error: {e}")
+            return {"books": set(), "categories": set(), "authors": set()}
+    
     # ==================== MySQL同步 ====================
     
+    def _feedback_query(self):
+        """有效负反馈联表书籍和类别（一次查询取齐重建所需的列）"""
+        return self.db.query(
+            NegativeFeedback.user_id,
+            NegativeFeedback.book_id,
+            NegativeFeedback.feedback_type,
+            Book.author,
+            Category.name.label("category_name")
+        ).join(
+            Book, Book.id == NegativeFeedback.book_id
+        ).outerjoin(
+            Category, Category.id == Book.category_id
+        ).filter(
+            NegativeFeedback.is_active == True
+        )
+    
+    @staticmethod
+    def _new_user_sets(user_id: int) -> Dict[str, Any]:
+        return {"user_id": user_id, "books": set(), "categories": set(), "authors": set()}
+    
+    @staticmethod
+    def _collect_row(user_sets: Dict[str, Any], row: Any):
+        """把一行负反馈归入用户的书籍/类别/作者集合"""
+        user_sets["books"].add(str(row.book_id))
+        if row.feedback_type == "wrong_category" and row.category_name:
+            user_sets["categories"].add(row.category_name)
+        elif row.feedback_type == "wrong_author" and row.author:
+            user_sets["authors"].add(row.author)
+    
+    def _write_user_sets(self, batch: List[Dict[str, Any]], replace: bool = True) -> bool:
+        """
+        用一次Pipeline写入一批用户的黑名单和类别/作者不喜欢集合
+        黑名单位图同时删除，读取时从新的Set重建
+        
+        Args:
+            replace: True 整体替换原有集合；False 只追加（SADD合并），不会删除快照读取之后新写入的成员
+        """
+        if not batch:
+            return True
+        
+        def build(pipe):
+            for user_sets in batch:
+                user_id = user_sets["user_id"]
+                for key, members in (
+                    (self.cache.blacklist_key(user_id), user_sets["books"]),
+                    (self.cache.category_dislike_key(user_id), user_sets["categories"]),
+                    (self.cache.author_dislike_key(user_id), user_sets["authors"])
+                ):
+                    if replace:
+                        pipe.delete(key)
+                    if members:
+                        pipe.sadd(key, *members)
+                pipe.delete(self.cache.blacklist_bitmap_key(user_id))
+        
+        return bool(self.cache.execute_pipeline(build))
+    
     def sync_from_mysql(self, user_id: int) -> int:
         """
         从MySQL同步黑名单到Redis
@@ -174,22 +340,12 @@ class BlacklistService:
             return 0
         
         try:
-            feedbacks = self.db.query(NegativeFeedback).filter(
-                NegativeFeedback.user_id == user_id,
-                NegativeFeedback.is_active == True
-            ).all()
-            
-            count = 0
-            for f in feedbacks:
-                if self.add_to_blacklist(user_id, f.book_id, f.feedback_type):
-                    count += 1
-                
-                # 同步类别/作者不喜欢
-                if f.feedback_type == "wrong_category" and f.book and f.book.category:
-                    self.add_category_dislike(user_id, f.book.category.name)
-                elif f.feedback_type == "wrong_author" and f.book and f.book.author:
-                    self.add_author_dislike(user_id, f.book.author)
+            user_sets = self._new_user_sets(user_id)
+            for row in self._feedback_query().filter(NegativeFeedback.user_id == user_id):
+                self._collect_row(user_sets, row)
             
+            self._write_user_sets([user_sets])
+            count = len(user_sets["books"])
             print(f"Synced {count} blacklist items from MySQL for user {user_id}")
             return count
             
@@ -197,6 +353,70 @@ class BlacklistService:
             print(f"Sync from MySQL error: {e}")
             return 0
     
+    def rebuild_all_from_mysql(self, batch_size: int = 1000) -> Dict[str, Any]:
+        """
+        从MySQL全量重建所有用户的黑名单和类别/作者不喜欢集合
+        
+        负反馈联表书籍、类别后按用户ID排序，用服务端游标流式读取；
+        每累计 batch_size 行就把已完整读取的用户集合用一次Pipeline写入；
+        重建在后台与请求并发执行，只合并（SADD）不删除，避免覆盖期间新加入的黑名单
+        
+        Returns:
+            统计信息（用户数、行数、耗时）
+        """
+        stats = {"users": 0, "rows": 0, "elapsed": 0.0, "completed": False}
+        if not self.db:
+            return stats
+        
+        lock_token = self.cache.acquire_lock(BLACKLIST_REBUILD_LOCK_KEY, BLACKLIST_REBUILD_LOCK_TTL)
+        if not lock_token:
+            print("Blacklist rebuild is already running, skipped")
+            return stats
+        
+        started = time.time()
+        try:
+            query = self._feedback_query().order_by(
+                NegativeFeedback.user_id
+            ).execution_options(stream_results=True, yield_per=batch_size)
+            
+            batch: List[Dict[str, Any]] = []
+            batch_rows = 0
+            current = None
+            for row in query:
+                if current is None or row.user_id != current["user_id"]:
+                    if current is not None:
+                        batch.append(current)
+                        if batch_rows >= batch_size:
+                            if not self._write_user_sets(batch, replace=False):
+                                print("Blacklist rebuild aborted: Redis write failed")
+                                return stats
+                            stats["users"] += len(batch)
+                            batch, batch_rows = [], 0
+                    current = self._new_user_sets(row.user_id)
+                
+                self._collect_row(current, row)
+                batch_rows += 1
+                stats["rows"] += 1
+            
+            if current is not None:
+                batch.append(current)
+            if not self._write_user_sets(batch, replace=False):
+                print("Blacklist rebuild aborted: Redis write failed")
+                return stats
+            stats["users"] += len(batch)
+            
+            self.cache.set(BLACKLIST_REBUILT_KEY, str(int(time.time())))
+            stats["completed"] = True
+            
+        except Exception as e:
+            print(f"Blacklist rebuild error: {e}")
+        finally:
+            self.cache.release_lock(BLACKLIST_REBUILD_LOCK_KEY, lock_token)
+            stats["elapsed"] = round(time.time() - started, 3)
+        
+        print(f"Rebuilt blacklists for {stats['users']} users from {stats['rows']} rows in {stats['elapsed']}s")
+        return stats
+    
     # ==================== Neo4j同步 ====================
     
     def sync_to_neo4j(
@@ -298,6 +518,75 @@ class BlacklistService:
 blacklist_service = BlacklistService()
 
 
+def ensure_blacklists_loaded() -> bool:
+    """
+    检测Redis是否为冷状态（重建标记不存在），是则从MySQL全量重建黑名单
+    
+    Returns:
+        是否执行了重建
+    """
+    if not redis_cache.is_connected() or redis_cache.exists(BLACKLIST_REBUILT_KEY):
+        return False
+    
+    print("Cold Redis detected, rebuilding blacklists from MySQL")
+    db = SessionLocal()
+    try:
+        return BlacklistService(db).rebuild_all_from_mysql()["completed"]
+    finally:
+        db.close()
+
+
+class BlacklistWatcher:
+    """
+    冷Redis检测线程
+    
+    定期检查重建标记，Redis熔断恢复时立即检查一次；
+    运行期间Redis被清空或故障切换后标记消失，自动从MySQL全量重建黑名单
+    """
+    
+    def __init__(self):
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        redis_cache.breaker.add_close_listener(self._wake.set)
+    
+    def start(self, interval: float = None):
+        """启动检测线程（启动后立即检查一次）"""
+        if self._thread and self._thread.is_alive():
+            print("Blacklist Watcher is already running")
+            return
+        
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(interval or settings.BLACKLIST_CHECK_INTERVAL,),
+            daemon=True
+        )
+        self._thread.start()
+        print("Blacklist Watcher started")
+    
+    def stop(self):
+        """停止检测线程"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        print("Blacklist Watcher stopped")
+    
+    def _run(self, interval: float):
+        while not self._stop.is_set():
+            try:
+                ensure_blacklists_loaded()
+            except Exception as e:
+                print(f"Blacklist Watcher error: {e}")
+            self._wake.wait(interval)
+            self._wake.clear()
+
+
+# 全局冷Redis检测线程
+blacklist_watcher = BlacklistWatcher()
+
+
 def get_blacklist_service() -> BlacklistService:
     """获取黑名单服务实例"""
     return blacklist_service
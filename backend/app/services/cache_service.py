@@ -4,11 +4,13 @@
 支持两级缓存：L1(Redis) + L2(MySQL)
 """
 import json
+import time
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Set
 from sqlalchemy.orm import Session
 from app.core.cache import redis_cache
 from app.core.config import settings
+from app.core.metrics import metrics, SIZE_BUCKETS, AGE_BUCKETS
 from app.models.sql import RecommendationCache
 
 
@@ -23,6 +25,25 @@ class CacheService:
         """设置数据库会话"""
         self.db = db
     
+    # ==================== 指标 ====================
+    
+    def _record(self, level: str, op: str, outcome: str, started: float, payload_bytes: int = None):
+        """
+        记录一次缓存操作
+        
+        Args:
+            level: l1 / l2
+            op: get / set / invalidate / mark_stale
+            outcome: hit / miss / stale / expired / error / ok
+            started: 操作开始时间（time.perf_counter）
+            payload_bytes: 读写的负载大小
+        """
+        labels = {"level": level, "op": op}
+        metrics.inc("cache_operations_total", {**labels, "outcome": outcome})
+        metrics.observe("cache_latency_seconds", time.perf_counter() - started, labels)
+        if payload_bytes is not None:
+            metrics.observe("cache_payload_bytes", payload_bytes, labels, SIZE_BUCKETS)
+    
     # ==================== L1缓存操作（Redis） ====================
     
     def get_l1_cache(self, user_id: int) -> Optional[List[Dict]]:
@@ -32,15 +53,22 @@ class CacheService:
         Returns:
             推荐列表或None
         """
+        started = time.perf_counter()
         try:
             key = self.cache.recommendation_key(user_id)
-            data = self.cache.get_json(key)
+            raw = self.cache.get(key)
+            data = json.loads(raw) if raw else None
+            # 熔断期间由进程内兜底存储提供，按error统计
+            degraded = self.cache.breaker.is_open
             if data:
                 print(f"L1 cache hit for user_id={user_id}")
+                self._record("l1", "get", "error" if degraded else "hit", started, len(raw.encode("utf-8")))
                 return data
+            self._record("l1", "get", "error" if degraded else "miss", started)
             return None
         except Exception as e:
             print(f"L1 cache get error: {e}")
+            self._record("l1", "get", "error", started)
             return None
     
     def set_l1_cache(self, user_id: int, recommendations: List[Dict], ttl: int = None) -> bool:
@@ -52,26 +80,34 @@ class CacheService:
             recommendations: 推荐列表
             ttl: 过期时间（秒），默认使用配置值
         """
+        started = time.perf_counter()
         try:
             key = self.cache.recommendation_key(user_id)
             ttl = ttl or settings.CACHE_L1_TTL
-            return self.cache.set_json(key, recommendations, ttl)
+            payload = json.dumps(recommendations, ensure_ascii=False)
+            success = self.cache.set(key, payload, ttl)
+            self._record("l1", "set", "ok" if success else "error", started, len(payload.encode("utf-8")))
+            return success
         except Exception as e:
             print(f"L1 cache set error: {e}")
+            self._record("l1", "set", "error", started)
             return False
     
     def invalidate_l1_cache(self, user_id: int) -> bool:
         """
         立即删除L1缓存
         """
+        started = time.perf_counter()
         try:
             key = self.cache.recommendation_key(user_id)
             result = self.cache.delete(key)
             if result:
                 print(f"L1 cache invalidated for user_id={user_id}")
+            self._record("l1", "invalidate", "ok" if result else "miss", started)
             return result
         except Exception as e:
             print(f"L1 cache invalidate error: {e}")
+            self._record("l1", "invalidate", "error", started)
             return False
     
     # ==================== L2缓存操作（MySQL） ====================
@@ -85,32 +121,41 @@ class CacheService:
         """
         if not self.db:
             return None
-            
+        
+        started = time.perf_counter()
         try:
             cache = self.db.query(RecommendationCache).filter(
                 RecommendationCache.user_id == user_id
             ).first()
             
             if not cache:
+                self._record("l2", "get", "miss", started)
                 return None
             
             # 检查是否标记为stale
             if cache.is_stale:
                 print(f"L2 cache is stale for user_id={user_id}")
+                self._record("l2", "get", "stale", started)
                 return None
             
             # 检查是否过期（24小时）
             cache_time = cache.updated_at if cache.updated_at else cache.created_at
-            if datetime.now() - cache_time > timedelta(seconds=settings.CACHE_L3_TTL):
+            age = datetime.now() - cache_time
+            if age > timedelta(seconds=settings.CACHE_L3_TTL):
                 print(f"L2 cache expired for user_id={user_id}")
+                self._record("l2", "get", "expired", started)
                 return None
             
             data = json.loads(cache.recommendations)
             print(f"L2 cache hit for user_id={user_id}")
+            self._record("l2", "get", "hit", started, len(cache.recommendations.encode("utf-8")))
+            # 命中时的条目年龄，用于评估 CACHE_L3_TTL
+            metrics.observe("cache_hit_age_seconds", age.total_seconds(), {"level": "l2"}, AGE_BUCKETS)
             return data
             
         except Exception as e:
             print(f"L2 cache get error: {e}")
+            self._record("l2", "get", "error", started)
             return None
     
     def set_l2_cache(self, user_id: int, recommendations: List[Dict]) -> bool:
@@ -119,7 +164,8 @@ class CacheService:
         """
         if not self.db:
             return False
-            
+        
+        started = time.perf_counter()
         try:
             cache = self.db.query(RecommendationCache).filter(
                 RecommendationCache.user_id == user_id
@@ -141,11 +187,13 @@ class CacheService:
             
             self.db.commit()
             print(f"L2 cache updated for user_id={user_id}")
+            self._record("l2", "set", "ok", started, len(cache_data.encode("utf-8")))
             return True
             
         except Exception as e:
             print(f"L2 cache set error: {e}")
             self.db.rollback()
+            self._record("l2", "set", "error", started)
             return False
     
     def mark_l2_cache_stale(self, user_id: int) -> bool:
@@ -155,7 +203,8 @@ class CacheService:
         """
         if not self.db:
             return False
-            
+        
+        started = time.perf_counter()
         try:
             cache = self.db.query(RecommendationCache).filter(
                 RecommendationCache.user_id == user_id
@@ -165,12 +214,15 @@ class CacheService:
                 cache.is_stale = True
                 self.db.commit()
                 print(f"L2 cache marked as stale for user_id={user_id}")
+                self._record("l2", "mark_stale", "ok", started)
                 return True
+            self._record("l2", "mark_stale", "miss", started)
             return False
             
         except Exception as e:
             print(f"L2 cache mark stale error: {e}")
             self.db.rollback()
+            self._record("l2", "mark_stale", "error", started)
             return False
     
     def invalidate_l2_cache(self, user_id: int) -> bool:
@@ -179,7 +231,8 @@ class CacheService:
         """
         if not self.db:
             return False
-            
+        
+        started = time.perf_counter()
         try:
             result = self.db.query(RecommendationCache).filter(
                 RecommendationCache.user_id == user_id
@@ -187,11 +240,14 @@ class CacheService:
             self.db.commit()
             if result:
                 print(f"L2 cache deleted for user_id={user_id}")
+                self._clear_reverse_index(user_id)
+            self._record("l2", "invalidate", "ok" if result else "miss", started)
             return result > 0
             
         except Exception as e:
             print(f"L2 cache delete error: {e}")
             self.db.rollback()
+            self._record("l2", "invalidate", "error", started)
             return False
     
     # ==================== 统一缓存操作 ====================
@@ -217,20 +273,98 @@ class CacheService:
         
         return None
     
-    def set_recommendations(self, user_id: int, recommendations: List[Dict]) -> bool:
+    def set_recommendations(self, user_id: int, recommendations: List[Dict], recomputed: bool = True) -> bool:
         """
         设置推荐缓存（同时设置L1和L2）
+        
+        Args:
+            recomputed: 是否为完整计算的结果；增量修补和片段替换不刷新计算时间
         """
         l1_success = self.set_l1_cache(user_id, recommendations)
         l2_success = self.set_l2_cache(user_id, recommendations)
+        if l1_success or l2_success:
+            self._update_reverse_index(user_id, recommendations)
+            if recomputed:
+                self.cache.set(
+                    self.cache.recommendation_computed_key(user_id),
+                    str(int(time.time())),
+                    settings.CACHE_L3_TTL
+                )
         return l1_success or l2_success
     
+    def get_cache_age(self, user_id: int) -> Optional[int]:
+        """
+        距上次完整计算推荐缓存的秒数
+        
+        Returns:
+            秒数；没有记录时返回None（按缓存过旧处理）
+        """
+        value = self.cache.get(self.cache.recommendation_computed_key(user_id))
+        try:
+            return max(int(time.time()) - int(value), 0) if value else None
+        except ValueError:
+            return None
+    
+    # ==================== 读时过滤 ====================
+    
+    @staticmethod
+    def filter_excluded(recommendations: List[Dict], exclusions: Optional[Dict[str, set]]) -> List[Dict]:
+        """
+        按用户当前的排除快照过滤缓存的推荐池
+        
+        缓存池按顺序存放展示列表和备选候选，过滤后取前N个即可由备选自动补位
+        
+        Args:
+            recommendations: 缓存的推荐池
+            exclusions: BlacklistService.get_exclusion_snapshot 返回的快照
+        
+        Returns:
+            过滤后的推荐池（保持原顺序）
+        """
+        if not exclusions:
+            return list(recommendations)
+        
+        excluded_books = exclusions.get("books") or set()
+        excluded_categories = exclusions.get("categories") or set()
+        excluded_authors = exclusions.get("authors") or set()
+        
+        result = []
+        for rec in recommendations:
+            if rec.get("book_id") in excluded_books:
+                continue
+            if rec.get("category_name") and rec["category_name"] in excluded_categories:
+                continue
+            if rec.get("author") and rec["author"] in excluded_authors:
+                continue
+            result.append(rec)
+        return result
+    
+    @staticmethod
+    def pool_threshold(limit: Optional[int] = None) -> int:
+        """过滤后缓存池的最小可用数量，低于该值才需要全量重算"""
+        return max(limit or settings.RECOMMENDATION_LIMIT, settings.CACHE_POOL_REFILL_THRESHOLD)
+    
+    def needs_recompute(self, user_id: int, exclusions: Optional[Dict[str, set]], limit: Optional[int] = None) -> bool:
+        """
+        判断负反馈后是否需要全量重算
+        
+        只有当缓存池经过读时过滤后低于阈值时才返回True；
+        没有缓存时下次请求会自然重算，无需触发
+        """
+        cached = self.get_recommendations(user_id)
+        if not cached:
+            return False
+        
+        pool = self.filter_excluded(cached, exclusions)
+        return len(pool) < self.pool_threshold(limit)
+    
     def invalidate_user_cache(self, user_id: int) -> bool:
         """
         立即删除用户的所有推荐缓存（L1 + L2标记为stale）
         """
         l1_result = self.invalidate_l1_cache(user_id)
         l2_result = self.mark_l2_cache_stale(user_id)
+        self._clear_reverse_index(user_id)
         print(f"Cache invalidated for user_id={user_id}: L1={l1_result}, L2_stale={l2_result}")
         return l1_result or l2_result
     
@@ -247,16 +381,20 @@ class CacheService:
             是否应该失效
         """
         # 高价值行为立即失效
-        if event_type in ["rating", "collect", "negative_feedback"]:
+        if event_type in ["rating", "collect"]:
             return True
+
+        # 负反馈在读取时过滤，缓存池不足时才失效
+        if event_type == "negative_feedback":
+            return False
         
         # 点击行为累计失效
         if event_type == "click":
             return self._check_click_threshold(user_id)
         
-        # 搜索行为部分失效（可以选择不完全失效）
+        # 搜索行为只替换缓存中的搜索关联片段（见 replace_segment），不整体失效
         if event_type == "search":
-            return True  # 暂时全部失效，后续可优化为部分失效
+            return False
         
         return False
     
@@ -274,6 +412,151 @@ class CacheService:
             print(f"Click threshold check error: {e}")
             return True  # 出错时保守处理
     
+    # ==================== 片段替换（部分失效） ====================
+    
+    def replace_segment(self, user_id: int, segment: str, entries: List[Dict]) -> bool:
+        """
+        替换缓存条目中的某个片段，其余片段保持不变
+        
+        新片段放在列表最前（与全量计算时搜索关联推荐在前一致），
+        其他片段中与新条目重复的书籍会被移除
+        
+        Args:
+            user_id: 用户ID
+            segment: 片段名称（如 search）
+            entries: 新片段的缓存条目
+            
+        Returns:
+            是否写回成功；没有缓存时返回False
+        """
+        cached = self.get_recommendations(user_id)
+        if not cached:
+            return False
+        
+        new_ids = {e.get("book_id") for e in entries}
+        kept = [
+            rec for rec in cached
+            if rec.get("segment", "main") != segment and rec.get("book_id") not in new_ids
+        ]
+        return self.set_recommendations(user_id, entries + kept, recomputed=False)
+    
+    # ==================== 反向索引（书籍 -> 用户） ====================
+    
+    @staticmethod
+    def _index_ttl() -> int:
+        """反向索引过期时间，与最长存活的缓存条目一致（L2按CACHE_L3_TTL过期）"""
+        return max(settings.CACHE_L1_TTL, settings.CACHE_L3_TTL)
+    
+    def _update_reverse_index(self, user_id: int, recommendations: List[Dict]):
+        """
+        维护书籍到用户的反向索引
+        
+        每本书一个整数Set（Redis使用intset紧凑编码），记录缓存列表包含该书的用户；
+        同时记录用户已索引的书籍，以便列表变化时移除过期的映射
+        """
+        user_key = self.cache.user_books_key(user_id)
+        new_ids = {rec.get("book_id") for rec in recommendations if rec.get("book_id") is not None}
+        old_ids = {int(b) for b in self.cache.smembers(user_key) if b.isdigit()}
+        ttl = self._index_ttl()
+        
+        def build(pipe):
+            for book_id in old_ids - new_ids:
+                pipe.srem(self.cache.book_users_key(book_id), user_id)
+            for book_id in new_ids:
+                book_key = self.cache.book_users_key(book_id)
+                pipe.sadd(book_key, user_id)
+                pipe.expire(book_key, ttl)
+            pipe.delete(user_key)
+            if new_ids:
+                pipe.sadd(user_key, *new_ids)
+                pipe.expire(user_key, ttl)
+        
+        self.cache.execute_pipeline(build)
+    
+    def _clear_reverse_index(self, user_id: int):
+        """从反向索引中移除用户（其缓存已失效）"""
+        user_key = self.cache.user_books_key(user_id)
+        book_ids = [int(b) for b in self.cache.smembers(user_key) if b.isdigit()]
+        
+        def build(pipe):
+            for book_id in book_ids:
+                pipe.srem(self.cache.book_users_key(book_id), user_id)
+            pipe.delete(user_key)
+        
+        self.cache.execute_pipeline(build)
+    
+    def get_users_with_book(self, book_id: int) -> Set[int]:
+        """
+        获取缓存列表中包含指定书籍的用户
+        
+        Returns:
+            用户ID集合
+        """
+        members = self.cache.smembers(self.cache.book_users_key(book_id))
+        return {int(m) for m in members if m.isdigit()}
+    
+    def invalidate_book(self, book_id: int) -> int:
+        """
+        失效所有包含指定书籍的用户缓存（书籍下架等需要重算的场景）
+        
+        Returns:
+            受影响的用户数
+        """
+        user_ids = self.get_users_with_book(book_id)
+        for user_id in user_ids:
+            self.invalidate_user_cache(user_id)
+        self.cache.delete(self.cache.book_users_key(book_id))
+        print(f"Invalidated cache of {len(user_ids)} users containing book_id={book_id}")
+        return len(user_ids)
+    
+    def evict_book(self, book_id: int) -> int:
+        """
+        从所有包含指定书籍的缓存列表中移除该书（就地修补，不触发重算）
+        
+        Returns:
+            受影响的用户数
+        """
+        user_ids = self.get_users_with_book(book_id)
+        if not user_ids:
+            return 0
+        
+        # L1：保留剩余TTL写回；读取后已过期（TTL为-2）或TTL未知时跳过，避免写出永不过期的缓存
+        for user_id in user_ids:
+            key = self.cache.recommendation_key(user_id)
+            data = self.cache.get_json(key)
+            if data:
+                remaining = self.cache.ttl(key)
+                if remaining <= 0:
+                    continue
+                patched = [rec for rec in data if rec.get("book_id") != book_id]
+                self.cache.set_json(key, patched, remaining)
+        
+        # L2：一次查询、一次提交
+        if self.db:
+            try:
+                caches = self.db.query(RecommendationCache).filter(
+                    RecommendationCache.user_id.in_(user_ids)
+                ).all()
+                for cache in caches:
+                    data = json.loads(cache.recommendations)
+                    cache.recommendations = json.dumps(
+                        [rec for rec in data if rec.get("book_id") != book_id],
+                        ensure_ascii=False
+                    )
+                self.db.commit()
+            except Exception as e:
+                print(f"L2 cache evict error: {e}")
+                self.db.rollback()
+        
+        def build(pipe):
+            for user_id in user_ids:
+                pipe.srem(self.cache.user_books_key(user_id), book_id)
+            pipe.delete(self.cache.book_users_key(book_id))
+        
+        self.cache.execute_pipeline(build)
+        print(f"Evicted book_id={book_id} from cache of {len(user_ids)} users")
+        return len(user_ids)
+    
     # ==================== 缓存合并（增量更新） ====================
     
     def merge_recommendations(
@@ -326,6 +609,62 @@ class CacheService:
         
         return merged[:settings.RECOMMENDATION_LIMIT]
     
+    # ==================== 缓存统计 ====================
+    
+    @staticmethod
+    def get_cache_stats() -> Dict[str, Any]:
+        """
+        汇总L1/L2缓存指标（当前进程）
+        
+        Returns:
+            各级缓存的命中率、stale/过期率、错误率、延迟分位数、负载大小，
+            以及L2命中时的条目年龄分布（用于调整 CACHE_L1_TTL / CACHE_L3_TTL）
+        """
+        def ratio(part: float, total: float) -> float:
+            return round(part / total, 4) if total else 0.0
+        
+        levels = {}
+        for level in ("l1", "l2"):
+            gets = metrics.counter_value("cache_operations_total", level=level, op="get")
+            outcomes = {
+                outcome: metrics.counter_value("cache_operations_total", level=level, op="get", outcome=outcome)
+                for outcome in ("hit", "miss", "stale", "expired", "error")
+            }
+            ops = {}
+            for op in ("get", "set", "invalidate", "mark_stale"):
+                latency = metrics.histogram("cache_latency_seconds", level=level, op=op)
+                payload = metrics.histogram("cache_payload_bytes", level=level, op=op)
+                if latency:
+                    ops[op] = {
+                        "count": latency.count,
+                        "latency_seconds": latency.summary(),
+                        "payload_bytes": payload.summary() if payload else None
+                    }
+            levels[level] = {
+                "gets": gets,
+                "outcomes": outcomes,
+                "hit_ratio": ratio(outcomes["hit"], gets),
+                "stale_ratio": ratio(outcomes["stale"], gets),
+                "expired_ratio": ratio(outcomes["expired"], gets),
+                "error_ratio": ratio(outcomes["error"], gets),
+                "operations": ops
+            }
+        
+        l1_gets = levels["l1"]["gets"]
+        served = levels["l1"]["outcomes"]["hit"] + levels["l2"]["outcomes"]["hit"]
+        l2_age = metrics.histogram("cache_hit_age_seconds", level="l2")
+        
+        return {
+            "overall_hit_ratio": ratio(served, l1_gets),
+            "levels": levels,
+            "l2_hit_age_seconds": l2_age.summary() if l2_age else None,
+            "ttl_config": {
+                "CACHE_L1_TTL": settings.CACHE_L1_TTL,
+                "CACHE_L2_TTL": settings.CACHE_L2_TTL,
+                "CACHE_L3_TTL": settings.CACHE_L3_TTL
+            }
+        }
+    
     # ==================== 缓存预热 ====================
     
     def warm_cache(self, user_ids: List[int], compute_func) -> int:
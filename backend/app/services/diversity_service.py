@@ -4,11 +4,12 @@
 """
 from typing import List, Dict, Any, Tuple, Set
 from collections import defaultdict
+import numpy as np
 from sqlalchemy.orm import Session
-from sqlalchemy import func
 
 from app.core.config import settings
-from app.models.sql import Interaction, Book, Category
+from app.services.history_service import HistoryService
+from app.services.profile_service import ProfileService
 
 
 class DiversityService:
@@ -43,35 +44,22 @@ class DiversityService:
             return self._empty_profile(user_id)
         
         try:
-            # 查询用户交互的书籍类别分布
-            results = self.db.query(
-                Category.name,
-                func.count(Interaction.id).label("count")
-            ).join(
-                Book, Book.category_id == Category.id
-            ).join(
-                Interaction, Interaction.book_id == Book.id
-            ).filter(
-                Interaction.user_id == user_id
-            ).group_by(
-                Category.name
-            ).order_by(
-                func.count(Interaction.id).desc()
-            ).all()
-            
-            if not results:
+            # 类别计数来自Redis中增量维护的画像，不再每次聚合交互表
+            profile_service = ProfileService(self.db)
+            counts = profile_service.get_category_counts(user_id)
+            if not counts:
                 return self._empty_profile(user_id)
             
             # 计算总交互数
-            total = sum(r.count for r in results)
+            total = sum(counts.values())
             
-            # 构建分布
+            # 构建分布（按次数降序）
             distribution = []
-            for r in results:
+            for name, count in sorted(counts.items(), key=lambda x: (-x[1], x[0])):
                 distribution.append({
-                    "category_name": r.name,
-                    "count": r.count,
-                    "ratio": r.count / total if total > 0 else 0
+                    "category_name": name,
+                    "count": count,
+                    "ratio": count / total if total > 0 else 0
                 })
             
             # 分类：主类别、次类别、探索类别
@@ -88,9 +76,8 @@ class DiversityService:
                 cumulative_ratio += d["ratio"]
             
             # 探索类别：用户没有交互过但相关的类别
-            all_categories = self.db.query(Category.name).all()
-            interacted_categories = set(d["category_name"] for d in distribution)
-            explore = [c.name for c in all_categories if c.name not in interacted_categories][:3]
+            all_categories = profile_service.get_category_names()
+            explore = [c for c in all_categories if c not in counts][:3]
             
             return {
                 "user_id": user_id,
@@ -223,35 +210,94 @@ class DiversityService:
         selected = selected or []
         result = list(selected)
         remaining = [c for c in candidates if c not in selected]
-        
-        while len(result) < limit and remaining:
-            best_score = float("-inf")
-            best_candidate = None
+        if not remaining or len(result) >= limit:
+            return result[:limit]
+        
+        # 一次性计算候选与（已选 + 候选）的相似度矩阵
+        n_selected = len(result)
+        sim = self._similarity_matrix(remaining, result + remaining)
+        relevance = np.array([c.get("score", 0) for c in remaining], dtype=np.float64)
+        
+        # 与已选书籍的最大相似度（随每次选择增量更新）
+        max_sim = np.zeros(len(remaining))
+        if n_selected:
+            max_sim = np.maximum(max_sim, sim[:, :n_selected].max(axis=1))
+        
+        available = np.ones(len(remaining), dtype=bool)
+        while len(result) < limit and available.any():
+            # MMR分数
+            mmr_scores = lambda_param * relevance - (1 - lambda_param) * max_sim
+            mmr_scores[~available | np.isnan(mmr_scores)] = -np.inf
             
-            for candidate in remaining:
-                relevance = candidate.get("score", 0)
-                
-                # 计算与已选书籍的最大相似度
-                max_sim = 0
-                for s in result:
-                    sim = self._calculate_similarity(candidate, s)
-                    max_sim = max(max_sim, sim)
-                
-                # MMR分数
-                mmr_score = lambda_param * relevance - (1 - lambda_param) * max_sim
-                
-                if mmr_score > best_score:
-                    best_score = mmr_score
-                    best_candidate = candidate
-            
-            if best_candidate:
-                result.append(best_candidate)
-                remaining.remove(best_candidate)
-            else:
+            # argmax 取第一个最大值，与逐个比较（严格大于）的选择一致
+            best = int(np.argmax(mmr_scores))
+            if mmr_scores[best] == -np.inf or not remaining[best]:
                 break
+            
+            result.append(remaining[best])
+            available[best] = False
+            max_sim = np.maximum(max_sim, sim[:, n_selected + best])
         
         return result[:limit]
     
+    def _similarity_matrix(self, rows: List[Dict], cols: List[Dict]) -> np.ndarray:
+        """
+        批量计算相似度矩阵（与 _calculate_similarity 逐对计算结果一致）
+        
+        类别、作者、标签先编码为整数，再用数组运算得到 len(rows) × len(cols) 的矩阵
+        """
+        features = self._encode_features(rows + cols)
+        n = len(rows)
+        return self._similarity_block(features, slice(0, n), slice(n, None))
+    
+    @staticmethod
+    def _encode_features(items: List[Dict]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        把类别、作者、标签编码为数组
+        
+        Returns:
+            (类别编码, 作者编码, 标签多热矩阵, 标签数)，缺失的类别/作者编码为 -1
+        """
+        codes: Dict[str, int] = {}
+        
+        def encode(value) -> int:
+            return codes.setdefault(value, len(codes)) if value else -1
+        
+        cats = np.array([encode(b.get("category_name") or b.get("category", "")) for b in items])
+        codes.clear()
+        authors = np.array([encode(b.get("author", "")) for b in items])
+        
+        # 标签多热编码
+        tag_codes: Dict[str, int] = {}
+        tag_sets = [set(b.get("tags", [])) for b in items]
+        for tags in tag_sets:
+            for t in tags:
+                tag_codes.setdefault(t, len(tag_codes))
+        tag_matrix = np.zeros((len(items), max(len(tag_codes), 1)))
+        for i, tags in enumerate(tag_sets):
+            tag_matrix[i, [tag_codes[t] for t in tags]] = 1.0
+        
+        return cats, authors, tag_matrix, tag_matrix.sum(axis=1)
+    
+    @staticmethod
+    def _similarity_block(features: Tuple, rows, cols) -> np.ndarray:
+        """根据编码后的特征计算 rows × cols 的相似度（rows/cols 为索引或切片）"""
+        cats, authors, tag_matrix, sizes = features
+        r_cats, c_cats = cats[rows][:, None], cats[cols][None, :]
+        r_authors, c_authors = authors[rows][:, None], authors[cols][None, :]
+        
+        cat_sim = np.where((r_cats >= 0) & (r_cats == c_cats), 1.0, 0.0)
+        author_sim = np.where((r_authors >= 0) & (r_authors == c_authors), 0.8, 0.0)
+        
+        # 标签Jaccard：交集 / (|A| + |B| - 交集)，任一方没有标签时为0
+        intersection = tag_matrix[rows] @ tag_matrix[cols].T
+        r_sizes, c_sizes = sizes[rows][:, None], sizes[cols][None, :]
+        union = r_sizes + c_sizes - intersection
+        both = (r_sizes > 0) & (c_sizes > 0)
+        tag_sim = np.divide(intersection, union, out=np.zeros_like(intersection), where=both & (union > 0))
+        
+        return 0.5 * cat_sim + 0.3 * author_sim + 0.2 * tag_sim
+    
     def _calculate_similarity(self, book1: Dict, book2: Dict) -> float:
         """
         计算两本书的相似度
@@ -289,6 +335,89 @@ class DiversityService:
         
         return intersection / union if union > 0 else 0.0
     
+    # ==================== DPP算法 ====================
+    
+    def dpp_rerank(
+        self,
+        candidates: List[Dict[str, Any]],
+        limit: int = 10,
+        theta: float = None,
+        epsilon: float = 1e-10
+    ) -> List[Dict[str, Any]]:
+        """
+        使用行列式点过程（DPP）的快速贪心MAP推断重排序
+        
+        核矩阵 L = diag(q) · S · diag(q)：
+        - S 为与 _calculate_similarity 相同的相似度（对角线置1）
+        - q = exp(α × 归一化分数)，α = θ / (2(1-θ))，θ越大越重视相关性
+        
+        每步选择使 log det(L_Y) 增量最大的书籍，用增量Cholesky更新，
+        只按需计算已选书籍所在的核矩阵行，总复杂度 O(n·k²)；
+        核矩阵退化后剩余位置按分数补齐
+        
+        Args:
+            candidates: 候选书籍列表
+            limit: 选择数量
+            theta: 相关性与多样性的权衡参数（0-1）
+            epsilon: 边际增益下限，低于此值视为与已选集合线性相关
+            
+        Returns:
+            DPP重排序后的推荐列表
+        """
+        if theta is None:
+            theta = settings.DPP_THETA
+        
+        if not candidates:
+            return []
+        
+        n = len(candidates)
+        limit = min(limit, n)
+        
+        # 分数min-max归一化后转为质量项
+        scores = np.array([c.get("score", 0) or 0 for c in candidates], dtype=np.float64)
+        scores = np.nan_to_num(scores)
+        span = scores.max() - scores.min()
+        normalized = (scores - scores.min()) / span if span > 0 else np.ones(n)
+        alpha = theta / (2 * (1 - theta)) if theta < 1 else 50.0
+        quality = np.exp(alpha * normalized)
+        
+        features = self._encode_features(candidates)
+        
+        def kernel_row(i: int) -> np.ndarray:
+            row = self._similarity_block(features, [i], slice(None))[0]
+            row[i] = 1.0
+            return quality[i] * row * quality
+        
+        # 增量Cholesky：cis[t, i] 为第 i 个候选在第 t 个已选方向上的分量，d2 为边际增益
+        cis = np.zeros((limit, n))
+        d2 = quality ** 2
+        available = np.ones(n, dtype=bool)
+        selected: List[int] = []
+        
+        best = int(np.argmax(d2))
+        while True:
+            selected.append(best)
+            available[best] = False
+            if len(selected) >= limit:
+                break
+            
+            t = len(selected) - 1
+            e = (kernel_row(best) - cis[:t, best] @ cis[:t]) / np.sqrt(d2[best])
+            cis[t] = e
+            d2 = d2 - e ** 2
+            
+            gains = np.where(available, d2, -np.inf)
+            best = int(np.argmax(gains))
+            if gains[best] < epsilon:
+                break
+        
+        # 剩余位置按分数补齐
+        if len(selected) < limit:
+            rest = [i for i in np.argsort(-scores, kind="stable") if available[i]]
+            selected.extend(rest[:limit - len(selected)])
+        
+        return [candidates[i] for i in selected]
+    
     # ==================== 滑动窗口去重 ====================
     
     def apply_sliding_window(
@@ -312,35 +441,17 @@ class DiversityService:
         Returns:
             过滤后的候选列表
         """
-        if not self.db:
-            return candidates
-        
-        from app.models.sql import RecommendationHistory
-        import json
-        
         try:
-            # 获取推荐历史
-            history = self.db.query(RecommendationHistory).filter(
-                RecommendationHistory.user_id == user_id
-            ).first()
+            # 最近推荐窗口（Redis列表 + 频次Hash）
+            recent_book_ids, category_counts, author_counts = HistoryService(self.db).get_window(
+                user_id, window_size
+            )
             
-            if not history:
+            if not recent_book_ids:
                 return candidates
             
-            recent_books = json.loads(history.recommended_books)[-window_size:]
-            recent_book_ids = set(recent_books)
-            
-            # 统计类别和作者频次
-            category_counts = defaultdict(int)
-            author_counts = defaultdict(int)
-            
-            for book_id in recent_books:
-                book = self.db.query(Book).filter(Book.id == book_id).first()
-                if book:
-                    if book.category:
-                        category_counts[book.category.name] += 1
-                    if book.author:
-                        author_counts[book.author] += 1
+            category_counts = defaultdict(int, category_counts)
+            author_counts = defaultdict(int, author_counts)
             
             # 过滤候选
             result = []
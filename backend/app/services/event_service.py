@@ -1,10 +1,15 @@
 """
 事件发布服务
-使用Redis Pub/Sub发布缓存失效事件
+缓存失效事件写入Redis Stream，由Worker以消费者组方式消费（至少一次处理）；
+增量更新事件仍使用Pub/Sub广播
 """
 import json
+import os
+import socket
+import time
+import uuid
 from datetime import datetime
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 from app.core.cache import redis_cache
 from app.core.config import settings
 
@@ -13,6 +18,88 @@ from app.core.config import settings
 CHANNEL_CACHE_INVALIDATION = "cache:invalidation"
 CHANNEL_RECOMMENDATION_UPDATE = "recommendation:update"
 
+# 消费缓存失效事件的消费者组
+CONSUMER_GROUP = "recommendation-workers"
+
+# 优先级（每级一个Stream），从高到低
+PRIORITY_LEVELS = (3, 2, 1)
+
+# 队列中一条消息的引用：(优先级, 消息ID)
+EventRef = Tuple[int, str]
+
+# 写入事件并更新去重索引（索引值为 {"event_id", "priority", "event_types", "book_ids"} 的JSON）：
+# 本事件成为该用户最新的待处理事件，优先级取与尚未处理的更早事件中的最大值，
+# 并写入该优先级的Stream（KEYS[2..4] 依次为优先级1-3），
+# 避免低优先级事件使更早的高优先级事件过期后，其工作排在低优先级积压之后；
+# 被取代事件的类型和书籍ID并入索引，认领时交给最新的事件处理
+PUSH_EVENT_SCRIPT = """
+local priority = tonumber(ARGV[3])
+local event_types = cjson.decode(ARGV[6])
+local book_ids = cjson.decode(ARGV[7])
+local function union(target, values)
+    local present = {}
+    for _, v in ipairs(target) do present[v] = true end
+    for _, v in ipairs(values or {}) do
+        if not present[v] then
+            table.insert(target, v)
+            present[v] = true
+        end
+    end
+end
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+if raw then
+    local ok, prev = pcall(cjson.decode, raw)
+    if ok and type(prev) == 'table' then
+        if tonumber(prev.priority) then
+            priority = math.max(priority, tonumber(prev.priority))
+        end
+        if type(prev.event_types) == 'table' then union(event_types, prev.event_types) end
+        if type(prev.book_ids) == 'table' then union(book_ids, prev.book_ids) end
+    end
+end
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode({
+    event_id = ARGV[2], priority = priority, event_types = event_types, book_ids = book_ids
+}))
+redis.call('XADD', KEYS[1 + priority], 'MAXLEN', '~', ARGV[5], '*', 'data', ARGV[4])
+return priority
+"""
+
+# 认领事件：该用户最新的待处理事件在本批（ARGV[2..n]）中时认领成功并清除索引，
+# 返回索引值（含被取代事件的类型和书籍ID）；
+# 索引已被清除说明是失败后重新投递的事件，同样需要处理
+CLAIM_EVENT_SCRIPT = """
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+if raw == false then
+    return 1
+end
+local latest = raw
+local ok, entry = pcall(cjson.decode, raw)
+if ok and type(entry) == 'table' then
+    latest = entry.event_id
+end
+for i = 2, #ARGV do
+    if latest == ARGV[i] then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+        return raw
+    end
+end
+return 0
+"""
+
+
+def entry_age(entry_id: str) -> float:
+    """Stream消息ID（毫秒时间戳-序号）对应的等待时长（秒）"""
+    try:
+        return max(time.time() - int(entry_id.split("-", 1)[0]) / 1000, 0.0)
+    except (AttributeError, ValueError):
+        return 0.0
+
+
+def consumer_name(suffix: str = "") -> str:
+    """当前进程的消费者名称（主机名-进程号[-后缀]），用于区分崩溃后需要被接管的消费者"""
+    name = f"{socket.gethostname()}-{os.getpid()}"
+    return f"{name}-{suffix}" if suffix else name
+
 
 class EventType:
     """事件类型枚举"""
@@ -47,7 +134,7 @@ class EventService:
             book_id: 书籍ID（可选）
             priority: 优先级 1-3，3最高
             extra_data: 额外数据
-            
+        
         Returns:
             是否发布成功
         """
@@ -65,12 +152,12 @@ class EventService:
             if event_type == EventType.CLICK:
                 # 点击事件需要累计，达到阈值才失效
                 if self._should_invalidate_on_click(user_id, book_id):
-                    return self._publish_event(CHANNEL_CACHE_INVALIDATION, event)
+                    return self.push_to_queue(event)
                 return True  # 累计但不触发失效
             else:
                 # 其他事件立即发布
-                return self._publish_event(CHANNEL_CACHE_INVALIDATION, event)
-                
+                return self.push_to_queue(event)
+        
         except Exception as e:
             print(f"Failed to publish cache invalidation event: {e}")
             return False
@@ -90,7 +177,7 @@ class EventService:
             book_id: 触发更新的书籍ID
             action_type: 行为类型
             affected_books: 受影响的书籍ID列表
-            
+        
         Returns:
             是否发布成功
         """
@@ -132,77 +219,246 @@ class EventService:
             
             # 设置过期时间（1小时）
             if count == 1:
-                self.cache.client.expire(click_key, 3600)
+                self.cache.expire(click_key, 3600)
             
             # 达到阈值则重置计数并返回True
             if count >= settings.CLICK_INVALIDATION_THRESHOLD:
                 self.cache.hdel(click_key, str(book_id) if book_id else "total")
                 return True
-                
-            return False
             
+            return False
+        
         except Exception as e:
             print(f"Click count error: {e}")
             return True  # 出错时保守处理，触发失效
     
     def get_pending_events_count(self, channel: str = CHANNEL_CACHE_INVALIDATION) -> int:
-        """获取待处理事件数量（从任务队列）"""
+        """获取待处理事件数量（各优先级合计）"""
+        return sum(self.get_queue_depths(channel).values())
+    
+    def get_queue_depths(self, channel: str = CHANNEL_CACHE_INVALIDATION) -> Dict[int, int]:
+        """
+        获取各优先级的队列深度（尚未投递 + 已投递未确认）
+        
+        Returns:
+            {优先级: 深度}
+        """
+        return {level: status["depth"] for level, status in self.get_queue_status(channel).items()}
+    
+    def get_queue_status(self, channel: str = CHANNEL_CACHE_INVALIDATION) -> Dict[int, Dict[str, float]]:
+        """
+        获取各优先级的队列深度和最早待处理消息的等待时长（从Redis服务端计算，不依赖Worker是否存活）
+        
+        最早待处理消息取 已投递未确认消息中最小的ID（XPENDING摘要）
+        与 last-delivered-id 之后第一条未投递消息（XRANGE）中更早的一条
+        
+        Returns:
+            {优先级: {"depth": 深度, "oldest_pending_seconds": 等待时长}}
+        """
+        status = {}
+        for level in PRIORITY_LEVELS:
+            status[level] = {"depth": 0, "oldest_pending_seconds": 0.0}
+            stream = self.stream_key(channel, level)
+            try:
+                for group in self.cache.xinfo_groups(stream):
+                    if group.get("name") != CONSUMER_GROUP:
+                        continue
+                    pending, lag = group.get("pending") or 0, group.get("lag")
+                    status[level]["depth"] = pending + (lag or 0)
+                    
+                    oldest_ids = []
+                    if pending:
+                        oldest_ids.append(self.cache.xpending_summary(stream, CONSUMER_GROUP).get("min"))
+                    if lag != 0:  # lag 为None表示无法计算（消息被裁剪过），同样查询
+                        undelivered = self.cache.xrange(stream, min=f"({group.get('last-delivered-id') or '0-0'}", count=1)
+                        oldest_ids.extend(entry_id for entry_id, _ in undelivered)
+                    status[level]["oldest_pending_seconds"] = round(
+                        max((entry_age(entry_id) for entry_id in oldest_ids if entry_id), default=0.0), 3
+                    )
+            except Exception as e:
+                print(f"Get queue status error: {e}")
+        return status
+    
+    # ==================== 事件队列（Redis Stream，每个优先级一个） ====================
+    
+    @staticmethod
+    def priority_level(event: dict) -> int:
+        """事件所属的优先级队列（1-3）"""
         try:
-            queue_key = f"queue:{channel}"
-            return self.cache.llen(queue_key)
-        except Exception as e:
-            print(f"Get pending events count error: {e}")
-            return 0
+            priority = int(event.get("priority") or 1)
+        except (TypeError, ValueError):
+            priority = 1
+        return min(max(priority, min(PRIORITY_LEVELS)), max(PRIORITY_LEVELS))
+    
+    @staticmethod
+    def stream_key(channel: str = CHANNEL_CACHE_INVALIDATION, level: int = 1) -> str:
+        """事件Stream Key"""
+        return f"stream:{channel}:p{level}"
+    
+    @staticmethod
+    def latest_event_key(channel: str = CHANNEL_CACHE_INVALIDATION) -> str:
+        """去重索引Key：用户ID -> 最新待处理事件ID（各优先级共用）"""
+        return f"stream:{channel}:latest"
     
     def push_to_queue(self, event: dict, channel: str = CHANNEL_CACHE_INVALIDATION) -> bool:
         """
-        将事件推送到任务队列（用于异步处理）
+        按优先级将事件写入对应的Stream（XADD，按 EVENT_STREAM_MAXLEN 近似裁剪）
         
-        注意：这是除了Pub/Sub之外的另一种方式，用于确保事件不丢失
+        同一用户只有最新写入的事件会被处理，更早的事件读取时直接确认丢弃；
+        该用户有更高优先级的待处理事件时，本事件提升到该优先级写入，
+        被取代事件的类型和书籍ID（如搜索）由本事件继承（见 PUSH_EVENT_SCRIPT）
         """
         try:
-            queue_key = f"queue:{channel}"
+            event.setdefault("event_id", uuid.uuid4().hex)
             event_str = json.dumps(event, ensure_ascii=False)
             
-            # 按优先级插入（高优先级在前）
-            priority = event.get("priority", 1)
-            if priority >= 3:
-                self.cache.lpush(queue_key, event_str)  # 高优先级插入头部
-            else:
-                self.cache.rpush(queue_key, event_str)  # 普通优先级插入尾部
-            
+            if event.get("user_id"):
+                level = self.cache.run_script(
+                    PUSH_EVENT_SCRIPT,
+                    keys=[self.latest_event_key(channel)] + [
+                        self.stream_key(channel, level) for level in sorted(PRIORITY_LEVELS)
+                    ],
+                    args=[
+                        str(event["user_id"]), event["event_id"], self.priority_level(event),
+                        event_str, settings.EVENT_STREAM_MAXLEN,
+                        json.dumps(self.event_types(event)), json.dumps(self.event_book_ids(event))
+                    ]
+                )
+                if not level:
+                    return False
+            elif not self.cache.execute_pipeline(lambda pipe: pipe.xadd(
+                self.stream_key(channel, self.priority_level(event)), {"data": event_str},
+                maxlen=settings.EVENT_STREAM_MAXLEN, approximate=True
+            )):
+                return False
+            print(f"Queued event: user_id={event.get('user_id')}, type={event.get('event_type')}")
             return True
         except Exception as e:
             print(f"Push to queue error: {e}")
             return False
     
-    def pop_from_queue(self, channel: str = CHANNEL_CACHE_INVALIDATION, timeout: int = 0) -> Optional[dict]:
+    def ensure_consumer_group(self, channel: str = CHANNEL_CACHE_INVALIDATION) -> bool:
+        """为各优先级Stream创建消费者组（幂等）"""
+        return all([
+            self.cache.xgroup_create(self.stream_key(channel, level), CONSUMER_GROUP)
+            for level in PRIORITY_LEVELS
+        ])
+    
+    def read_events(
+        self,
+        consumer: str,
+        count: int = 10,
+        block_ms: Optional[int] = 1000,
+        levels: Tuple[int, ...] = PRIORITY_LEVELS,
+        channel: str = CHANNEL_CACHE_INVALIDATION
+    ) -> List[Tuple[EventRef, dict]]:
         """
-        从任务队列弹出事件
+        以消费者组身份从指定优先级读取新事件（XREADGROUP，每个Stream最多 count 条）
         
-        Args:
-            channel: 频道名称
-            timeout: 超时时间（秒），0表示不阻塞
-            
         Returns:
-            事件字典或None
+            [((优先级, 消息ID), 事件字典), ...]，处理成功后需要 ack_events
         """
-        try:
-            queue_key = f"queue:{channel}"
-            
-            if timeout > 0:
-                result = self.cache.brpop([queue_key], timeout)
-                if result:
-                    return json.loads(result[1])
-            else:
-                result = self.cache.rpop(queue_key)
-                if result:
-                    return json.loads(result)
-            
-            return None
-        except Exception as e:
-            print(f"Pop from queue error: {e}")
-            return None
+        streams = {self.stream_key(channel, level): ">" for level in levels}
+        levels_by_key = {self.stream_key(channel, level): level for level in levels}
+        result = self.cache.xreadgroup(CONSUMER_GROUP, consumer, streams, count=count, block=block_ms)
+        return [
+            entry
+            for key, entries in result
+            for entry in self._parse_entries(levels_by_key[key], entries, channel)
+        ]
+    
+    def claim_stale_events(
+        self,
+        consumer: str,
+        min_idle_ms: int,
+        count: int = 10,
+        channel: str = CHANNEL_CACHE_INVALIDATION
+    ) -> List[Tuple[EventRef, dict]]:
+        """接管其他消费者投递后长时间未确认的事件（XAUTOCLAIM，各优先级）"""
+        claimed = []
+        for level in PRIORITY_LEVELS:
+            entries = self.cache.xautoclaim(
+                self.stream_key(channel, level), CONSUMER_GROUP, consumer, min_idle_ms, count
+            )
+            claimed.extend(self._parse_entries(level, entries, channel))
+        return claimed
+    
+    def ack_events(self, *refs: EventRef, channel: str = CHANNEL_CACHE_INVALIDATION) -> int:
+        """确认事件已处理（XACK，按优先级分组）"""
+        by_level: Dict[int, List[str]] = {}
+        for level, entry_id in refs:
+            by_level.setdefault(level, []).append(entry_id)
+        return sum(
+            self.cache.xack(self.stream_key(channel, level), CONSUMER_GROUP, *entry_ids)
+            for level, entry_ids in by_level.items()
+        )
+    
+    def _parse_entries(self, level: int, entries: list, channel: str) -> List[Tuple[EventRef, dict]]:
+        """解析Stream消息；格式错误的消息直接确认，避免反复投递"""
+        parsed = []
+        for entry_id, fields in entries:
+            try:
+                event = json.loads(fields["data"])
+                # 写入时可能已提升到更高的优先级（见 PUSH_EVENT_SCRIPT）
+                event["priority"] = max(self.priority_level(event), level)
+                parsed.append(((level, entry_id), event))
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Invalid stream entry {entry_id}: {e}")
+                self.ack_events((level, entry_id), channel=channel)
+        return parsed
+    
+    @staticmethod
+    def event_types(event: dict) -> list:
+        """事件包含的全部类型（合并后的事件携带 event_types）"""
+        return list(event.get("event_types") or [event.get("event_type")])
+    
+    @staticmethod
+    def event_book_ids(event: dict) -> list:
+        """事件涉及的全部书籍ID（合并后的事件携带 book_ids）"""
+        return list(event.get("book_ids") or ([event["book_id"]] if event.get("book_id") else []))
+    
+    def claim_event(self, event: dict, channel: str = CHANNEL_CACHE_INVALIDATION) -> bool:
+        """
+        认领读到的事件（合并后的事件携带 event_ids，任一为最新即认领成功）
+        
+        认领成功时，被本事件取代而丢弃的更早事件的类型和书籍ID并入 event_types / book_ids，
+        增量更新据此覆盖全部待处理的变化
+        
+        Returns:
+            True 表示需要处理；
+            False 表示之后已有更新的事件入队，本事件可直接确认丢弃
+        """
+        user_id = event.get("user_id")
+        event_ids = event.get("event_ids") or [event.get("event_id")]
+        event_ids = [e for e in event_ids if e]
+        if not user_id or not event_ids:
+            return True  # 旧格式事件没有去重信息
+        result = self.cache.run_script(
+            CLAIM_EVENT_SCRIPT,
+            keys=[self.latest_event_key(channel)],
+            args=[str(user_id), *event_ids]
+        )
+        if isinstance(result, str):
+            try:
+                entry = json.loads(result)
+            except ValueError:
+                entry = None
+            if isinstance(entry, dict):
+                event_types, book_ids = self.event_types(event), self.event_book_ids(event)
+                # 空列表经cjson编码为 {}
+                event_types += [t for t in entry.get("event_types") or [] if t not in event_types]
+                book_ids += [b for b in entry.get("book_ids") or [] if b not in book_ids]
+                event["event_types"], event["book_ids"] = event_types, book_ids
+        return result != 0  # Redis不可用时保守处理
+    
+    def requeue_event(self, event: dict, channel: str = CHANNEL_CACHE_INVALIDATION) -> bool:
+        """
+        已认领但暂时无法处理的事件重新写入Stream
+        
+        与新事件一样成为该用户最新的待处理事件：此期间入队的更新事件读取时直接丢弃，
+        由本事件的重算覆盖；优先级取两者中的最大值
+        """
+        return self.push_to_queue(event, channel)
 
 
 # 全局事件服务实例
@@ -0,0 +1,188 @@
+"""
+排除集合服务
+使用Redis位图按书籍ID存储用户的已看过集合和黑名单，
+推荐时一次MGET取回两个位图并合并，在Python中做O(1)成员判断
+"""
+from typing import Iterable, Iterator, List, Optional
+from sqlalchemy.orm import Session
+
+from app.core.cache import redis_cache
+from app.models.sql import Interaction, Rating
+
+
+class ExclusionBitmap:
+    """
+    书籍ID位图
+    
+    位序与Redis SETBIT/GETBIT一致：第 n 位位于第 n // 8 个字节，字节内高位在前。
+    支持 in / add / discard / update / | / len，可直接替代原来的 set[int]
+    """
+    
+    def __init__(self, data: bytes = b""):
+        self._data = bytearray(data)
+    
+    @classmethod
+    def from_ids(cls, book_ids: Iterable[int]) -> "ExclusionBitmap":
+        bitmap = cls()
+        bitmap.update(book_ids)
+        return bitmap
+    
+    def __contains__(self, book_id: int) -> bool:
+        if book_id is None or book_id < 0:
+            return False
+        index = book_id >> 3
+        if index >= len(self._data):
+            return False
+        return bool(self._data[index] & (0x80 >> (book_id & 7)))
+    
+    def add(self, book_id: int):
+        """加入一个书籍ID"""
+        if book_id is None or book_id < 0:
+            return
+        index = book_id >> 3
+        if index >= len(self._data):
+            self._data.extend(b"\x00" * (index + 1 - len(self._data)))
+        self._data[index] |= 0x80 >> (book_id & 7)
+    
+    def discard(self, book_id: int):
+        """移除一个书籍ID（不存在时忽略）"""
+        if book_id in self:
+            self._data[book_id >> 3] &= ~(0x80 >> (book_id & 7)) & 0xFF
+    
+    def update(self, book_ids: Iterable[int]):
+        """批量加入书籍ID"""
+        for book_id in book_ids:
+            self.add(book_id)
+    
+    def copy(self) -> "ExclusionBitmap":
+        return ExclusionBitmap(bytes(self._data))
+    
+    def __or__(self, other) -> "ExclusionBitmap":
+        result = self.copy()
+        result |= other
+        return result
+    
+    def __ior__(self, other) -> "ExclusionBitmap":
+        if isinstance(other, ExclusionBitmap):
+            if len(other._data) > len(self._data):
+                self._data.extend(b"\x00" * (len(other._data) - len(self._data)))
+            for i, byte in enumerate(other._data):
+                if byte:
+                    self._data[i] |= byte
+        else:
+            self.update(other)
+        return self
+    
+    def __iter__(self) -> Iterator[int]:
+        for index, byte in enumerate(self._data):
+            if not byte:
+                continue
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    yield (index << 3) + bit
+    
+    def __len__(self) -> int:
+        return sum(bin(byte).count("1") for byte in self._data)
+    
+    def to_bytes(self) -> bytes:
+        return bytes(self._data)
+
+
+class ExclusionService:
+    """排除集合服务（已看过 + 黑名单）"""
+    
+    def __init__(self, db: Optional[Session] = None):
+        self.cache = redis_cache
+        self.db = db
+    
+    def set_db(self, db: Session):
+        """设置数据库会话"""
+        self.db = db
+    
+    # ==================== 位图更新 ====================
+    
+    def mark_seen(self, user_id: int, *book_ids: int) -> bool:
+        """
+        标记书籍为已看过（交互、评分时调用）
+        位图尚未构建时跳过，读取时会从MySQL完整回填
+        """
+        key = self.cache.seen_bitmap_key(user_id)
+        if not book_ids or not self.cache.exists(key):
+            return False
+        return self.cache.setbit_many(key, list(book_ids), 1)
+    
+    def set_blacklisted(self, user_id: int, book_ids: List[int], blacklisted: bool = True) -> bool:
+        """
+        更新黑名单位图（加入/移出黑名单时调用）
+        位图尚未构建时跳过，读取时会从黑名单Set回填
+        """
+        key = self.cache.blacklist_bitmap_key(user_id)
+        if not book_ids or not self.cache.exists(key):
+            return False
+        return self.cache.setbit_many(key, list(book_ids), 1 if blacklisted else 0)
+    
+    def invalidate(self, user_id: int):
+        """删除用户位图，下次读取时重建"""
+        self.cache.delete(self.cache.seen_bitmap_key(user_id))
+        self.cache.delete(self.cache.blacklist_bitmap_key(user_id))
+    
+    # ==================== 位图读取 ====================
+    
+    def get_exclusions(self, user_id: int) -> ExclusionBitmap:
+        """
+        获取用户的排除位图（已看过 ∪ 黑名单）
+        
+        一次MGET读取两个位图；缺失的位图按需回填
+        """
+        seen_key = self.cache.seen_bitmap_key(user_id)
+        blacklist_key = self.cache.blacklist_bitmap_key(user_id)
+        seen_data, blacklist_data = self.cache.mget_bytes(seen_key, blacklist_key)
+        
+        seen = ExclusionBitmap(seen_data) if seen_data is not None else self._backfill_seen(user_id)
+        if blacklist_data is not None:
+            seen |= ExclusionBitmap(blacklist_data)
+        else:
+            seen |= self._backfill_blacklist(user_id)
+        return seen
+    
+    def _backfill_seen(self, user_id: int) -> ExclusionBitmap:
+        """从MySQL的交互和评分记录构建已看过位图"""
+        bitmap = ExclusionBitmap()
+        if not self.db:
+            return bitmap
+        
+        try:
+            interacted = self.db.query(Interaction.book_id).filter(
+                Interaction.user_id == user_id
+            ).distinct().all()
+            rated = self.db.query(Rating.book_id).filter(
+                Rating.user_id == user_id
+            ).distinct().all()
+            bitmap.update(row.book_id for row in interacted)
+            bitmap.update(row.book_id for row in rated)
+        except Exception as e:
+            print(f"Backfill seen bitmap error: {e}")
+            return bitmap
+        
+        self._store(self.cache.seen_bitmap_key(user_id), bitmap)
+        return bitmap
+    
+    def _backfill_blacklist(self, user_id: int) -> ExclusionBitmap:
+        """从Redis黑名单Set构建黑名单位图"""
+        members = self.cache.smembers(self.cache.blacklist_key(user_id))
+        bitmap = ExclusionBitmap.from_ids(int(id) for id in members if id.isdigit())
+        self._store(self.cache.blacklist_bitmap_key(user_id), bitmap)
+        return bitmap
+    
+    def _store(self, key: str, bitmap: ExclusionBitmap):
+        """写入位图；字节布局与SETBIT一致，空位图写入一个0字节以标记已构建"""
+        self.cache.set_bytes(key, bitmap.to_bytes() or b"\x00")
+
+
+# 全局排除集合服务实例
+exclusion_service = ExclusionService()
+
+
+def get_exclusion_service() -> ExclusionService:
+    """获取排除集合服务实例"""
+    return exclusion_service
@@ -0,0 +1,365 @@
+"""
+曝光计数服务
+曝光/点击先在Redis Hash中用HINCRBY累加，后台线程定期批量写入 exposure_logs
+（多行 INSERT ... ON DUPLICATE KEY UPDATE）
+"""
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import case
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import Session
+
+from app.core.cache import redis_cache
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.models.sql import ExposureLog
+
+
+# 有待落库增量的用户集合
+EXPOSURE_DIRTY_KEY = "exposure:dirty"
+# 计数Hash中标记"已从MySQL加载"的占位字段
+SEEDED_FIELD = "_seeded"
+# 单条 INSERT 语句的最大行数
+UPSERT_CHUNK_SIZE = 1000
+
+# 仅当计数Hash未加载时把MySQL已落库的计数累加上去（原子执行）；
+# 加载前并发的HINCRBY已写入的增量保留，不会被覆盖或丢弃
+SEED_IF_ABSENT = """
+if redis.call('HSETNX', KEYS[1], ARGV[1], 1) == 0 then
+    return 0
+end
+for i = 3, #ARGV, 3 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    if tonumber(ARGV[i + 2]) > 0 then
+        redis.call('HINCRBY', KEYS[2], ARGV[i], ARGV[i + 2])
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return 1
+"""
+
+
+class ExposureService:
+    """
+    曝光计数服务
+    
+    Redis结构：
+    - exposure:user:{id}          书籍ID -> 累计曝光次数（含已落库部分）
+    - exposure:clicks:user:{id}   书籍ID -> 累计点击次数
+    - exposure:pending:user:{id}  e:{书籍ID}/c:{书籍ID} -> 尚未落库的增量
+    - exposure:dirty              有待落库增量的用户ID
+    """
+    
+    def __init__(self, db: Optional[Session] = None):
+        self.cache = redis_cache
+        self.db = db
+    
+    def set_db(self, db: Session):
+        """设置数据库会话"""
+        self.db = db
+    
+    # ==================== 计数 ====================
+    
+    def record_exposures(self, user_id: int, book_ids: List[int]) -> Dict[int, Tuple[int, int]]:
+        """
+        批量记录曝光（一次Pipeline往返）
+        
+        Returns:
+            {书籍ID: (累计曝光次数, 累计点击次数)}；Redis不可用时直接写MySQL并返回空字典
+        """
+        book_ids = list(dict.fromkeys(book_ids))  # 同一页重复出现只计一次
+        if not book_ids:
+            return {}
+        
+        self._ensure_seeded(user_id)
+        totals_key = self.cache.exposure_count_key(user_id)
+        clicks_key = self.cache.exposure_click_key(user_id)
+        pending_key = self.cache.exposure_pending_key(user_id)
+        
+        def build(pipe):
+            for book_id in book_ids:
+                pipe.hincrby(totals_key, str(book_id), 1)
+            for book_id in book_ids:
+                pipe.hincrby(pending_key, f"e:{book_id}", 1)
+            pipe.hmget(clicks_key, [str(b) for b in book_ids])
+            pipe.sadd(EXPOSURE_DIRTY_KEY, str(user_id))
+            pipe.expire(totals_key, settings.CACHE_L3_TTL)
+            pipe.expire(clicks_key, settings.CACHE_L3_TTL)
+        
+        results = self.cache.execute_pipeline(build)
+        if not results:
+            self._write_through(user_id, {book_id: (1, 0) for book_id in book_ids})
+            return {}
+        
+        totals = results[:len(book_ids)]
+        clicks = results[2 * len(book_ids)]
+        return {
+            book_id: (int(total), int(click or 0))
+            for book_id, total, click in zip(book_ids, totals, clicks)
+        }
+    
+    def record_click(self, user_id: int, book_id: int) -> bool:
+        """记录曝光后的点击"""
+        self._ensure_seeded(user_id)
+        clicks_key = self.cache.exposure_click_key(user_id)
+        
+        def build(pipe):
+            pipe.hincrby(clicks_key, str(book_id), 1)
+            pipe.hincrby(self.cache.exposure_pending_key(user_id), f"c:{book_id}", 1)
+            pipe.sadd(EXPOSURE_DIRTY_KEY, str(user_id))
+            pipe.expire(clicks_key, settings.CACHE_L3_TTL)
+        
+        if self.cache.execute_pipeline(build):
+            return True
+        self._write_through(user_id, {book_id: (0, 1)})
+        return False
+    
+    def get_counts(self, user_id: int, book_ids: List[int]) -> Dict[int, Tuple[int, int]]:
+        """
+        只查询指定书籍的曝光/点击计数
+        
+        计数Hash已加载时用HMGET读取；否则用 (user_id, book_id) 索引做 IN 查询
+        
+        Returns:
+            {书籍ID: (累计曝光次数, 累计点击次数)}，没有记录的书籍不返回
+        """
+        book_ids = list(dict.fromkeys(b for b in book_ids if b is not None))
+        if not book_ids:
+            return {}
+        
+        fields = [str(b) for b in book_ids]
+        
+        def build(pipe):
+            pipe.hmget(self.cache.exposure_count_key(user_id), [SEEDED_FIELD] + fields)
+            pipe.hmget(self.cache.exposure_click_key(user_id), fields)
+        
+        results = self.cache.execute_pipeline(build)
+        if results and results[0][0] is not None:
+            totals, clicks = results[0][1:], results[1]
+            return {
+                book_id: (int(total or 0), int(click or 0))
+                for book_id, total, click in zip(book_ids, totals, clicks)
+                if total is not None or click is not None
+            }
+        
+        if not self.db:
+            return {}
+        try:
+            rows = self.db.query(
+                ExposureLog.book_id, ExposureLog.exposure_count, ExposureLog.click_count
+            ).filter(
+                ExposureLog.user_id == user_id,
+                ExposureLog.book_id.in_(book_ids)
+            ).all()
+            return {row.book_id: (row.exposure_count or 0, row.click_count or 0) for row in rows}
+        except Exception as e:
+            print(f"Get exposure counts error: {e}")
+            return {}
+    
+    def _ensure_seeded(self, user_id: int):
+        """计数Hash未加载时从MySQL加载已落库的计数（Lua脚本原子累加，与并发的HINCRBY叠加）"""
+        totals_key = self.cache.exposure_count_key(user_id)
+        if not self.db or self.cache.hget(totals_key, SEEDED_FIELD) is not None:
+            return
+        
+        try:
+            rows = self.db.query(
+                ExposureLog.book_id, ExposureLog.exposure_count, ExposureLog.click_count
+            ).filter(ExposureLog.user_id == user_id).all()
+        except Exception as e:
+            print(f"Load exposure counts error: {e}")
+            return
+        
+        args = [SEEDED_FIELD, settings.CACHE_L3_TTL]
+        for row in rows:
+            args.extend([str(row.book_id), row.exposure_count or 0, row.click_count or 0])
+        self.cache.run_script(
+            SEED_IF_ABSENT,
+            keys=[totals_key, self.cache.exposure_click_key(user_id)],
+            args=args
+        )
+    
+    # ==================== 落库 ====================
+    
+    def flush(self, db: Session, max_users: int = None) -> int:
+        """
+        将待落库的增量批量写入MySQL
+        
+        每个用户的增量以 MULTI(HGETALL + DEL) 原子取走；写库失败时放回Redis
+        
+        Returns:
+            写入的行数
+        """
+        return self._flush_batch(db, max_users)[1]
+    
+    def _flush_batch(self, db: Session, max_users: int = None) -> Tuple[int, int]:
+        """
+        落库一批待处理用户
+        
+        Returns:
+            (取走的用户数, 写入的行数)；失败时用户放回Redis，取走数记为0
+        """
+        max_users = max_users or settings.EXPOSURE_FLUSH_BATCH
+        popped = self.cache.execute_pipeline(lambda pipe: pipe.spop(EXPOSURE_DIRTY_KEY, max_users))
+        members = (popped[0] if popped else None) or []
+        user_ids = [int(u) for u in members if u.isdigit()]
+        if not user_ids:
+            return 0, 0
+        
+        def build(pipe):
+            for user_id in user_ids:
+                key = self.cache.exposure_pending_key(user_id)
+                pipe.hgetall(key)
+                pipe.delete(key)
+        
+        results = self.cache.execute_pipeline(build, transaction=True)
+        if not results:
+            # 取增量失败，用户重新标记为待落库
+            self.cache.sadd(EXPOSURE_DIRTY_KEY, *[str(u) for u in user_ids])
+            return 0, 0
+        
+        deltas: Dict[int, Dict[int, List[int]]] = {}
+        for user_id, pending in zip(user_ids, results[::2]):
+            if pending:
+                deltas[user_id] = self._parse_pending(pending)
+        
+        rows = self._build_rows(deltas)
+        if not rows:
+            # 这批用户的增量已被其他进程取走或为空，继续处理下一批
+            return len(user_ids), 0
+        
+        try:
+            self._upsert(db, rows)
+            return len(user_ids), len(rows)
+        except Exception as e:
+            print(f"Exposure flush error: {e}")
+            db.rollback()
+            self._restore_pending(deltas)
+            return 0, 0
+    
+    @staticmethod
+    def _parse_pending(pending: Dict[str, str]) -> Dict[int, List[int]]:
+        """解析增量Hash：{书籍ID: [曝光增量, 点击增量]}"""
+        parsed: Dict[int, List[int]] = defaultdict(lambda: [0, 0])
+        for field, value in pending.items():
+            kind, _, book_id = field.partition(":")
+            if not book_id.isdigit():
+                continue
+            parsed[int(book_id)][0 if kind == "e" else 1] += int(value)
+        return dict(parsed)
+    
+    @staticmethod
+    def _build_rows(deltas: Dict[int, Dict[int, List[int]]]) -> List[Dict]:
+        now = datetime.now()
+        return [
+            {
+                "user_id": user_id,
+                "book_id": book_id,
+                "exposure_count": exposures,
+                "click_count": clicks,
+                "last_exposure_at": now
+            }
+            for user_id, books in deltas.items()
+            for book_id, (exposures, clicks) in books.items()
+        ]
+    
+    @staticmethod
+    def _upsert(db: Session, rows: List[Dict]):
+        """多行 INSERT ... ON DUPLICATE KEY UPDATE，计数按增量累加"""
+        for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+            stmt = mysql_insert(ExposureLog).values(rows[start:start + UPSERT_CHUNK_SIZE])
+            stmt = stmt.on_duplicate_key_update(
+                exposure_count=ExposureLog.exposure_count + stmt.inserted.exposure_count,
+                click_count=ExposureLog.click_count + stmt.inserted.click_count,
+                # 只有点击增量时不更新最近曝光时间
+                last_exposure_at=case(
+                    (stmt.inserted.exposure_count > 0, stmt.inserted.last_exposure_at),
+                    else_=ExposureLog.last_exposure_at
+                )
+            )
+            db.execute(stmt)
+        db.commit()
+    
+    def _restore_pending(self, deltas: Dict[int, Dict[int, List[int]]]):
+        """写库失败时把增量加回Redis，等待下一轮"""
+        def build(pipe):
+            for user_id, books in deltas.items():
+                key = self.cache.exposure_pending_key(user_id)
+                for book_id, (exposures, clicks) in books.items():
+                    if exposures:
+                        pipe.hincrby(key, f"e:{book_id}", exposures)
+                    if clicks:
+                        pipe.hincrby(key, f"c:{book_id}", clicks)
+                pipe.sadd(EXPOSURE_DIRTY_KEY, str(user_id))
+        
+        if not self.cache.execute_pipeline(build):
+            print(f"Failed to restore exposure deltas for {len(deltas)} users")
+    
+    def _write_through(self, user_id: int, books: Dict[int, Tuple[int, int]]):
+        """Redis不可用时直接写MySQL"""
+        if not self.db:
+            return
+        try:
+            self._upsert(self.db, self._build_rows({user_id: {b: list(d) for b, d in books.items()}}))
+        except Exception as e:
+            print(f"Exposure write-through error: {e}")
+            self.db.rollback()
+
+
+class ExposureFlusher:
+    """曝光计数后台落库线程"""
+    
+    def __init__(self):
+        self.service = ExposureService()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def start(self, interval: float = None):
+        """启动落库线程"""
+        if self._thread and self._thread.is_alive():
+            print("Exposure Flusher is already running")
+            return
+        
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(interval or settings.EXPOSURE_FLUSH_INTERVAL,),
+            daemon=True
+        )
+        self._thread.start()
+        print("Exposure Flusher started")
+    
+    def stop(self):
+        """停止落库线程（退出前再落库一次）"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        print("Exposure Flusher stopped")
+    
+    def _run(self, interval: float):
+        while not self._stop.wait(interval):
+            self.flush_all()
+        self.flush_all()
+    
+    def flush_all(self) -> int:
+        """反复落库直到待处理集合为空（或某一轮没有取走用户，如写库失败）"""
+        db = SessionLocal()
+        total = 0
+        try:
+            while True:
+                processed, written = self.service._flush_batch(db)
+                total += written
+                if not processed:
+                    break
+        except Exception as e:
+            print(f"Exposure Flusher error: {e}")
+        finally:
+            db.close()
+        return total
+
+
+# 全局曝光落库线程
+exposure_flusher = ExposureFlusher()
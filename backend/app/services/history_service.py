@@ -0,0 +1,307 @@
+"""
+推荐历史服务（滑动窗口）
+最近推荐的书籍保存在Redis定长列表中（LPUSH + LTRIM），
+类别/作者频次用Hash计数并随书籍进出窗口增量更新；MySQL只做定期持久化
+"""
+import json
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+from sqlalchemy.orm import Session
+
+from app.core.cache import redis_cache
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.models.sql import Book, RecommendationHistory
+
+
+# 有待持久化历史的用户集合
+HISTORY_DIRTY_KEY = "rec:history:dirty"
+
+
+class HistoryService:
+    """
+    推荐历史服务
+    
+    Redis结构：
+    - rec:history:user:{id}         列表，元素为 [书籍ID, 类别, 作者] 的JSON，最新的在表头
+    - rec:history:category:user:{id} 类别 -> 窗口内出现次数
+    - rec:history:author:user:{id}   作者 -> 窗口内出现次数
+    """
+    
+    def __init__(self, db: Optional[Session] = None):
+        self.cache = redis_cache
+        self.db = db
+        self.window_size = settings.RECOMMENDATION_HISTORY_WINDOW
+    
+    def set_db(self, db: Session):
+        """设置数据库会话"""
+        self.db = db
+    
+    # ==================== 写入 ====================
+    
+    def append(self, user_id: int, recommendations: List[Dict[str, Any]]) -> bool:
+        """
+        追加一批推荐到历史窗口
+        
+        一个事务内完成 LPUSH、频次+1、取出被挤出窗口的元素、LTRIM；
+        再用一次Pipeline为被挤出的元素做频次-1
+        """
+        entries = [self._entry(r) for r in recommendations]
+        if not entries:
+            return False
+        
+        self._ensure_loaded(user_id)
+        history_key = self.cache.history_key(user_id)
+        category_key = self.cache.history_category_key(user_id)
+        author_key = self.cache.history_author_key(user_id)
+        
+        def build(pipe):
+            pipe.lpush(history_key, *[json.dumps(e, ensure_ascii=False) for e in entries])
+            for _, category, author in entries:
+                if category:
+                    pipe.hincrby(category_key, category, 1)
+                if author:
+                    pipe.hincrby(author_key, author, 1)
+            pipe.lrange(history_key, self.window_size, -1)
+            pipe.ltrim(history_key, 0, self.window_size - 1)
+            pipe.sadd(HISTORY_DIRTY_KEY, str(user_id))
+        
+        results = self.cache.execute_pipeline(build, transaction=True)
+        if not results:
+            return False
+        
+        evicted = [self._parse(raw) for raw in results[-3]]
+        self._decrement(category_key, author_key, evicted)
+        return True
+    
+    def _decrement(self, category_key: str, author_key: str, evicted: List[Tuple]):
+        """被挤出窗口的元素频次-1，减到0的字段删除"""
+        fields = [(category_key, e[1]) for e in evicted if e and e[1]]
+        fields += [(author_key, e[2]) for e in evicted if e and e[2]]
+        if not fields:
+            return
+        
+        def decrement(pipe):
+            for key, field in fields:
+                pipe.hincrby(key, field, -1)
+        
+        results = self.cache.execute_pipeline(decrement)
+        drained = [(key, field) for (key, field), count in zip(fields, results) if count <= 0]
+        
+        def cleanup(pipe):
+            for key, field in drained:
+                pipe.hdel(key, field)
+        
+        if drained:
+            self.cache.execute_pipeline(cleanup)
+    
+    @staticmethod
+    def _entry(rec: Dict[str, Any]) -> Tuple[int, Optional[str], Optional[str]]:
+        book = rec["book"]
+        category = rec.get("category_name") or (book.category.name if book.category else None)
+        author = rec.get("author") or book.author
+        return (book.id, category, author)
+    
+    @staticmethod
+    def _parse(raw: str) -> Optional[Tuple]:
+        try:
+            book_id, category, author = json.loads(raw)
+            return (int(book_id), category, author)
+        except (ValueError, TypeError):
+            return None
+    
+    @staticmethod
+    def _count(entries: List[Tuple]) -> Tuple[Dict[str, int], Dict[str, int]]:
+        """统计类别和作者频次"""
+        category_counts: Dict[str, int] = {}
+        author_counts: Dict[str, int] = {}
+        for _, category, author in entries:
+            if category:
+                category_counts[category] = category_counts.get(category, 0) + 1
+            if author:
+                author_counts[author] = author_counts.get(author, 0) + 1
+        return category_counts, author_counts
+    
+    # ==================== 读取 ====================
+    
+    def get_window(self, user_id: int, window_size: int = None) -> Tuple[Set[int], Dict[str, int], Dict[str, int]]:
+        """
+        获取最近的推荐窗口
+        
+        Returns:
+            (书籍ID集合, 类别频次, 作者频次)
+        """
+        window_size = window_size or self.window_size
+        self._ensure_loaded(user_id)
+        
+        def build(pipe):
+            pipe.lrange(self.cache.history_key(user_id), 0, window_size - 1)
+            pipe.hgetall(self.cache.history_category_key(user_id))
+            pipe.hgetall(self.cache.history_author_key(user_id))
+        
+        results = self.cache.execute_pipeline(build)
+        if not results:
+            return set(), {}, {}
+        
+        entries = [e for e in (self._parse(raw) for raw in results[0]) if e]
+        book_ids = {e[0] for e in entries}
+        if window_size == self.window_size:
+            return (
+                book_ids,
+                {k: int(v) for k, v in results[1].items()},
+                {k: int(v) for k, v in results[2].items()}
+            )
+        
+        # 非默认窗口大小时按列表内容现算
+        return (book_ids, *self._count(entries))
+    
+    def _ensure_loaded(self, user_id: int):
+        """Redis中没有历史时从MySQL加载（一次IN查询取书籍类别和作者）"""
+        history_key = self.cache.history_key(user_id)
+        if not self.db or self.cache.exists(history_key):
+            return
+        
+        try:
+            history = self.db.query(RecommendationHistory).filter(
+                RecommendationHistory.user_id == user_id
+            ).first()
+            if not history:
+                return
+            
+            book_ids = json.loads(history.recommended_books)[-self.window_size:]
+            books = {
+                b.id: b for b in self.db.query(Book).filter(Book.id.in_(book_ids)).all()
+            } if book_ids else {}
+        except Exception as e:
+            print(f"Load recommendation history error: {e}")
+            return
+        
+        # MySQL中按时间正序，Redis列表表头为最新
+        entries = []
+        for book_id in reversed(book_ids):
+            book = books.get(book_id)
+            category = book.category.name if book and book.category else None
+            entries.append((book_id, category, book.author if book else None))
+        
+        category_counts, author_counts = self._count(entries)
+        
+        def build(pipe):
+            pipe.delete(history_key, self.cache.history_category_key(user_id), self.cache.history_author_key(user_id))
+            if entries:
+                pipe.rpush(history_key, *[json.dumps(e, ensure_ascii=False) for e in entries])
+            if category_counts:
+                pipe.hset(self.cache.history_category_key(user_id), mapping=category_counts)
+            if author_counts:
+                pipe.hset(self.cache.history_author_key(user_id), mapping=author_counts)
+        
+        self.cache.execute_pipeline(build, transaction=True)
+    
+    # ==================== 持久化 ====================
+    
+    def persist(self, db: Session, max_users: int = 500) -> int:
+        """
+        把有变化的用户历史写回MySQL（每批一次IN查询 + 一次提交）
+        
+        Returns:
+            写入的用户数
+        """
+        popped = self.cache.execute_pipeline(lambda pipe: pipe.spop(HISTORY_DIRTY_KEY, max_users))
+        members = (popped[0] if popped else None) or []
+        user_ids = [int(u) for u in members if u.isdigit()]
+        if not user_ids:
+            return 0
+        
+        def build(pipe):
+            for user_id in user_ids:
+                pipe.lrange(self.cache.history_key(user_id), 0, -1)
+        
+        lists = self.cache.execute_pipeline(build)
+        if not lists:
+            self.cache.sadd(HISTORY_DIRTY_KEY, *[str(u) for u in user_ids])
+            return 0
+        
+        try:
+            existing = {
+                h.user_id: h for h in db.query(RecommendationHistory).filter(
+                    RecommendationHistory.user_id.in_(user_ids)
+                ).all()
+            }
+            now = datetime.now()
+            for user_id, raw_entries in zip(user_ids, lists):
+                # Redis表头为最新，MySQL按时间正序
+                book_ids = [e[0] for e in (self._parse(raw) for raw in reversed(raw_entries)) if e]
+                history = existing.get(user_id)
+                if history:
+                    history.recommended_books = json.dumps(book_ids)
+                    history.window_size = self.window_size
+                    history.updated_at = now
+                else:
+                    db.add(RecommendationHistory(
+                        user_id=user_id,
+                        recommended_books=json.dumps(book_ids),
+                        window_size=self.window_size
+                    ))
+            db.commit()
+            return len(user_ids)
+        except Exception as e:
+            print(f"Persist recommendation history error: {e}")
+            db.rollback()
+            self.cache.sadd(HISTORY_DIRTY_KEY, *[str(u) for u in user_ids])
+            return 0
+
+
+class HistoryPersister:
+    """推荐历史定期持久化线程"""
+    
+    def __init__(self):
+        self.service = HistoryService()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def start(self, interval: float = None):
+        """启动持久化线程"""
+        if self._thread and self._thread.is_alive():
+            print("History Persister is already running")
+            return
+        
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(interval or settings.RECOMMENDATION_HISTORY_PERSIST_INTERVAL,),
+            daemon=True
+        )
+        self._thread.start()
+        print("History Persister started")
+    
+    def stop(self):
+        """停止持久化线程（退出前再持久化一次）"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        print("History Persister stopped")
+    
+    def _run(self, interval: float):
+        while not self._stop.wait(interval):
+            self.persist_all()
+        self.persist_all()
+    
+    def persist_all(self) -> int:
+        """反复持久化直到没有待处理用户"""
+        db = SessionLocal()
+        total = 0
+        try:
+            while True:
+                written = self.service.persist(db)
+                if not written:
+                    break
+                total += written
+        except Exception as e:
+            print(f"History Persister error: {e}")
+        finally:
+            db.close()
+        return total
+
+
+# 全局推荐历史持久化线程
+history_persister = HistoryPersister()
@@ -2,11 +2,20 @@
 增量更新服务
 分析行为影响范围，仅重新计算受影响的推荐
 """
-from typing import List, Dict, Any, Set
+from typing import List, Dict, Any, Optional, Set, Tuple
 from sqlalchemy.orm import Session
 from neo4j import Session as Neo4jSession
 
 from app.core.config import settings
+from app.models.sql import Book, User
+from app.services.blacklist_service import BlacklistService
+from app.services.neighborhood_service import neighborhood_service
+from app.services.profile_service import category_names
+from app.services.similarity_service import similarity_service
+
+
+# 点击行为影响的同类别书籍数量
+LOCAL_IMPACT_LIMIT = 10
 
 
 class IncrementalUpdateService:
@@ -47,7 +56,7 @@ class IncrementalUpdateService:
                 "priority": 1-3                              # 更新优先级
             }
         """
-        if not self.neo4j:
+        if not self.db:
             return self._default_impact(book_id, action_type)
         
         try:
@@ -69,101 +78,53 @@ class IncrementalUpdateService:
         book_id: int, 
         action_type: str
     ) -> Dict[str, Any]:
-        """分析扩展影响（高价值行为）"""
-        
-        # 查询1-2跳范围内的相关书籍
-        cypher_query = """
-        MATCH (b:Book {id: $book_id})
-        
-        // 获取书籍的类别和作者
-        OPTIONAL MATCH (b)-[:BELONGS_TO]->(cat:Category)
-        OPTIONAL MATCH (b)-[:WRITTEN_BY]->(author:Author)
-        
-        // 找到同类别的书籍
-        OPTIONAL MATCH (cat)<-[:BELONGS_TO]-(same_cat_book:Book)
-        WHERE same_cat_book.id <> b.id
-        
-        // 找到同作者的书籍
-        OPTIONAL MATCH (author)<-[:WRITTEN_BY]-(same_author_book:Book)
-        WHERE same_author_book.id <> b.id
-        
-        // 找到协同过滤相关的书籍
-        OPTIONAL MATCH (b)<-[:CLICKED|RATED|COLLECTED]-(peer:User)-[:CLICKED|RATED|COLLECTED]->(collab_book:Book)
-        WHERE collab_book.id <> b.id
-        
-        RETURN 
-            collect(DISTINCT same_cat_book.id) AS same_category_books,
-            collect(DISTINCT same_author_book.id) AS same_author_books,
-            collect(DISTINCT collab_book.id) AS collab_books,
-            cat.name AS category_name,
-            author.name AS author_name
-        """
-        
-        result = self.neo4j.run(cypher_query, book_id=book_id).single()
-        
-        if not result:
+        """分析扩展影响（高价值行为）：同类别、同作者、共同读者邻居（查预计算的邻域表）"""
+        labels = self._get_book_labels(book_id)
+        if labels is None:
             return self._default_impact(book_id, action_type)
         
-        # 合并受影响的书籍
-        affected_books = set()
-        affected_books.add(book_id)
+        neighbors = neighborhood_service.get_neighbors(self.db, book_id)
         
-        # 同类别书籍（限制数量）
-        same_cat = result["same_category_books"] or []
-        affected_books.update(same_cat[:20])
-        
-        # 同作者书籍
-        same_author = result["same_author_books"] or []
-        affected_books.update(same_author[:10])
-        
-        # 协同过滤书籍
-        collab = result["collab_books"] or []
-        affected_books.update(collab[:10])
+        # 合并受影响的书籍（邻域表中各类邻居已按相关度排序并截断）
+        affected_books = [book_id]
+        for kind in ("category", "author", "coread"):
+            affected_books.extend(b for b in neighbors[kind] if b not in affected_books)
         
+        category_name, author_name = labels
         return {
-            "affected_books": list(affected_books),
-            "affected_categories": [result["category_name"]] if result["category_name"] else [],
-            "affected_authors": [result["author_name"]] if result["author_name"] else [],
+            "affected_books": affected_books,
+            "affected_categories": [category_name] if category_name else [],
+            "affected_authors": [author_name] if author_name else [],
             "update_scope": "partial",
             "priority": 3 if action_type == "rating" else 2
         }
     
     def _analyze_local_impact(self, user_id: int, book_id: int) -> Dict[str, Any]:
-        """分析局部影响（点击行为）"""
-        
-        # 只查询直接相关的书籍
-        cypher_query = """
-        MATCH (b:Book {id: $book_id})
-        
-        // 获取书籍的类别
-        OPTIONAL MATCH (b)-[:BELONGS_TO]->(cat:Category)
-        
-        // 找到同类别的高评分书籍（限制数量）
-        OPTIONAL MATCH (cat)<-[:BELONGS_TO]-(related:Book)
-        WHERE related.id <> b.id
-        
-        RETURN 
-            collect(DISTINCT related.id)[0..10] AS related_books,
-            cat.name AS category_name
-        """
-        
-        result = self.neo4j.run(cypher_query, book_id=book_id).single()
-        
-        if not result:
+        """分析局部影响（点击行为）：只取同类别最相关的书籍"""
+        labels = self._get_book_labels(book_id)
+        if labels is None:
             return self._default_impact(book_id, "click")
         
+        neighbors = neighborhood_service.get_neighbors(self.db, book_id)
         affected_books = [book_id]
-        related = result["related_books"] or []
-        affected_books.extend(related)
+        affected_books.extend(neighbors["category"][:LOCAL_IMPACT_LIMIT])
         
+        category_name, _ = labels
         return {
             "affected_books": affected_books,
-            "affected_categories": [result["category_name"]] if result["category_name"] else [],
+            "affected_categories": [category_name] if category_name else [],
             "affected_authors": [],
             "update_scope": "partial",
             "priority": 1
         }
     
+    def _get_book_labels(self, book_id: int) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """书籍的类别名称和作者，书籍不存在时返回None"""
+        book = self.db.query(Book.category_id, Book.author).filter(Book.id == book_id).first()
+        if not book:
+            return None
+        return category_names.get(self.db, book.category_id), book.author
+    
     def _default_impact(self, book_id: int, action_type: str) -> Dict[str, Any]:
         """默认影响（无法分析时的回退）"""
         return {
@@ -174,6 +135,87 @@ class IncrementalUpdateService:
             "priority": 2 if action_type in ["rating", "collect"] else 1
         }
     
+    def score_books(self, user_id: int, book_ids: List[int]) -> Dict[int, float]:
+        """
+        只为指定书籍重新计算图谱分数
+        
+        评分口径与推荐服务的图谱召回一致（平均评分 + 协同过滤/人口统计/偏好类别路径加分），
+        并同样应用不喜欢类别/作者和相似度惩罚的降权
+        
+        Returns:
+            {book_id: score}，用户已标记不喜欢的书籍不返回
+        """
+        if not self.neo4j or not book_ids:
+            return {}
+        
+        pref_cats = []
+        if self.db:
+            user = self.db.query(User).filter(User.id == user_id).first()
+            if user and user.preferred_categories:
+                pref_cats = [c.strip() for c in user.preferred_categories.split(",") if c.strip()]
+        
+        cypher_query = """
+        MATCH (u:User {id: $user_id})
+        UNWIND $book_ids AS book_id
+        MATCH (b:Book {id: book_id})
+        WHERE NOT (u)-[:DISLIKES]->(b)
+        
+        // 协同过滤强度
+        OPTIONAL MATCH (u)-[:CLICKED|RATED|COLLECTED]->(:Book)<-[:CLICKED|RATED|COLLECTED]-(peer:User)-[:CLICKED|RATED|COLLECTED]->(b)
+        WHERE peer.id <> u.id
+        WITH u, b, count(DISTINCT peer) AS peer_strength
+        
+        // 人口统计强度
+        OPTIONAL MATCH (peer_demog:User)-[:CLICKED|RATED|COLLECTED]->(b)
+        WHERE peer_demog.id <> u.id
+          AND peer_demog.gender = u.gender
+          AND abs(peer_demog.age - u.age) <= 5
+        WITH b, peer_strength, count(DISTINCT peer_demog) AS demog_strength
+        
+        OPTIONAL MATCH (b)<-[r:RATED]-()
+        WITH b, peer_strength, demog_strength, avg(r.score) AS avg_rating
+        OPTIONAL MATCH (b)-[:BELONGS_TO]->(cat:Category)
+        OPTIONAL MATCH (b)-[:WRITTEN_BY]->(author:Author)
+        
+        RETURN b.id AS book_id,
+               1.0 +
+               (CASE WHEN avg_rating IS NOT NULL THEN avg_rating * 0.5 ELSE 0 END) +
+               (CASE
+                  WHEN peer_strength > 0 THEN 3 + (peer_strength * 0.5)
+                  WHEN demog_strength > 0 THEN 2.5 + (demog_strength * 0.3)
+                  WHEN cat.name IN $pref_cats THEN 3.5
+                  ELSE 0
+                END) AS score,
+               cat.name AS category_name,
+               author.name AS author_name
+        """
+        
+        try:
+            records = list(self.neo4j.run(
+                cypher_query, user_id=user_id, book_ids=list(book_ids), pref_cats=pref_cats
+            ))
+        except Exception as e:
+            print(f"Score books error: {e}")
+            return {}
+        
+        blacklist = BlacklistService(self.db, self.neo4j)
+        disliked_categories = blacklist.get_disliked_categories(user_id)
+        disliked_authors = blacklist.get_disliked_authors(user_id)
+        penalties = similarity_service.get_user_penalties(self.db, user_id) if self.db else {}
+        
+        scores = {}
+        for record in records:
+            b_id = record["book_id"]
+            score = record["score"]
+            if record["category_name"] in disliked_categories:
+                score *= 0.5
+            if record["author_name"] in disliked_authors:
+                score *= 0.5
+            if b_id in penalties:
+                score = similarity_service.apply_penalty(score, penalties[b_id])
+            scores[b_id] = score
+        return scores
+    
     def incremental_update(
         self, 
         user_id: int, 
@@ -191,7 +233,7 @@ class IncrementalUpdateService:
             new_scores: 新计算的分数 {book_id: score}
             
         Returns:
-            更新后的推荐列表
+            更新后的推荐列表（保留完整的缓存池，不截断）
         """
         affected_set = set(affected_books)
         
@@ -214,10 +256,13 @@ class IncrementalUpdateService:
             
             updated.append(rec)
         
-        # 按分数重新排序
-        updated.sort(key=lambda x: x.get("score", 0), reverse=True)
+        # 按分数重新排序（各片段内排序，片段之间的先后顺序不变）
+        segment_order = {}
+        for rec in updated:
+            segment_order.setdefault(rec.get("segment", "main"), len(segment_order))
+        updated.sort(key=lambda x: (segment_order[x.get("segment", "main")], -x.get("score", 0)))
         
-        return updated[:settings.RECOMMENDATION_LIMIT]
+        return updated
     
     def should_use_incremental(
         self, 
@@ -1,11 +1,13 @@
 """
 负反馈服务
-处理隐式负反馈收集、软降权、特征传播
+处理隐式负反馈收集、软降权、特征传播（相似书籍惩罚见 similarity_service）
 """
+import time
+from collections import defaultdict
 from typing import List, Dict, Any, Optional, Set
-from datetime import datetime, timedelta
+import numpy as np
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, literal_column
 from neo4j import Session as Neo4jSession
 
 from app.core.cache import redis_cache
@@ -13,6 +15,12 @@ from app.core.config import settings
 from app.models.sql import NegativeFeedback, ExposureLog, Rating, Book
 from app.services.blacklist_service import BlacklistService
 from app.services.sync_service import SyncService
+from app.services.exposure_service import ExposureService
+from app.services.similarity_service import similarity_service
+
+
+# 全局时间衰减任务的断点Key（最后处理的负反馈ID）
+DECAY_CHECKPOINT_KEY = "job:negative_decay:last_id"
 
 
 class NegativeFeedbackService:
@@ -23,11 +31,13 @@ class NegativeFeedbackService:
         self.neo4j = neo4j
         self.cache = redis_cache
         self.blacklist_service = BlacklistService(db, neo4j)
+        self.exposure_service = ExposureService(db)
     
     def set_db(self, db: Session):
         """设置数据库会话"""
         self.db = db
         self.blacklist_service.set_db(db)
+        self.exposure_service.set_db(db)
     
     def set_neo4j(self, neo4j: Neo4jSession):
         """设置Neo4j会话"""
@@ -75,47 +85,32 @@ class NegativeFeedbackService:
     
     def _handle_exposure(self, user_id: int, book_id: int) -> Optional[Dict]:
         """处理曝光事件"""
-        if not self.db:
-            return None
+        results = self.record_exposures(user_id, [book_id])
+        return results[0] if results else None
+    
+    def record_exposures(self, user_id: int, book_ids: List[int]) -> List[Dict[str, Any]]:
+        """
+        批量处理曝光事件
         
-        try:
-            # 查找或创建曝光记录
-            exposure = self.db.query(ExposureLog).filter(
-                ExposureLog.user_id == user_id,
-                ExposureLog.book_id == book_id
-            ).first()
-            
-            if exposure:
-                exposure.exposure_count += 1
-                exposure.last_exposure_at = datetime.now()
-            else:
-                exposure = ExposureLog(
-                    user_id=user_id,
-                    book_id=book_id,
-                    exposure_count=1,
-                    click_count=0
-                )
-                self.db.add(exposure)
-            
-            self.db.commit()
-            
-            # 检查是否达到负反馈阈值
-            threshold = settings.IMPLICIT_NEGATIVE_EXPOSURE_THRESHOLD
-            if exposure.exposure_count >= threshold and exposure.click_count == 0:
+        计数在Redis中累加（由后台线程落库），并基于Redis计数检查未点击阈值
+        
+        Returns:
+            本次触发的隐式负反馈列表
+        """
+        counts = self.exposure_service.record_exposures(user_id, book_ids)
+        threshold = settings.IMPLICIT_NEGATIVE_EXPOSURE_THRESHOLD
+        
+        feedbacks = []
+        for book_id, (exposure_count, click_count) in counts.items():
+            if exposure_count >= threshold and click_count == 0:
                 # 自动创建弱负反馈
-                return self._create_implicit_feedback(
-                    user_id, book_id, 
-                    "implicit_no_click", 
-                    f"曝光{exposure.exposure_count}次未点击",
+                feedbacks.append(self._create_implicit_feedback(
+                    user_id, book_id,
+                    "implicit_no_click",
+                    f"曝光{exposure_count}次未点击",
                     strength=1
-                )
-            
-            return None
-            
-        except Exception as e:
-            print(f"Exposure handling error: {e}")
-            self.db.rollback()
-            return None
+                ))
+        return feedbacks
     
     def _handle_quick_return(
         self, 
@@ -132,14 +127,7 @@ class NegativeFeedbackService:
         
         try:
             # 更新曝光记录的点击计数
-            exposure = self.db.query(ExposureLog).filter(
-                ExposureLog.user_id == user_id,
-                ExposureLog.book_id == book_id
-            ).first()
-            
-            if exposure:
-                exposure.click_count += 1
-                self.db.commit()
+            self.exposure_service.record_click(user_id, book_id)
             
             # 快速返回视为弱负反馈信号
             return self._create_implicit_feedback(
@@ -206,6 +194,7 @@ class NegativeFeedbackService:
             )
             self.db.add(feedback)
             self.db.commit()
+            similarity_service.invalidate_user(user_id)
             
             # 如果强度达到阈值，加入黑名单
             if strength >= 2:
@@ -245,49 +234,54 @@ class NegativeFeedbackService:
         Returns:
             降权后的候选列表
         """
-        if not self.db:
-            return candidates
-        
         try:
-            # 获取用户的曝光记录
-            exposures = self.db.query(ExposureLog).filter(
-                ExposureLog.user_id == user_id
-            ).all()
-            
-            exposure_map = {e.book_id: e for e in exposures}
+            # 只查询候选书籍的曝光计数
+            book_ids = [self._candidate_book_id(c) for c in candidates]
+            exposure_map = self.exposure_service.get_counts(user_id, book_ids)
             penalty_factor = settings.SOFT_PENALTY_FACTOR
             threshold = settings.IMPLICIT_NEGATIVE_EXPOSURE_THRESHOLD
             
             result = []
-            for c in candidates:
-                book_id = c.get("book_id") or c.get("book", {}).get("id")
+            to_blacklist = []
+            for c, book_id in zip(candidates, book_ids):
                 score = c.get("score", 1.0)
                 
                 if book_id in exposure_map:
-                    exp = exposure_map[book_id]
+                    exposure_count, click_count = exposure_map[book_id]
                     
                     # 计算惩罚
-                    if exp.click_count == 0:  # 只有未点击的才惩罚
-                        penalty = min(exp.exposure_count * penalty_factor, 0.9)  # 最多降90%
+                    if click_count == 0:  # 只有未点击的才惩罚
+                        penalty = min(exposure_count * penalty_factor, 0.9)  # 最多降90%
                         score = score * (1 - penalty)
                         
                         # 超过阈值加入黑名单
-                        if exp.exposure_count >= threshold:
-                            self.blacklist_service.add_to_blacklist(
-                                user_id, book_id, "implicit_no_click",
-                                f"曝光{exp.exposure_count}次未点击"
-                            )
+                        if exposure_count >= threshold:
+                            to_blacklist.append(book_id)
                             continue  # 跳过黑名单书籍
                 
                 c["score"] = score
                 result.append(c)
             
+            # 黑名单批量写入
+            if to_blacklist:
+                self.blacklist_service.add_many_to_blacklist(user_id, to_blacklist)
+            
             return result
             
         except Exception as e:
             print(f"Soft penalty error: {e}")
             return candidates
     
+    @staticmethod
+    def _candidate_book_id(candidate: Dict[str, Any]) -> Optional[int]:
+        """取候选的书籍ID（兼容 book_id 字段、ORM对象和字典）"""
+        if candidate.get("book_id") is not None:
+            return candidate["book_id"]
+        book = candidate.get("book")
+        if isinstance(book, dict):
+            return book.get("id")
+        return getattr(book, "id", None)
+    
     def get_penalty_score(self, user_id: int, book_id: int) -> float:
         """
         获取书籍的惩罚分数
@@ -295,19 +289,13 @@ class NegativeFeedbackService:
         Returns:
             惩罚系数 (0-1)，0表示完全不推荐，1表示正常推荐
         """
-        if not self.db:
-            return 1.0
-        
         try:
-            exposure = self.db.query(ExposureLog).filter(
-                ExposureLog.user_id == user_id,
-                ExposureLog.book_id == book_id
-            ).first()
+            counts = self.exposure_service.get_counts(user_id, [book_id]).get(book_id)
             
-            if not exposure or exposure.click_count > 0:
+            if not counts or counts[1] > 0:
                 return 1.0
             
-            penalty = min(exposure.exposure_count * settings.SOFT_PENALTY_FACTOR, 0.9)
+            penalty = min(counts[0] * settings.SOFT_PENALTY_FACTOR, 0.9)
             return 1 - penalty
             
         except Exception as e:
@@ -322,7 +310,7 @@ class NegativeFeedbackService:
         decay_lambda: float = 0.1
     ) -> int:
         """
-        应用负反馈时间衰减
+        应用负反馈时间衰减（单个用户）
         
         strength(t) = original_strength × e^(-λt)
         
@@ -336,43 +324,133 @@ class NegativeFeedbackService:
         if not self.db:
             return 0
         
-        import math
-        
         try:
-            feedbacks = self.db.query(NegativeFeedback).filter(
-                NegativeFeedback.user_id == user_id,
-                NegativeFeedback.is_active == True
+            rows = self._decay_query().filter(
+                NegativeFeedback.user_id == user_id
             ).all()
-            
-            now = datetime.now()
-            updated = 0
-            
-            for f in feedbacks:
-                # 计算经过的月数
-                age_days = (now - f.created_at).days
-                age_months = age_days / 30
-                
-                # 计算衰减后的强度
-                decayed_strength = f.strength * math.exp(-decay_lambda * age_months)
-                
-                # 如果强度降到0.5以下，考虑重新尝试推荐
-                if decayed_strength < 0.5:
-                    # 移出黑名单
-                    self.blacklist_service.remove_from_blacklist(user_id, f.book_id)
-                    
-                    # 软删除负反馈
-                    if decayed_strength < 0.1:
-                        f.is_active = False
-                        updated += 1
-            
-            self.db.commit()
-            return updated
+            _, deactivated = self._decay_rows(rows, decay_lambda)
+            return deactivated
             
         except Exception as e:
             print(f"Time decay error: {e}")
             self.db.rollback()
             return 0
     
+    def apply_global_time_decay(
+        self,
+        decay_lambda: float = 0.1,
+        chunk_size: int = 5000,
+        resume: bool = True
+    ) -> Dict[str, Any]:
+        """
+        全局负反馈时间衰减（所有用户）
+        
+        按ID区间分块扫描有效负反馈，用NumPy批量计算衰减强度：
+        - 强度 < 0.5：移出Redis黑名单（按块Pipeline）
+        - 强度 < 0.1：批量UPDATE软删除
+        每块处理完后把最后的ID写入Redis断点，中断后可从断点继续
+        
+        Args:
+            decay_lambda: 衰减系数
+            chunk_size: 每块行数
+            resume: 是否从上次的断点继续
+            
+        Returns:
+            统计信息（扫描行数、移出黑名单数、软删除数、耗时、每秒行数）
+        """
+        stats = {"scanned": 0, "unblacklisted": 0, "deactivated": 0, "elapsed": 0.0, "rows_per_second": 0.0}
+        if not self.db:
+            return stats
+        
+        last_id = 0
+        if resume:
+            checkpoint = self.cache.get(DECAY_CHECKPOINT_KEY)
+            if checkpoint and checkpoint.isdigit():
+                last_id = int(checkpoint)
+                print(f"Resuming time decay from id > {last_id}")
+        
+        started = time.time()
+        while True:
+            rows = self._decay_query().filter(
+                NegativeFeedback.id > last_id
+            ).order_by(NegativeFeedback.id).limit(chunk_size).all()
+            if not rows:
+                break
+            
+            try:
+                unblacklisted, deactivated = self._decay_rows(rows, decay_lambda)
+            except Exception as e:
+                print(f"Time decay chunk after id {last_id} failed: {e}")
+                self.db.rollback()
+                break
+            
+            last_id = rows[-1].id
+            self.cache.set(DECAY_CHECKPOINT_KEY, str(last_id), settings.CACHE_L3_TTL)
+            
+            stats["scanned"] += len(rows)
+            stats["unblacklisted"] += unblacklisted
+            stats["deactivated"] += deactivated
+            elapsed = time.time() - started
+            print(f"Time decay: {stats['scanned']} rows up to id {last_id}, "
+                  f"{stats['scanned'] / elapsed if elapsed else 0:.0f} rows/s")
+        
+        if not rows:
+            # 全部处理完成，清除断点
+            self.cache.delete(DECAY_CHECKPOINT_KEY)
+        
+        stats["elapsed"] = round(time.time() - started, 3)
+        stats["rows_per_second"] = round(stats["scanned"] / stats["elapsed"], 1) if stats["elapsed"] else 0.0
+        return stats
+    
+    def _decay_query(self):
+        """查询有效负反馈的衰减所需列（年龄按整天计算）"""
+        return self.db.query(
+            NegativeFeedback.id,
+            NegativeFeedback.user_id,
+            NegativeFeedback.book_id,
+            NegativeFeedback.strength,
+            func.timestampdiff(literal_column("DAY"), NegativeFeedback.created_at, func.now()).label("age_days")
+        ).filter(NegativeFeedback.is_active == True)
+    
+    def _decay_rows(self, rows: List[Any], decay_lambda: float) -> tuple:
+        """
+        对一批负反馈计算衰减并批量写回
+        
+        Returns:
+            (移出黑名单数, 软删除数)
+        """
+        if not rows:
+            return 0, 0
+        
+        ids = np.array([r.id for r in rows], dtype=np.int64)
+        strengths = np.array([r.strength or 0 for r in rows], dtype=np.float64)
+        age_months = np.array([r.age_days or 0 for r in rows], dtype=np.float64) / 30
+        
+        decayed = strengths * np.exp(-decay_lambda * age_months)
+        release = np.flatnonzero(decayed < 0.5)
+        deactivate_mask = decayed < 0.1
+        deactivate = ids[deactivate_mask].tolist()
+        
+        # 软删除
+        if deactivate:
+            self.db.query(NegativeFeedback).filter(
+                NegativeFeedback.id.in_(deactivate)
+            ).update({NegativeFeedback.is_active: False}, synchronize_session=False)
+        self.db.commit()
+        
+        # 移出黑名单
+        user_books = defaultdict(list)
+        for i in release:
+            user_books[rows[i].user_id].append(rows[i].book_id)
+        self.blacklist_service.remove_many_from_blacklist(user_books)
+        
+        # 衰减后的负反馈不再参与相似度惩罚，删除受影响用户的惩罚缓存
+        affected_users = set(user_books)
+        affected_users.update(rows[i].user_id for i in np.flatnonzero(deactivate_mask))
+        similarity_service.invalidate_users(affected_users)
+        
+        return len(release), len(deactivate)
+    
     # ==================== 统计分析 ====================
     
     def get_user_negative_stats(self, user_id: int) -> Dict[str, Any]:
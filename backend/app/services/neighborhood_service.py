@@ -0,0 +1,361 @@
+"""
+书籍邻域表服务
+离线为每本书预计算有上限、已排序的邻居列表（同类别、同作者、共同读者），
+以CSR数组（indptr + neighbors）保存为.npy文件并内存映射加载，影响分析时按书籍ID直接取切片；
+表构建之后新增的书籍从MySQL即时计算并缓存在进程内，定期重建表以纳入新书籍和新交互
+"""
+import os
+import shutil
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import numpy as np
+import scipy.sparse as sp
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.core.cache import redis_cache
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.models.sql import Book, Interaction, Rating
+
+
+# backend 目录，相对路径的邻域表目录以此为基准
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 邻居类型
+KINDS = ("category", "author", "coread")
+
+# 指向当前版本目录的文件名
+CURRENT_FILE = "current"
+# 检查是否有新版本的间隔（秒）
+RELOAD_CHECK_INTERVAL = 30
+# 新书籍邻居的进程内缓存
+OVERLAY_TTL = 300
+OVERLAY_MAX_BOOKS = 1000
+
+
+class NeighborhoodService:
+    """书籍邻域表服务"""
+    
+    def __init__(self, path: Optional[str] = None):
+        path = path or settings.NEIGHBORHOOD_PATH
+        self.path = path if os.path.isabs(path) else os.path.join(BASE_DIR, path)
+        self._lock = threading.Lock()
+        self._arrays: Optional[Dict[str, np.ndarray]] = None
+        self._version: Optional[str] = None
+        self._checked_at = 0.0
+        self._overlay: "OrderedDict[int, tuple]" = OrderedDict()
+    
+    @staticmethod
+    def caps() -> Dict[str, int]:
+        """各类邻居的数量上限"""
+        return {
+            "category": settings.NEIGHBORHOOD_CATEGORY_CAP,
+            "author": settings.NEIGHBORHOOD_AUTHOR_CAP,
+            "coread": settings.NEIGHBORHOOD_COREAD_CAP
+        }
+    
+    # ==================== 离线构建 ====================
+    
+    def build(self, db: Session, chunk_size: int = 512) -> Dict[str, Any]:
+        """
+        构建邻域表并保存
+        
+        同类别/同作者邻居按热度（交互 + 评分次数）排序，共同读者邻居按共同读者数排序，
+        每类只保留配置的上限数量
+        
+        Returns:
+            统计信息（书籍数、各类邻居总数、耗时）
+        """
+        started = time.time()
+        caps = self.caps()
+        
+        books = db.query(Book.id, Book.category_id, Book.author).order_by(Book.id).all()
+        book_ids = np.array([b.id for b in books], dtype=np.int64)
+        n = len(book_ids)
+        if n == 0:
+            return {"books": 0, "neighbors": {}, "elapsed": 0.0}
+        
+        popularity = np.zeros(n, dtype=np.float64)
+        for model in (Interaction, Rating):
+            counts = db.query(model.book_id, func.count(model.id)).group_by(model.book_id).all()
+            positions, valid = self._positions(book_ids, [c[0] for c in counts])
+            np.add.at(popularity, positions[valid], np.array([c[1] for c in counts], dtype=np.float64)[valid])
+        
+        rows = {
+            "category": self._group_neighbors([b.category_id for b in books], popularity, caps["category"]),
+            "author": self._group_neighbors([b.author or None for b in books], popularity, caps["author"]),
+            "coread": self._coread_neighbors(db, book_ids, popularity, caps["coread"], chunk_size)
+        }
+        
+        row_index = np.full(int(book_ids[-1]) + 1, -1, dtype=np.int32)
+        row_index[book_ids] = np.arange(n, dtype=np.int32)
+        arrays = {"book_ids": book_ids, "row_index": row_index}
+        for kind, lists in rows.items():
+            lengths = np.array([len(r) for r in lists], dtype=np.int64)
+            arrays[f"{kind}_indptr"] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+            arrays[f"{kind}_neighbors"] = (
+                book_ids[np.concatenate(lists)] if lengths.sum() else np.array([], dtype=np.int64)
+            )
+        self.save(arrays)
+        
+        return {
+            "books": n,
+            "neighbors": {kind: int(len(arrays[f"{kind}_neighbors"])) for kind in KINDS},
+            "elapsed": round(time.time() - started, 3)
+        }
+    
+    @staticmethod
+    def _positions(book_ids: np.ndarray, ids: List[int]):
+        """书籍ID -> 行号（searchsorted），返回行号和是否存在"""
+        ids = np.array(ids, dtype=np.int64)
+        positions = np.searchsorted(book_ids, ids)
+        valid = (positions < len(book_ids)) & (book_ids[np.minimum(positions, len(book_ids) - 1)] == ids)
+        return positions, valid
+    
+    @staticmethod
+    def _group_neighbors(keys: List[Any], popularity: np.ndarray, cap: int) -> List[np.ndarray]:
+        """同一分组（类别/作者）内按热度取前 cap 个其他书籍（行号）"""
+        groups: Dict[Any, List[int]] = {}
+        for row, key in enumerate(keys):
+            if key is not None:
+                groups.setdefault(key, []).append(row)
+        
+        ranked = {}
+        for key, members in groups.items():
+            members = np.array(members, dtype=np.int64)
+            ranked[key] = members[np.argsort(-popularity[members], kind="stable")][:cap + 1]
+        
+        empty = np.array([], dtype=np.int64)
+        lists = []
+        for row, key in enumerate(keys):
+            if key is None:
+                lists.append(empty)
+                continue
+            top = ranked[key]
+            lists.append(top[top != row][:cap])
+        return lists
+    
+    def _coread_neighbors(
+        self,
+        db: Session,
+        book_ids: np.ndarray,
+        popularity: np.ndarray,
+        cap: int,
+        chunk_size: int
+    ) -> List[np.ndarray]:
+        """共同读者最多的前 cap 本书（行号），共同读者数相同时热度高的在前"""
+        n = len(book_ids)
+        empty = np.array([], dtype=np.int64)
+        reads = db.query(Interaction.book_id, Interaction.user_id).distinct().union(
+            db.query(Rating.book_id, Rating.user_id).distinct()
+        ).all()
+        if not reads:
+            return [empty] * n
+        
+        positions, valid = self._positions(book_ids, [r[0] for r in reads])
+        read_users = np.array([r[1] for r in reads], dtype=np.int64)
+        user_codes, user_index = np.unique(read_users[valid], return_inverse=True)
+        read_matrix = sp.csr_matrix(
+            (np.ones(valid.sum(), dtype=np.float32), (positions[valid], user_index)),
+            shape=(n, len(user_codes))
+        )
+        read_matrix.data[:] = 1.0  # 去重后的重复项只计一次
+        read_t = read_matrix.T.tocsc()
+        
+        lists = []
+        for start in range(0, n, chunk_size):
+            block = (read_matrix[start:start + chunk_size] @ read_t).tocsr()
+            for i in range(block.shape[0]):
+                row_start, row_end = block.indptr[i], block.indptr[i + 1]
+                cols = block.indices[row_start:row_end]
+                counts = block.data[row_start:row_end]
+                keep = cols != start + i  # 去掉自身
+                cols, counts = cols[keep], counts[keep]
+                order = np.lexsort((-popularity[cols], -counts))[:cap]
+                lists.append(cols[order].astype(np.int64))
+        return lists
+    
+    def save(self, arrays: Dict[str, np.ndarray]):
+        """
+        保存为新版本目录下的.npy文件，再原子替换 current 指针
+        
+        已内存映射旧版本的进程不受影响（文件删除后映射仍然有效），下次检查时切换到新版本
+        """
+        version = f"v{int(time.time() * 1000)}"
+        version_dir = os.path.join(self.path, version)
+        os.makedirs(version_dir, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(version_dir, f"{name}.npy"), array)
+        
+        tmp_path = os.path.join(self.path, CURRENT_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            f.write(version)
+        os.replace(tmp_path, os.path.join(self.path, CURRENT_FILE))
+        
+        for entry in os.listdir(self.path):
+            if entry.startswith("v") and entry != version:
+                shutil.rmtree(os.path.join(self.path, entry), ignore_errors=True)
+        
+        self._checked_at = 0.0
+        self._load()
+    
+    # ==================== 加载 ====================
+    
+    def _load(self) -> bool:
+        """内存映射加载当前版本（定期检查 current 指针，有新版本时切换）"""
+        if self._arrays is not None and time.time() - self._checked_at < RELOAD_CHECK_INTERVAL:
+            return True
+        
+        with self._lock:
+            if self._arrays is not None and time.time() - self._checked_at < RELOAD_CHECK_INTERVAL:
+                return True
+            self._checked_at = time.time()
+            try:
+                with open(os.path.join(self.path, CURRENT_FILE)) as f:
+                    version = f.read().strip()
+            except OSError:
+                return self._arrays is not None
+            
+            if version == self._version:
+                return True
+            try:
+                version_dir = os.path.join(self.path, version)
+                names = ["book_ids", "row_index"] + [f"{k}_{p}" for k in KINDS for p in ("indptr", "neighbors")]
+                self._arrays = {
+                    name: np.load(os.path.join(version_dir, f"{name}.npy"), mmap_mode="r") for name in names
+                }
+                self._version = version
+                self._overlay.clear()
+                print(f"Loaded book neighborhood table {version}: {len(self._arrays['book_ids'])} books")
+            except Exception as e:
+                print(f"Load neighborhood table error: {e}")
+        return self._arrays is not None
+    
+    # ==================== 查询 ====================
+    
+    def available(self) -> bool:
+        """本机是否已有可用的邻域表"""
+        return self._load()
+    
+    def get_neighbors(self, db: Optional[Session], book_id: int) -> Dict[str, List[int]]:
+        """
+        获取书籍的邻居
+        
+        Returns:
+            {"category": [...], "author": [...], "coread": [...]}，各列表已按相关度排序；
+            表中没有的书籍（构建之后新增）从MySQL即时计算
+        """
+        if self._load():
+            arrays = self._arrays
+            row_index = arrays["row_index"]
+            if 0 <= book_id < len(row_index) and row_index[book_id] >= 0:
+                row = int(row_index[book_id])
+                return {
+                    kind: arrays[f"{kind}_neighbors"][
+                        arrays[f"{kind}_indptr"][row]:arrays[f"{kind}_indptr"][row + 1]
+                    ].tolist()
+                    for kind in KINDS
+                }
+        return self._overlay_neighbors(db, book_id)
+    
+    def _overlay_neighbors(self, db: Optional[Session], book_id: int) -> Dict[str, List[int]]:
+        """新书籍的邻居：同类别/同作者按平均评分取前N本（新书籍还没有共同读者）"""
+        with self._lock:
+            cached = self._overlay.get(book_id)
+            if cached and time.time() - cached[0] < OVERLAY_TTL:
+                self._overlay.move_to_end(book_id)
+                return cached[1]
+        
+        neighbors = {kind: [] for kind in KINDS}
+        if not db:
+            return neighbors
+        
+        book = db.query(Book.category_id, Book.author).filter(Book.id == book_id).first()
+        if not book:
+            return neighbors
+        
+        caps = self.caps()
+        if book.category_id is not None:
+            neighbors["category"] = [r.id for r in db.query(Book.id).filter(
+                Book.category_id == book.category_id, Book.id != book_id
+            ).order_by(Book.average_rating.desc()).limit(caps["category"]).all()]
+        if book.author:
+            neighbors["author"] = [r.id for r in db.query(Book.id).filter(
+                Book.author == book.author, Book.id != book_id
+            ).order_by(Book.average_rating.desc()).limit(caps["author"]).all()]
+        
+        with self._lock:
+            self._overlay[book_id] = (time.time(), neighbors)
+            while len(self._overlay) > OVERLAY_MAX_BOOKS:
+                self._overlay.popitem(last=False)
+        return neighbors
+
+
+# 全局邻域表服务实例（表在进程内只映射一份）
+neighborhood_service = NeighborhoodService()
+
+
+class NeighborhoodRebuilder:
+    """
+    邻域表定期重建线程
+    
+    表保存在本机磁盘，同一主机上的多个Worker进程共用一份：
+    以主机名为粒度的Redis锁保证每个重建周期内每台主机只重建一次
+    """
+    
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def start(self, interval: float = None):
+        """启动重建线程（本机还没有邻域表时立即构建一次）"""
+        if self._thread and self._thread.is_alive():
+            print("Neighborhood Rebuilder is already running")
+            return
+        
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(interval or settings.NEIGHBORHOOD_REBUILD_INTERVAL,),
+            daemon=True
+        )
+        self._thread.start()
+        print("Neighborhood Rebuilder started")
+    
+    def stop(self):
+        """停止重建线程"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        print("Neighborhood Rebuilder stopped")
+    
+    def _run(self, interval: float):
+        if not neighborhood_service.available():
+            self.rebuild(interval)
+        while not self._stop.wait(interval):
+            self.rebuild(interval)
+    
+    def rebuild(self, interval: float) -> bool:
+        """本周期内本机尚未重建时重建一次（锁不主动释放，到期即进入下一周期）"""
+        lock_key = f"lock:neighborhood:rebuild:{socket.gethostname()}"
+        if not redis_cache.acquire_lock(lock_key, max(int(interval * 0.9), 1)):
+            return False
+        
+        db = SessionLocal()
+        try:
+            stats = neighborhood_service.build(db)
+            print(f"Rebuilt book neighborhood table: {stats['books']} books in {stats['elapsed']}s")
+            return True
+        except Exception as e:
+            print(f"Neighborhood Rebuilder error: {e}")
+            return False
+        finally:
+            db.close()
+
+
+# 全局邻域表重建线程
+neighborhood_rebuilder = NeighborhoodRebuilder()
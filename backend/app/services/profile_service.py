@@ -0,0 +1,186 @@
+"""
+用户类别画像服务
+每个用户的类别交互次数保存在Redis Hash中，交互写入时用HINCRBY增量更新，
+多样性控制读取画像时不再访问MySQL
+"""
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.core.cache import redis_cache
+from app.models.sql import Book, Category, Interaction
+
+
+# 画像Hash中标记"已从MySQL加载"的占位字段
+LOADED_FIELD = "_loaded"
+# 类别名称进程内缓存的有效期（秒）
+CATEGORY_NAME_TTL = 600
+
+# 仅当画像已加载时才累加；未加载的画像在首次读取时从MySQL完整计算（已包含本次交互）
+INCREMENT_IF_LOADED = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('HINCRBY', KEYS[1], ARGV[2], 1)
+end
+return false
+"""
+
+
+class CategoryNameCache:
+    """类别ID -> 名称 的进程内缓存（类别很少变化，定期刷新）"""
+    
+    def __init__(self, ttl: int = CATEGORY_NAME_TTL):
+        self.ttl = ttl
+        self._names: Dict[int, str] = {}
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+    
+    def get_all(self, db: Session) -> Dict[int, str]:
+        """获取全部类别（按ID排序）"""
+        if time.time() - self._loaded_at > self.ttl or not self._names:
+            with self._lock:
+                if time.time() - self._loaded_at > self.ttl or not self._names:
+                    rows = db.query(Category.id, Category.name).order_by(Category.id).all()
+                    self._names = {r.id: r.name for r in rows}
+                    self._loaded_at = time.time()
+        return self._names
+    
+    def get(self, db: Session, category_id: Optional[int]) -> Optional[str]:
+        if category_id is None:
+            return None
+        name = self.get_all(db).get(category_id)
+        if name is None:
+            # 新增的类别，强制刷新一次
+            self._loaded_at = 0.0
+            name = self.get_all(db).get(category_id)
+        return name
+
+
+# 全局类别名称缓存
+category_names = CategoryNameCache()
+
+
+class ProfileService:
+    """用户类别画像服务"""
+    
+    def __init__(self, db: Optional[Session] = None):
+        self.cache = redis_cache
+        self.db = db
+    
+    def set_db(self, db: Session):
+        """设置数据库会话"""
+        self.db = db
+    
+    # ==================== 增量更新 ====================
+    
+    def record_interaction(self, user_id: int, book_id: int) -> bool:
+        """交互写入成功后累加该书籍类别的计数"""
+        if not self.db:
+            return False
+        try:
+            category_id = self.db.query(Book.category_id).filter(Book.id == book_id).scalar()
+            category = category_names.get(self.db, category_id)
+            if not category:
+                return False
+            result = self.cache.run_script(
+                INCREMENT_IF_LOADED,
+                keys=[self.cache.category_profile_key(user_id)],
+                args=[LOADED_FIELD, category]
+            )
+            return result is not None
+        except Exception as e:
+            print(f"Record category profile error: {e}")
+            return False
+    
+    # ==================== 读取 ====================
+    
+    def get_category_counts(self, user_id: int) -> Dict[str, int]:
+        """
+        获取用户的类别交互次数
+        
+        Redis画像未加载时从MySQL聚合一次并写入
+        """
+        key = self.cache.category_profile_key(user_id)
+        profile = self.cache.hgetall(key)
+        if LOADED_FIELD in profile:
+            return {k: int(v) for k, v in profile.items() if k != LOADED_FIELD}
+        
+        if not self.db:
+            return {}
+        
+        rows = self.db.query(
+            Category.name,
+            func.count(Interaction.id).label("count")
+        ).join(
+            Book, Book.category_id == Category.id
+        ).join(
+            Interaction, Interaction.book_id == Book.id
+        ).filter(
+            Interaction.user_id == user_id
+        ).group_by(
+            Category.name
+        ).all()
+        counts = {r.name: r.count for r in rows}
+        
+        self._write_profiles({user_id: counts})
+        return counts
+    
+    def get_category_names(self) -> List[str]:
+        """获取全部类别名称（进程内缓存）"""
+        if not self.db:
+            return []
+        return list(category_names.get_all(self.db).values())
+    
+    # ==================== 全量回填 ====================
+    
+    def _write_profiles(self, profiles: Dict[int, Dict[str, int]]) -> bool:
+        """整体替换一批用户的画像（一次Pipeline）"""
+        def build(pipe):
+            for user_id, counts in profiles.items():
+                key = self.cache.category_profile_key(user_id)
+                pipe.delete(key)
+                pipe.hset(key, mapping={LOADED_FIELD: 1, **counts})
+        
+        return bool(self.cache.execute_pipeline(build, transaction=True))
+    
+    def rebuild_all(self, batch_size: int = 1000) -> Dict[str, Any]:
+        """
+        从MySQL回填所有用户的类别画像
+        
+        按 (用户, 类别) 聚合后流式读取，每 batch_size 个用户写入一次
+        """
+        stats = {"users": 0, "rows": 0, "elapsed": 0.0}
+        if not self.db:
+            return stats
+        
+        started = time.time()
+        query = self.db.query(
+            Interaction.user_id,
+            Category.name,
+            func.count(Interaction.id).label("count")
+        ).join(
+            Book, Book.id == Interaction.book_id
+        ).join(
+            Category, Category.id == Book.category_id
+        ).group_by(
+            Interaction.user_id, Category.name
+        ).order_by(
+            Interaction.user_id
+        ).execution_options(stream_results=True, yield_per=batch_size)
+        
+        batch: Dict[int, Dict[str, int]] = {}
+        for row in query:
+            if row.user_id not in batch and len(batch) >= batch_size:
+                self._write_profiles(batch)
+                stats["users"] += len(batch)
+                batch = {}
+            batch.setdefault(row.user_id, {})[row.name] = row.count
+            stats["rows"] += 1
+        
+        if batch:
+            self._write_profiles(batch)
+            stats["users"] += len(batch)
+        
+        stats["elapsed"] = round(time.time() - started, 3)
+        return stats
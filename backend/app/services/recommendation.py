@@ -6,16 +6,22 @@ from sqlalchemy.orm import Session
 from neo4j import Session as Neo4jSession
 from typing import List, Dict, Any, Optional
 import random
-import json
-from datetime import datetime, timedelta
 
-from app.models.sql import Book, User, Interaction, SearchLog, RecommendationCache, RecommendationHistory
+from app.models.sql import Book, User, Interaction, SearchLog
 from app.services.llm_service import llm_service
 from app.services.cache_service import CacheService
 from app.services.blacklist_service import BlacklistService
+from app.services.exclusion_service import ExclusionService, ExclusionBitmap
 from app.services.diversity_service import DiversityService
+from app.services.similarity_service import similarity_service
+from app.services.history_service import HistoryService
 from app.core.config import settings
-from sqlalchemy import func
+
+
+# 搜索关联推荐的标签，缓存中以独立片段（segment）存放
+SEARCH_TAG = "搜索关联"
+SEGMENT_SEARCH = "search"
+SEGMENT_MAIN = "main"
 
 
 class RecommendationService:
@@ -28,15 +34,18 @@ class RecommendationService:
         # 初始化服务
         self.cache_service = CacheService(db)
         self.blacklist_service = BlacklistService(db, neo4j)
+        self.exclusion_service = ExclusionService(db)
         self.diversity_service = DiversityService(db)
+        self.history_service = HistoryService(db)
 
     def get_recommendations(
         self, 
         user_id: int, 
         limit: int = 10,
         enable_diversity: bool = True,
-        diversity_mode: str = "quota",  # quota, mmr, none
-        force_refresh: bool = False
+        diversity_mode: str = "quota",  # quota, mmr, dpp, none
+        force_refresh: bool = False,
+        record_history: bool = True
     ) -> List[Dict[str, Any]]:
         """
         混合推荐：图谱路径 + 人口统计 + 偏好 + 热门
@@ -46,8 +55,9 @@ class RecommendationService:
             user_id: 用户ID
             limit: 推荐数量
             enable_diversity: 是否启用多样性控制
-            diversity_mode: 多样性模式 (quota/mmr/none)
+            diversity_mode: 多样性模式 (quota/mmr/dpp/none)
             force_refresh: 是否强制刷新缓存
+            record_history: 是否计入推荐历史（后台预计算的结果并未展示给用户，不计入）
         """
         print(f"DEBUG: Starting recommendation for user_id={user_id}")
         
@@ -55,30 +65,35 @@ class RecommendationService:
         if not force_refresh:
             cached = self.cache_service.get_recommendations(user_id)
             if cached:
-                print(f"DEBUG: Cache hit for user_id={user_id}")
-                return self._restore_recommendations(cached, limit)
-        
-        # 1. 获取用户信息和黑名单
+                # 读时过滤：按当前黑名单和不喜欢的类别/作者过滤，备选候选自动补位
+                exclusions = self.blacklist_service.get_exclusion_snapshot(user_id)
+                pool = self.cache_service.filter_excluded(cached, exclusions)
+                if len(pool) >= self.cache_service.pool_threshold(limit):
+                    print(f"DEBUG: Cache hit for user_id={user_id}")
+                    return self._restore_recommendations(pool, limit)
+                print(f"DEBUG: Cache pool below threshold for user_id={user_id} ({len(pool)} left), recomputing")
+        
+        # 1. 获取用户信息和排除集合
         user = self.db.query(User).filter(User.id == user_id).first()
         pref_cats = []
         if user and user.preferred_categories:
             pref_cats = [c.strip() for c in user.preferred_categories.split(",") if c.strip()]
         
-        # 获取黑名单
-        blacklist = self.blacklist_service.get_blacklist_for_neo4j_query(user_id)
+        # 排除位图：全部已看过书籍 + 黑名单
+        excluded_books = self.exclusion_service.get_exclusions(user_id)
         disliked_categories = self.blacklist_service.get_disliked_categories(user_id)
         disliked_authors = self.blacklist_service.get_disliked_authors(user_id)
+        # 负反馈向相似书籍传播的惩罚
+        penalties = similarity_service.get_user_penalties(self.db, user_id)
         
         # 2. 获取用户历史
-        recent_interactions = self.db.query(Interaction).filter(
-            Interaction.user_id == user_id
-        ).order_by(Interaction.created_at.desc()).limit(10).all()
+        recent_interactions = self._get_recent_interactions(user_id)
         
         history_book_ids = [i.book_id for i in recent_interactions]
         history_titles = [i.book.title for i in recent_interactions if i.book]
 
         recommendations = []
-        seen_books = set(history_book_ids) | set(blacklist)  # 排除历史和黑名单
+        seen_books = excluded_books | history_book_ids  # 排除历史和黑名单
         
         # 3. 搜索关联推荐
         recommendations.extend(
@@ -89,19 +104,21 @@ class RecommendationService:
         
         # 4. 图谱推荐
         graph_candidates = self._get_graph_candidates(
-            user_id, pref_cats, blacklist, 
+            user_id, pref_cats,
             list(disliked_categories), list(disliked_authors),
-            seen_books, limit * 3
+            penalties, seen_books, limit * 3
         )
         
         # 5. LLM重排序
         if graph_candidates:
-            refined = self._llm_rerank(graph_candidates, history_titles, blacklist)
+            refined = self._llm_rerank(graph_candidates, history_titles)
             for r in refined:
                 if r["book"].id not in seen_books:
                     recommendations.append(r)
                     seen_books.add(r["book"].id)
         
+        ranked = list(recommendations)
+        
         # 6. 应用多样性控制
         if enable_diversity and len(recommendations) > 0:
             recommendations = self._apply_diversity(
@@ -113,19 +130,38 @@ class RecommendationService:
             popular = self._get_popular_fallback(seen_books, limit - len(recommendations))
             recommendations.extend(popular)
         
-        # 8. 保存缓存
-        self._save_to_cache(user_id, recommendations)
+        # 8. 保存缓存（展示列表 + 备选候选，供读时过滤后补位）
+        backups = self._build_backup_pool(recommendations, ranked, graph_candidates, seen_books)
+        self._save_to_cache(user_id, recommendations + backups)
         
         # 9. 更新推荐历史（用于滑动窗口）
-        self._update_recommendation_history(user_id, recommendations)
+        if record_history:
+            self._update_recommendation_history(user_id, recommendations)
         
         return recommendations[:limit]
 
+    def _get_recent_interactions(self, user_id: int, limit: int = 10) -> List[Interaction]:
+        """获取用户最近的交互记录"""
+        return self.db.query(Interaction).filter(
+            Interaction.user_id == user_id
+        ).order_by(Interaction.created_at.desc()).limit(limit).all()
+
+    def _get_recent_searches(self, user_id: int, limit: int = 3) -> List[SearchLog]:
+        """获取用户最近的搜索记录"""
+        return self.db.query(SearchLog).filter(
+            SearchLog.user_id == user_id
+        ).order_by(SearchLog.created_at.desc()).limit(limit).all()
+
     def _restore_recommendations(self, cached: List[Dict], limit: int) -> List[Dict[str, Any]]:
-        """从缓存恢复推荐结果"""
+        """从缓存恢复推荐结果（一次IN查询加载书籍，保持缓存中的顺序）"""
         recommendations = []
-        for item in cached:
-            book = self.db.query(Book).filter(Book.id == item["book_id"]).first()
+        items = cached[:limit]
+        books = {
+            book.id: book
+            for book in self.db.query(Book).filter(Book.id.in_([item["book_id"] for item in items])).all()
+        } if items else {}
+        for item in items:
+            book = books.get(item["book_id"])
             if book:
                 recommendations.append({
                     "book": book,
@@ -133,17 +169,15 @@ class RecommendationService:
                     "reason": item["reason"],
                     "tags": item.get("tags", [])
                 })
-        return recommendations[:limit]
+        return recommendations
 
     def _get_search_based_recommendations(
-        self, user_id: int, seen_books: set, limit: int
+        self, user_id: int, seen_books: ExclusionBitmap, limit: int
     ) -> List[Dict[str, Any]]:
         """基于搜索历史的推荐"""
         recommendations = []
         
-        recent_searches = self.db.query(SearchLog).filter(
-            SearchLog.user_id == user_id
-        ).order_by(SearchLog.created_at.desc()).limit(3).all()
+        recent_searches = self._get_recent_searches(user_id)
         
         for search in recent_searches:
             if len(recommendations) >= limit // 3:  # 搜索推荐占比最多1/3
@@ -163,7 +197,7 @@ class RecommendationService:
                     "book": book,
                     "score": 0.9,
                     "reason": f"基于您最近搜索关键词【{search.query}】的精准推荐。",
-                    "tags": ["搜索关联"],
+                    "tags": [SEARCH_TAG],
                     "category_name": book.category.name if book.category else "Unknown",
                     "author": book.author
                 })
@@ -175,14 +209,20 @@ class RecommendationService:
         self, 
         user_id: int, 
         pref_cats: List[str],
-        blacklist: List[int],
         disliked_categories: List[str],
         disliked_authors: List[str],
-        seen_books: set,
+        penalties: Dict[int, float],
+        seen_books: ExclusionBitmap,
         limit: int
     ) -> List[Dict[str, Any]]:
-        """从知识图谱获取候选书籍"""
+        """
+        从知识图谱获取候选书籍
+        
+        已看过和黑名单书籍不在Cypher中逐行检查，而是多取一部分结果后用排除位图过滤；
+        过滤后不足 limit 个且图谱还有更多结果时，加倍 LIMIT 重新查询（最多 EXCLUSION_FETCH_MAX 行）
+        """
         candidates = []
+        fetch_limit = limit + min(len(seen_books), settings.EXCLUSION_OVERFETCH_MAX)
         
         # 增强的Cypher查询，包含负反馈过滤
         cypher_query = """
@@ -190,23 +230,17 @@ class RecommendationService:
         
         // 1. 内容推荐路径
         OPTIONAL MATCH (u)-[:CLICKED|RATED|COLLECTED]->(b:Book)-[:BELONGS_TO|WRITTEN_BY]->(node)<-[:BELONGS_TO|WRITTEN_BY]-(rec_content:Book)
-        WHERE NOT (u)-[:CLICKED|RATED|COLLECTED]->(rec_content)
-          AND NOT (u)-[:DISLIKES]->(rec_content)
-          AND NOT rec_content.id IN $blacklist
+        WHERE NOT (u)-[:DISLIKES]->(rec_content)
         
         // 2. 协同过滤路径
         OPTIONAL MATCH (u)-[:CLICKED|RATED|COLLECTED]->(b2:Book)<-[:CLICKED|RATED|COLLECTED]-(peer:User)-[:CLICKED|RATED|COLLECTED]->(rec_collab:Book)
-        WHERE NOT (u)-[:CLICKED|RATED|COLLECTED]->(rec_collab) 
-          AND NOT (u)-[:DISLIKES]->(rec_collab)
+        WHERE NOT (u)-[:DISLIKES]->(rec_collab)
           AND peer.id <> u.id
-          AND NOT rec_collab.id IN $blacklist
         
         // 3. 偏好类别路径
         OPTIONAL MATCH (rec_pref:Book)-[:BELONGS_TO]->(c_pref:Category)
         WHERE c_pref.name IN $pref_cats 
-          AND NOT (u)-[:CLICKED|RATED|COLLECTED]->(rec_pref)
           AND NOT (u)-[:DISLIKES]->(rec_pref)
-          AND NOT rec_pref.id IN $blacklist
         
         // 4. 人口统计路径
         OPTIONAL MATCH (peer_demog:User)
@@ -214,9 +248,7 @@ class RecommendationService:
           AND peer_demog.gender = u.gender 
           AND abs(peer_demog.age - u.age) <= 5
         OPTIONAL MATCH (peer_demog)-[:CLICKED|RATED|COLLECTED]->(rec_demog:Book)
-        WHERE NOT (u)-[:CLICKED|RATED|COLLECTED]->(rec_demog)
-          AND NOT (u)-[:DISLIKES]->(rec_demog)
-          AND NOT rec_demog.id IN $blacklist
+        WHERE NOT (u)-[:DISLIKES]->(rec_demog)
         
         // 合并结果
         WITH rec_content, rec_collab, rec_pref, rec_demog, node, count(peer) as peer_strength, count(peer_demog) as demog_strength, c_pref
@@ -268,18 +300,23 @@ class RecommendationService:
         """
         
         try:
-            results = self.neo4j.run(
-                cypher_query, 
-                user_id=user_id, 
-                pref_cats=pref_cats,
-                blacklist=blacklist,
-                limit=limit
-            )
+            while True:
+                records = list(self.neo4j.run(
+                    cypher_query, 
+                    user_id=user_id, 
+                    pref_cats=pref_cats,
+                    limit=fetch_limit
+                ))
+                unseen = [record for record in records if record["book_id"] not in seen_books]
+                if (len(unseen) >= limit or len(records) < fetch_limit
+                        or fetch_limit >= settings.EXCLUSION_FETCH_MAX):
+                    break
+                fetch_limit = min(fetch_limit * 2, settings.EXCLUSION_FETCH_MAX)
             
-            for record in results:
+            for record in unseen:
+                if len(candidates) >= limit:
+                    break
                 b_id = record["book_id"]
-                if b_id in seen_books:
-                    continue
                 
                 book_obj = self.db.query(Book).filter(Book.id == b_id).first()
                 if not book_obj:
@@ -294,6 +331,9 @@ class RecommendationService:
                     score *= 0.5
                 if author_name in disliked_authors:
                     score *= 0.5
+                # 与被拒绝书籍相似的降权
+                if b_id in penalties:
+                    score = similarity_service.apply_penalty(score, penalties[b_id])
                 
                 candidates.append({
                     "book": book_obj,
@@ -309,13 +349,14 @@ class RecommendationService:
         except Exception as e:
             print(f"DEBUG: Neo4j Query failed: {e}")
         
+        # 降权改变了分数，按降权后的分数重新排序（后续只取前几个候选）
+        candidates.sort(key=lambda c: c["score"], reverse=True)
         return candidates
 
     def _llm_rerank(
         self, 
         candidates: List[Dict], 
-        history_titles: List[str],
-        blacklist: List[int]
+        history_titles: List[str]
     ) -> List[Dict[str, Any]]:
         """使用LLM重排序"""
         recommendations = []
@@ -361,18 +402,24 @@ class RecommendationService:
         except Exception as e:
             print(f"DEBUG: LLM refinement failed: {e}")
             # 回退：直接使用候选
-            for c in candidates[:10]:
-                recommendations.append({
-                    "book": c["book"],
-                    "score": c["score"],
-                    "reason": f"根据您的兴趣为您推荐。",
-                    "tags": [c.get("source_type", "推荐")],
-                    "category_name": c.get("category_name"),
-                    "author": c.get("author")
-                })
+            recommendations = self._fallback_rerank(candidates)
         
         return recommendations
 
+    def _fallback_rerank(self, candidates: List[Dict]) -> List[Dict[str, Any]]:
+        """不经过LLM，按图谱分数直接取前10个候选"""
+        recommendations = []
+        for c in candidates[:10]:
+            recommendations.append({
+                "book": c["book"],
+                "score": c["score"],
+                "reason": f"根据您的兴趣为您推荐。",
+                "tags": [c.get("source_type", "推荐")],
+                "category_name": c.get("category_name"),
+                "author": c.get("author")
+            })
+        return recommendations
+
     def _apply_diversity(
         self, 
         user_id: int,
@@ -411,6 +458,11 @@ class RecommendationService:
             result = self.diversity_service.mmr_rerank(
                 candidates, [], limit, settings.MMR_LAMBDA
             )
+        elif mode == "dpp":
+            # DPP快速贪心MAP推断
+            result = self.diversity_service.dpp_rerank(
+                candidates, limit, settings.DPP_THETA
+            )
         else:
             result = candidates
         
@@ -421,12 +473,14 @@ class RecommendationService:
                 "book": r["book"],
                 "score": r["score"],
                 "reason": r["reason"],
-                "tags": r.get("tags", [])
+                "tags": r.get("tags", []),
+                "category_name": r.get("category_name"),
+                "author": r.get("author")
             })
         
         return final
 
-    def _get_popular_fallback(self, seen_books: set, limit: int) -> List[Dict[str, Any]]:
+    def _get_popular_fallback(self, seen_books: ExclusionBitmap, limit: int) -> List[Dict[str, Any]]:
         """热门书籍兜底"""
         recommendations = []
         
@@ -434,38 +488,123 @@ class RecommendationService:
         # 1. 封面URL以/static/开头（真实书籍）
         # 2. 或者书籍ID小于1000（假设测试数据ID较大）
         # 3. 并且有真实评分记录
-        popular_books = self.db.query(Book).filter(
+        query = self.db.query(Book).filter(
             # 过滤掉明显的测试数据
             (Book.cover_url.like('/static/%')) | (Book.id < 1000)
         ).order_by(
             Book.average_rating.desc()
-        ).limit(limit * 3 + len(seen_books)).all()
+        )
         
-        for book in popular_books:
-            if book.id not in seen_books and len(recommendations) < limit:
-                # 额外检查：排除明显的假数据（标题太短或像测试数据）
-                if book.title and len(book.title) > 3 and not book.title in ['Prof.', 'Mrs.', 'Miss.', 'Mr.', 'Dr.']:
-                    recommendations.append({
-                        "book": book,
-                        "score": 0.5,
-                        "reason": "为您推荐当前热门的高评分书籍。",
-                        "tags": ["热门精选"]
-                    })
-                    seen_books.add(book.id)
+        # 已看过的书籍用排除位图过滤；一页不够时继续翻页（最多 EXCLUSION_FETCH_MAX 行）
+        page_size = limit * 3 + min(len(seen_books), settings.EXCLUSION_OVERFETCH_MAX)
+        offset = 0
+        while len(recommendations) < limit and offset < settings.EXCLUSION_FETCH_MAX:
+            popular_books = query.offset(offset).limit(page_size).all()
+            
+            for book in popular_books:
+                if book.id not in seen_books and len(recommendations) < limit:
+                    # 额外检查：排除明显的假数据（标题太短或像测试数据）
+                    if book.title and len(book.title) > 3 and not book.title in ['Prof.', 'Mrs.', 'Miss.', 'Mr.', 'Dr.']:
+                        recommendations.append({
+                            "book": book,
+                            "score": 0.5,
+                            "reason": "为您推荐当前热门的高评分书籍。",
+                            "tags": ["热门精选"]
+                        })
+                        seen_books.add(book.id)
+            
+            if len(popular_books) < page_size:
+                break
+            offset += page_size
         
         return recommendations
 
+    def _build_backup_pool(
+        self,
+        selected: List[Dict],
+        ranked: List[Dict],
+        graph_candidates: List[Dict],
+        seen_books: ExclusionBitmap
+    ) -> List[Dict[str, Any]]:
+        """
+        构建备选候选池
+        
+        依次取未入选的重排序结果、未经LLM重排的图谱候选和热门书籍，
+        直到缓存池达到 CACHE_POOL_SIZE
+        """
+        room = settings.CACHE_POOL_SIZE - len(selected)
+        if room <= 0:
+            return []
+        
+        backups = []
+        used_ids = {r["book"].id for r in selected}
+        
+        for r in ranked:
+            if len(backups) >= room:
+                break
+            if r["book"].id not in used_ids:
+                backups.append(r)
+                used_ids.add(r["book"].id)
+        
+        for c in graph_candidates:
+            if len(backups) >= room:
+                break
+            if c["book"].id not in used_ids:
+                backups.append({
+                    "book": c["book"],
+                    "score": c["score"],
+                    "reason": "根据您的兴趣为您推荐。",
+                    "tags": [c.get("source_type", "推荐")],
+                    "category_name": c.get("category_name"),
+                    "author": c.get("author")
+                })
+                used_ids.add(c["book"].id)
+        
+        if len(backups) < room:
+            backups.extend(self._get_popular_fallback(seen_books | used_ids, room - len(backups)))
+        
+        return backups
+
+    def _to_cache_entry(self, rec: Dict[str, Any]) -> Dict[str, Any]:
+        """转换为缓存条目"""
+        book = rec["book"]
+        tags = rec.get("tags", [])
+        return {
+            "book_id": book.id,
+            "score": rec["score"],
+            "reason": rec["reason"],
+            "tags": tags,
+            # 读时过滤需要类别和作者
+            "category_name": rec.get("category_name") or (book.category.name if book.category else None),
+            "author": rec.get("author") or book.author,
+            # 搜索关联条目单独成段，搜索后只替换该段
+            "segment": SEGMENT_SEARCH if SEARCH_TAG in tags else SEGMENT_MAIN
+        }
+
+    def refresh_search_segment(self, user_id: int, limit: int = None) -> bool:
+        """
+        搜索后只重算缓存中的搜索关联片段
+        
+        图谱 + LLM 片段保持不变；没有缓存时不做处理，下次请求会全量计算
+        
+        Returns:
+            是否更新了缓存
+        """
+        cached = self.cache_service.get_recommendations(user_id)
+        if not cached:
+            return False
+        
+        limit = limit or settings.RECOMMENDATION_LIMIT
+        seen_books = self.exclusion_service.get_exclusions(user_id)
+        
+        search_recs = self._get_search_based_recommendations(user_id, seen_books, limit)
+        entries = [self._to_cache_entry(r) for r in search_recs]
+        return self.cache_service.replace_segment(user_id, SEGMENT_SEARCH, entries)
+
     def _save_to_cache(self, user_id: int, recommendations: List[Dict]):
         """保存到缓存"""
         try:
-            cache_data = []
-            for rec in recommendations:
-                cache_data.append({
-                    "book_id": rec["book"].id,
-                    "score": rec["score"],
-                    "reason": rec["reason"],
-                    "tags": rec.get("tags", [])
-                })
+            cache_data = [self._to_cache_entry(rec) for rec in recommendations]
             
             self.cache_service.set_recommendations(user_id, cache_data)
             print(f"DEBUG: Saved {len(cache_data)} recommendations to cache for user_id={user_id}")
@@ -476,28 +615,7 @@ class RecommendationService:
     def _update_recommendation_history(self, user_id: int, recommendations: List[Dict]):
         """更新推荐历史（用于滑动窗口去重）"""
         try:
-            book_ids = [r["book"].id for r in recommendations]
-            
-            history = self.db.query(RecommendationHistory).filter(
-                RecommendationHistory.user_id == user_id
-            ).first()
-            
-            if history:
-                existing = json.loads(history.recommended_books)
-                # 保持窗口大小
-                combined = existing + book_ids
-                history.recommended_books = json.dumps(combined[-history.window_size:])
-                history.updated_at = datetime.now()
-            else:
-                history = RecommendationHistory(
-                    user_id=user_id,
-                    recommended_books=json.dumps(book_ids),
-                    window_size=50
-                )
-                self.db.add(history)
-            
-            self.db.commit()
-            
+            self.history_service.append(user_id, recommendations)
         except Exception as e:
             print(f"DEBUG: Failed to update recommendation history: {e}")
 
@@ -1,37 +1,241 @@
 """
 异步推荐计算Worker
-订阅Redis事件，接收缓存失效事件后异步重新计算推荐
+以Redis Stream消费者组方式消费缓存失效事件，处理成功后确认（至少一次处理），
+消费者崩溃后其未确认的事件由其他消费者接管；
+每个优先级一个Stream，按权重轮询读取，等待过久的低优先级队列逐步提升权重，避免饥饿；
+低影响事件只重算受影响书籍的分数并融合进缓存列表，搜索事件只刷新搜索片段，其余事件全量重算
 """
+import hashlib
 import json
 import threading
 import time
-from typing import Optional, Callable
-from datetime import datetime
+from typing import Optional, Callable, Dict, List, Tuple
 
 from app.core.cache import redis_cache
+from app.core.config import settings
+from app.core.metrics import metrics, LAG_BUCKETS
 from app.core.database import SessionLocal, neo4j_conn
-from app.services.event_service import CHANNEL_CACHE_INVALIDATION, CHANNEL_RECOMMENDATION_UPDATE
+from app.services.event_service import (
+    CHANNEL_CACHE_INVALIDATION, PRIORITY_LEVELS, EventRef, event_service, consumer_name, entry_age
+)
 from app.services.cache_service import CacheService
+from app.services.incremental_update_service import IncrementalUpdateService
+from app.services.recommendation import RecommendationService
+from app.services.blacklist_service import blacklist_service, blacklist_watcher, ensure_blacklists_loaded
+from app.services.worker_stats_service import refresh_queue_gauges
+
+
+# 检查并接管其他消费者遗留事件的间隔（秒）
+CLAIM_CHECK_INTERVAL = 30
+# 队列深度指标的刷新间隔（秒）
+DEPTH_REPORT_INTERVAL = 5
+# 可以增量修补缓存列表的事件类型（负反馈等需要全量重算）
+INCREMENTAL_EVENT_TYPES = ("click", "collect", "rating")
+# 只需刷新缓存中搜索关联片段的事件类型（与其他事件合并时，增量更新后再刷新该片段）
+SEGMENT_EVENT_TYPES = ("search",)
+# Pub/Sub转发去重的有效期（秒）：多个Worker副本都会收到同一条消息，只由一个转写入Stream
+BRIDGE_DEDUPE_TTL = 30
+
+
+def run_exclusive(user_id: int, process: Callable[[], bool]) -> Optional[bool]:
+    """
+    持有用户锁执行重算，保证同一用户不会被两个Worker同时计算
+    
+    Returns:
+        process 的返回值；锁被其他线程/进程持有时返回None
+    """
+    lock_key = redis_cache.user_lock_key(user_id)
+    token = redis_cache.acquire_lock(lock_key, settings.WORKER_USER_LOCK_TTL)
+    if not token:
+        return None
+    try:
+        return process()
+    finally:
+        redis_cache.release_lock(lock_key, token)
+
+
+def handle_queued_event(event: dict, process: Callable[[dict], bool]) -> str:
+    """
+    处理一个读到的事件：去重 -> 用户锁 -> 重算
+    
+    Returns:
+        processed / failed / deduplicated / requeued / skipped，
+        除 failed 外都可以确认（failed 的事件留在待确认列表中等待重新投递）
+    """
+    user_id = event.get("user_id")
+    if not user_id:
+        return "skipped"
+    
+    if not event_service.claim_event(event):
+        print(f"Skipped stale event for user_id={user_id}")
+        return "deduplicated"
+    
+    result = run_exclusive(user_id, lambda: process(event))
+    if result is not None:
+        return "processed" if result else "failed"
+    
+    # 该用户正被其他Worker计算，重新写入Stream稍后重试（不在消费线程中等待，
+    # 重新入队的消息排在已积压的事件之后，自然形成延迟；期间已有新事件入队时由新事件触发）
+    event_service.requeue_event(event)
+    return "requeued"
+
+
+class PriorityScheduler:
+    """
+    多优先级加权公平调度
+    
+    每轮按各优先级的有效权重分配读取数量（加权轮询）；
+    某优先级最早的待处理消息每多等待 aging 秒，其权重加1（不超过最高权重），
+    低优先级积压时不会被高优先级事件无限期饿死
+    """
+    
+    def __init__(self, weights: Dict[int, int] = None, aging: float = None):
+        self.weights = dict(weights or settings.WORKER_PRIORITY_WEIGHTS)
+        self.aging = settings.WORKER_PRIORITY_AGING if aging is None else aging
+        self._lock = threading.Lock()
+        self._lag: Dict[int, float] = {}  # 优先级 -> 最近一次读到的最早消息的等待时长
+    
+    def effective_weight(self, level: int) -> int:
+        """当前有效权重 = 基础权重 + 等待时长 / aging"""
+        base = self.weights.get(level, 1)
+        with self._lock:
+            lag = self._lag.get(level, 0.0)
+        boost = int(lag / self.aging) if self.aging > 0 else 0
+        return min(base + boost, max(self.weights.values(), default=base))
+    
+    def plan(self, batch_size: int) -> List[Tuple[int, int]]:
+        """
+        本轮各优先级的读取数量
+        
+        Returns:
+            [(优先级, 数量), ...]，按有效权重从高到低（权重相同时优先级高的在前）
+        """
+        weights = {level: self.effective_weight(level) for level in PRIORITY_LEVELS}
+        total = sum(weights.values()) or 1
+        order = sorted(PRIORITY_LEVELS, key=lambda level: (weights[level], level), reverse=True)
+        return [(level, max(1, round(batch_size * weights[level] / total))) for level in order]
+    
+    def observe(self, level: int, entries: List[Tuple[EventRef, dict]]):
+        """
+        记录一次读取结果（只用于本线程的权重提升）：读空说明该优先级没有未投递的积压
+        
+        队列整体的最早待处理时长由 EventService.get_queue_status 在服务端计算
+        """
+        lag = max((entry_age(entry_id) for (_, entry_id), _ in entries), default=0.0)
+        with self._lock:
+            self._lag[level] = lag
+
+
+class EventCoalescer:
+    """
+    按用户合并短时间内到达的事件
+    
+    同一用户的事件在窗口期内合并为一个：事件类型和书籍ID取并集，优先级取最高；
+    收到优先级3的事件时立即结束该用户的窗口
+    """
+    
+    def __init__(self, window: float = None):
+        self.window = settings.WORKER_COALESCE_WINDOW if window is None else window
+        self._lock = threading.Lock()
+        self._pending: Dict[int, dict] = {}  # user_id -> {"event", "entry_ids", "deadline"}
+    
+    def add(self, entry_id: EventRef, event: dict):
+        """加入一个事件"""
+        metrics.inc("worker_events_in_total", {"event_type": event.get("event_type") or "unknown"})
+        user_id = event.get("user_id")
+        now = time.monotonic()
+        
+        with self._lock:
+            slot = self._pending.get(user_id)
+            if slot is None:
+                slot = self._pending[user_id] = {
+                    "event": self._start(event),
+                    "entry_ids": [],
+                    "deadline": now + self.window
+                }
+            else:
+                self._merge(slot["event"], event)
+            slot["entry_ids"].append(entry_id)
+            if (event.get("priority") or 1) >= 3:
+                slot["deadline"] = now
+    
+    def pop_due(self, force: bool = False) -> List[Tuple[List[EventRef], dict]]:
+        """
+        取出窗口已结束的合并事件
+        
+        Args:
+            force: 忽略窗口，取出全部（停止时排空）
+        
+        Returns:
+            [(消息引用列表, 合并后的事件), ...]，优先级高的在前
+        """
+        now = time.monotonic()
+        with self._lock:
+            due = [u for u, slot in self._pending.items() if force or slot["deadline"] <= now]
+            slots = [self._pending.pop(u) for u in due]
+        slots.sort(key=lambda slot: slot["event"].get("priority") or 1, reverse=True)
+        return [(slot["entry_ids"], slot["event"]) for slot in slots]
+    
+    def seconds_until_due(self) -> Optional[float]:
+        """距最早一个窗口结束的秒数，没有待合并事件时返回None"""
+        with self._lock:
+            if not self._pending:
+                return None
+            earliest = min(slot["deadline"] for slot in self._pending.values())
+        return max(earliest - time.monotonic(), 0.0)
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending)
+    
+    @staticmethod
+    def _parts(event: dict) -> Tuple[list, list, list]:
+        """事件的类型、书籍ID和事件ID列表（重新入队的合并事件已带有合并后的列表）"""
+        event_types = event.get("event_types") or [event.get("event_type")]
+        book_ids = event.get("book_ids") or ([event["book_id"]] if event.get("book_id") else [])
+        event_ids = event.get("event_ids") or ([event["event_id"]] if event.get("event_id") else [])
+        return list(event_types), list(book_ids), list(event_ids)
+    
+    @classmethod
+    def _start(cls, event: dict) -> dict:
+        merged = dict(event)
+        merged["event_types"], merged["book_ids"], merged["event_ids"] = cls._parts(event)
+        merged["coalesced"] = event.get("coalesced") or 1
+        return merged
+    
+    @classmethod
+    def _merge(cls, merged: dict, event: dict):
+        event_types, book_ids, event_ids = cls._parts(event)
+        for event_type in event_types:
+            if event_type not in merged["event_types"]:
+                merged["event_types"].append(event_type)
+        for book_id in book_ids:
+            if book_id not in merged["book_ids"]:
+                merged["book_ids"].append(book_id)
+        if event.get("book_id"):
+            merged["book_id"] = event["book_id"]
+        merged["event_ids"].extend(event_ids)
+        if event.get("event_id"):
+            merged["event_id"] = event["event_id"]
+        # 主事件类型取优先级最高的事件
+        if (event.get("priority") or 1) > (merged.get("priority") or 1):
+            merged["priority"] = event["priority"]
+            merged["event_type"] = event.get("event_type")
+        merged["coalesced"] += event.get("coalesced") or 1
 
 
 class RecommendationWorker:
-    """推荐计算Worker"""
+    """
+    Pub/Sub转发Worker
+    兼容仍向 cache:invalidation 频道 PUBLISH 的发布方：收到的事件转写入Stream，由QueueWorker处理；
+    多个副本同时订阅时按消息内容去重，同一条消息只转写一次
+    """
     
     def __init__(self):
         self.cache = redis_cache
         self.running = False
         self._thread: Optional[threading.Thread] = None
         self._pubsub = None
-        self._recommendation_func: Optional[Callable] = None
-    
-    def set_recommendation_function(self, func: Callable):
-        """
-        设置推荐计算函数
-        
-        Args:
-            func: 接收user_id，返回推荐列表的函数
-        """
-        self._recommendation_func = func
     
     def start(self):
         """启动Worker（后台线程）"""
@@ -67,7 +271,7 @@ class RecommendationWorker:
                 
                 if message["type"] == "message":
                     self._handle_message(message)
-                    
+        
         except Exception as e:
             print(f"Worker error: {e}")
         finally:
@@ -75,186 +279,189 @@ class RecommendationWorker:
                 self._pubsub.close()
     
     def _handle_message(self, message: dict):
-        """处理收到的消息"""
+        """处理收到的消息：转写入Stream"""
         try:
             data = message.get("data", "{}")
             if isinstance(data, bytes):
                 data = data.decode("utf-8")
             
             event = json.loads(data)
+            print(f"Worker received event: user_id={event.get('user_id')}, type={event.get('event_type')}")
             
-            user_id = event.get("user_id")
-            event_type = event.get("event_type")
-            priority = event.get("priority", 1)
+            digest = hashlib.sha1(data.encode("utf-8")).hexdigest()
+            if not self.cache.set_nx(f"event:bridged:{digest}", "1", BRIDGE_DEDUPE_TTL):
+                metrics.inc("worker_bridge_deduplicated_total")
+                return  # 其他副本已转写
             
-            print(f"Worker received event: user_id={user_id}, type={event_type}, priority={priority}")
-            
-            # 根据优先级决定处理方式
-            if priority >= 3:
-                # 高优先级，立即处理
-                self._process_event(event)
-            else:
-                # 普通优先级，加入队列
-                self._enqueue_event(event)
-                
+            if not event_service.push_to_queue(event):
+                print(f"Enqueue error: user_id={event.get('user_id')}")
+        
         except json.JSONDecodeError as e:
             print(f"Invalid message format: {e}")
         except Exception as e:
             print(f"Message handling error: {e}")
-    
-    def _process_event(self, event: dict):
-        """处理单个事件"""
-        user_id = event.get("user_id")
-        
-        if not user_id:
-            return
-        
-        try:
-            # 创建数据库会话
-            db = SessionLocal()
-            neo4j = neo4j_conn.get_session()
-            
-            try:
-                cache_service = CacheService(db)
-                
-                # 如果有推荐计算函数，则重新计算
-                if self._recommendation_func:
-                    print(f"Recomputing recommendations for user_id={user_id}")
-                    recommendations = self._recommendation_func(user_id, db, neo4j)
-                    
-                    if recommendations:
-                        # 转换为缓存格式
-                        cache_data = self._convert_to_cache_format(recommendations)
-                        cache_service.set_recommendations(user_id, cache_data)
-                        print(f"Cache updated for user_id={user_id}")
-                else:
-                    # 没有计算函数，只标记缓存失效
-                    cache_service.invalidate_user_cache(user_id)
-                    
-            finally:
-                db.close()
-                neo4j.close()
-                
-        except Exception as e:
-            print(f"Event processing error for user_id={user_id}: {e}")
-    
-    def _enqueue_event(self, event: dict):
-        """将事件加入队列"""
-        try:
-            queue_key = f"queue:{CHANNEL_CACHE_INVALIDATION}"
-            self.cache.rpush(queue_key, json.dumps(event))
-        except Exception as e:
-            print(f"Enqueue error: {e}")
-    
-    def _convert_to_cache_format(self, recommendations: list) -> list:
-        """将推荐结果转换为缓存格式"""
-        cache_data = []
-        for rec in recommendations:
-            if hasattr(rec, "get"):
-                # 已经是字典
-                cache_data.append(rec)
-            elif hasattr(rec, "book"):
-                # 是推荐对象
-                cache_data.append({
-                    "book_id": rec["book"].id if hasattr(rec["book"], "id") else rec["book"]["id"],
-                    "score": rec.get("score", 0),
-                    "reason": rec.get("reason", ""),
-                    "tags": rec.get("tags", [])
-                })
-        return cache_data
-    
-    def process_queue(self, batch_size: int = 10):
-        """
-        处理队列中的事件（手动调用）
-        
-        Args:
-            batch_size: 每次处理的事件数量
-        """
-        queue_key = f"queue:{CHANNEL_CACHE_INVALIDATION}"
-        processed = 0
-        
-        while processed < batch_size:
-            event_str = self.cache.rpop(queue_key)
-            if not event_str:
-                break
-            
-            try:
-                event = json.loads(event_str)
-                self._process_event(event)
-                processed += 1
-            except Exception as e:
-                print(f"Queue processing error: {e}")
-        
-        return processed
 
 
 class QueueWorker:
     """
-    队列Worker（轮询模式）
-    适用于不支持Pub/Sub或需要更可靠处理的场景
+    队列Worker（Redis Stream消费者组）
+    
+    多个线程并发消费：每个线程是消费者组中的一个消费者，按优先级调度读取各级Stream，
+    读到的事件先按用户合并，窗口结束后一次重算，成功后确认合并进来的全部消息；
+    同一用户只处理最新的待处理事件，并用Redis用户锁保证同一用户同一时刻只有一个线程/进程在计算
     """
     
     def __init__(self):
         self.cache = redis_cache
         self.running = False
-        self._thread: Optional[threading.Thread] = None
+        self._threads: List[threading.Thread] = []
         self._recommendation_func: Optional[Callable] = None
+        self.coalescer = EventCoalescer()
+        self.scheduler = PriorityScheduler()
+        self._depth_lock = threading.Lock()
+        self._last_depth_report = 0.0
     
     def set_recommendation_function(self, func: Callable):
-        """设置推荐计算函数"""
+        """
+        设置推荐计算函数 func(user_id, db, neo4j)
+        
+        返回推荐列表时由Worker写入缓存；函数自行写入缓存时返回None
+        """
         self._recommendation_func = func
     
-    def start(self, poll_interval: float = 1.0):
+    def start(self, poll_interval: float = 1.0, concurrency: int = None):
         """
         启动Worker
         
         Args:
-            poll_interval: 轮询间隔（秒）
+            poll_interval: 单次阻塞读取的最长等待时间（秒）
+            concurrency: 消费线程数，默认取配置 WORKER_CONCURRENCY
         """
         if self.running:
             print("Queue Worker is already running")
             return
         
+        event_service.ensure_consumer_group()
+        
         self.running = True
-        self._thread = threading.Thread(
-            target=self._run, 
-            args=(poll_interval,),
-            daemon=True
-        )
-        self._thread.start()
-        print("Queue Worker started")
+        concurrency = concurrency or settings.WORKER_CONCURRENCY
+        self._threads = [
+            threading.Thread(
+                target=self._run,
+                args=(poll_interval, consumer_name(str(i))),
+                name=f"queue-worker-{i}",
+                daemon=True
+            )
+            for i in range(concurrency)
+        ]
+        for thread in self._threads:
+            thread.start()
+        print(f"Queue Worker started with {concurrency} threads")
     
-    def stop(self):
-        """停止Worker"""
+    def stop(self, timeout: float = 5):
+        """
+        停止Worker（处理完已读取但仍在合并窗口中的事件）
+        
+        Args:
+            timeout: 每个线程完成当前重算的最长等待时间（秒）
+        """
         self.running = False
-        if self._thread:
-            self._thread.join(timeout=5)
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+        self._flush(self.coalescer.pop_due(force=True))
         print("Queue Worker stopped")
     
-    def _run(self, poll_interval: float):
+    def _run(self, poll_interval: float, consumer: str):
         """Worker主循环"""
-        queue_key = f"queue:{CHANNEL_CACHE_INVALIDATION}"
+        last_claim = 0.0
         
         while self.running:
             try:
-                # 阻塞式弹出（带超时）
-                result = self.cache.brpop([queue_key], timeout=int(poll_interval))
+                # 定期接管崩溃消费者遗留的未确认事件
+                if time.time() - last_claim >= CLAIM_CHECK_INTERVAL:
+                    last_claim = time.time()
+                    for ref, event in event_service.claim_stale_events(
+                        consumer, settings.EVENT_STREAM_CLAIM_IDLE * 1000, settings.WORKER_BATCH_SIZE
+                    ):
+                        self._enqueue(ref, event)
                 
-                if result:
-                    _, event_str = result
-                    event = json.loads(event_str)
-                    self._process_event(event)
-                    
+                # 按权重依次非阻塞读取各优先级
+                received = 0
+                for level, count in self.scheduler.plan(settings.WORKER_BATCH_SIZE):
+                    entries = event_service.read_events(consumer, count, block_ms=None, levels=(level,))
+                    self.scheduler.observe(level, entries)
+                    for ref, event in entries:
+                        self._enqueue(ref, event)
+                    received += len(entries)
+                
+                # 各级都为空时阻塞等待任一优先级的新事件，最长等到下一个合并窗口结束
+                if not received:
+                    wait = self.coalescer.seconds_until_due()
+                    block = poll_interval if wait is None else min(poll_interval, wait)
+                    for ref, event in event_service.read_events(
+                        consumer, settings.WORKER_BATCH_SIZE, max(int(block * 1000), 1)
+                    ):
+                        self._enqueue(ref, event)
+                
+                self._flush(self.coalescer.pop_due())
+                self._report_queue_depths()
+            
             except Exception as e:
                 print(f"Queue Worker error: {e}")
                 time.sleep(poll_interval)
     
-    def _process_event(self, event: dict):
-        """处理事件"""
+    def _enqueue(self, ref: EventRef, event: dict):
+        """记录出队延迟（消息写入到被读取的时长）后加入合并窗口"""
+        level, entry_id = ref
+        metrics.observe("worker_event_lag_seconds", entry_age(entry_id), {"priority": str(level)}, LAG_BUCKETS)
+        self.coalescer.add(ref, event)
+    
+    def _report_queue_depths(self):
+        """定期更新各优先级的队列深度和最早待处理时长指标（多个线程共享，间隔内只查询一次）"""
+        with self._depth_lock:
+            if time.time() - self._last_depth_report < DEPTH_REPORT_INTERVAL:
+                return
+            self._last_depth_report = time.time()
+        refresh_queue_gauges()
+    
+    def _flush(self, batches: List[Tuple[List[EventRef], dict]]) -> int:
+        """处理合并后的事件，成功后确认其包含的全部消息"""
+        acked = 0
+        for entry_ids, event in batches:
+            event_type = event.get("event_type") or "unknown"
+            started = time.perf_counter()
+            status = handle_queued_event(event, self._process_event)
+            metrics.inc("worker_recomputes_total", {"outcome": status, "event_type": event_type})
+            if status in ("processed", "failed"):
+                metrics.observe("worker_recompute_seconds", time.perf_counter() - started, {"event_type": event_type})
+            if len(entry_ids) > 1:
+                metrics.inc("worker_events_coalesced_total", amount=len(entry_ids) - 1)
+            if status != "failed":
+                event_service.ack_events(*entry_ids)
+                acked += len(entry_ids)
+        return acked
+    
+    def process_queue(self, batch_size: int = 10) -> int:
+        """
+        处理队列中的事件（手动调用，不阻塞，不等待合并窗口）
+        
+        Args:
+            batch_size: 每次读取的事件数量
+        """
+        event_service.ensure_consumer_group()
+        consumer = consumer_name("manual")
+        for level, count in self.scheduler.plan(batch_size):
+            for ref, event in event_service.read_events(consumer, count, block_ms=None, levels=(level,)):
+                self._enqueue(ref, event)
+        return self._flush(self.coalescer.pop_due(force=True))
+    
+    def _process_event(self, event: dict) -> bool:
+        """处理事件，返回是否成功"""
         user_id = event.get("user_id")
         
         if not user_id:
-            return
+            return True
         
         try:
             db = SessionLocal()
@@ -262,32 +469,112 @@ class QueueWorker:
             
             try:
                 cache_service = CacheService(db)
+                started = time.perf_counter()
                 
-                if self._recommendation_func:
+                if self._is_segment_only(event):
+                    # 搜索片段刷新，没有缓存时下次请求会全量计算
+                    mode = "incremental"
+                    RecommendationService(db, neo4j).refresh_search_segment(user_id)
+                elif self._try_incremental(event, db, neo4j, cache_service):
+                    mode = "incremental"
+                    if any(t in SEGMENT_EVENT_TYPES for t in self._event_types(event)):
+                        RecommendationService(db, neo4j).refresh_search_segment(user_id)
+                elif self._recommendation_func:
+                    mode = "full"
                     print(f"Queue Worker: Recomputing for user_id={user_id}")
                     recommendations = self._recommendation_func(user_id, db, neo4j)
                     
                     if recommendations:
-                        cache_data = []
-                        for rec in recommendations:
-                            if isinstance(rec, dict) and "book" in rec:
-                                book = rec["book"]
-                                cache_data.append({
-                                    "book_id": book.id if hasattr(book, "id") else book.get("id"),
-                                    "score": rec.get("score", 0),
-                                    "reason": rec.get("reason", ""),
-                                    "tags": rec.get("tags", [])
-                                })
+                        # 与在线计算写入相同的缓存条目（含读时过滤所需的类别、作者和分段）
+                        recommender = RecommendationService(db, neo4j)
+                        cache_data = [
+                            recommender._to_cache_entry(rec)
+                            for rec in recommendations
+                            if isinstance(rec, dict) and "book" in rec
+                        ]
                         cache_service.set_recommendations(user_id, cache_data)
                 else:
+                    mode = "invalidate"
                     cache_service.invalidate_user_cache(user_id)
-                    
+                
+                metrics.inc("worker_updates_total", {"mode": mode})
+                metrics.observe("worker_update_seconds", time.perf_counter() - started, {"mode": mode})
+            
             finally:
                 db.close()
                 neo4j.close()
-                
+            
+            return True
+        
         except Exception as e:
             print(f"Queue Worker processing error: {e}")
+            return False
+    
+    
+    @staticmethod
+    def _event_types(event: dict) -> List[str]:
+        """合并后的事件（含认领时继承的被取代事件）包含的全部类型"""
+        return event.get("event_types") or [event.get("event_type")]
+    
+    def _is_segment_only(self, event: dict) -> bool:
+        """合并后的事件是否只包含搜索事件"""
+        return all(t in SEGMENT_EVENT_TYPES for t in self._event_types(event))
+    
+    def _try_incremental(self, event: dict, db, neo4j, cache_service: CacheService) -> bool:
+        """
+        增量更新：分析事件影响范围，只为缓存列表中受影响的书籍重新计算分数并融合写回
+        （搜索类型不参与判断，由调用方另行刷新搜索片段）
+        
+        Returns:
+            是否已完成增量更新；False 表示需要全量重算
+            （事件类型不支持、没有缓存、读时过滤后缓存池已不足、影响范围过大、缓存过旧或修补后缓存池不足）
+        """
+        user_id = event["user_id"]
+        event_types = [t for t in self._event_types(event) if t not in SEGMENT_EVENT_TYPES]
+        book_ids = event.get("book_ids") or ([event["book_id"]] if event.get("book_id") else [])
+        if not book_ids or not event_types or any(t not in INCREMENTAL_EVENT_TYPES for t in event_types):
+            return False
+        event_type = event.get("event_type") if event.get("event_type") in event_types else event_types[0]
+        
+        try:
+            cached = cache_service.get_recommendations(user_id)
+            if not cached:
+                return False
+            # 同一用户更早的负反馈事件可能已被新事件去重，其要求的全量重算不能被增量修补掩盖
+            exclusions = blacklist_service.get_exclusion_snapshot(user_id)
+            if cache_service.needs_recompute(user_id, exclusions):
+                return False
+            
+            service = IncrementalUpdateService(db, neo4j)
+            affected = set()
+            for book_id in book_ids:
+                impact = service.analyze_impact(user_id, book_id, event_type)
+                if impact["update_scope"] == "full":
+                    return False
+                affected.update(impact["affected_books"])
+            
+            cache_age = cache_service.get_cache_age(user_id)
+            if cache_age is None or not all(
+                service.should_use_incremental(t, len(affected), cache_age) for t in event_types
+            ):
+                return False
+            
+            # 刚交互过的书籍不再推荐
+            pool = [rec for rec in cache_service.filter_excluded(cached, exclusions) if rec.get("book_id") not in book_ids]
+            cached_ids = {rec.get("book_id") for rec in pool}
+            new_scores = service.score_books(user_id, [b for b in affected if b in cached_ids])
+            updated = service.incremental_update(user_id, pool, list(affected), new_scores)
+            if len(updated) < cache_service.pool_threshold():
+                return False
+            
+            if not cache_service.set_recommendations(user_id, updated, recomputed=False):
+                return False
+            print(f"Queue Worker: Incremental update for user_id={user_id}, rescored {len(new_scores)} books")
+            return True
+        
+        except Exception as e:
+            print(f"Incremental update error: {e}")
+            return False
 
 
 # 全局Worker实例
@@ -295,15 +582,20 @@ recommendation_worker = RecommendationWorker()
 queue_worker = QueueWorker()
 
 
-def start_workers():
+def start_workers(poll_interval: float = 1.0, concurrency: int = None, enable_pubsub: bool = False):
     """启动所有Worker"""
-    # 使用队列Worker作为主要处理方式（更可靠）
-    queue_worker.start()
-    # 可选：同时启动Pub/Sub Worker（用于实时处理高优先级事件）
-    # recommendation_worker.start()
+    # Redis为冷状态时先从MySQL重建黑名单；运行期间Redis被清空时由检测线程重建
+    ensure_blacklists_loaded()
+    blacklist_watcher.start()
+    # 使用队列Worker作为主要处理方式（Stream消费者组，至少一次处理）
+    queue_worker.start(poll_interval=poll_interval, concurrency=concurrency)
+    # 可选：同时启动Pub/Sub转发Worker（兼容仍使用PUBLISH的发布方）
+    if enable_pubsub:
+        recommendation_worker.start()
 
 
-def stop_workers():
+def stop_workers(timeout: float = 5):
     """停止所有Worker"""
     recommendation_worker.stop()
-    queue_worker.stop()
+    queue_worker.stop(timeout=timeout)
+    blacklist_watcher.stop()
@@ -0,0 +1,267 @@
+"""
+书籍相似度服务
+离线构建稀疏的书籍相似度矩阵（同类别、同作者、共同读者），
+用于把用户的负反馈传播到相似书籍：每个用户的惩罚向量 = S · n（一次稀疏矩阵向量乘）
+"""
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional, Any
+import numpy as np
+import scipy.sparse as sp
+from sqlalchemy.orm import Session
+
+from app.core.cache import redis_cache
+from app.core.config import settings
+from app.models.sql import Book, Interaction, Rating, NegativeFeedback
+
+
+# backend 目录，相对路径的矩阵文件以此为基准
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 相似度权重（与多样性服务的相似度定义保持一致）
+CATEGORY_WEIGHT = 0.5
+AUTHOR_WEIGHT = 0.3
+CO_READ_WEIGHT = 0.2
+
+# 惩罚Hash中标记"已计算"的占位字段（用户没有负反馈时也缓存空结果）
+COMPUTED_FIELD = "_computed"
+
+
+class SimilarityService:
+    """书籍相似度服务"""
+    
+    def __init__(self, path: Optional[str] = None):
+        self.cache = redis_cache
+        path = path or settings.SIMILARITY_MATRIX_PATH
+        self.path = path if os.path.isabs(path) else os.path.join(BASE_DIR, path)
+        self._lock = threading.Lock()
+        self._matrix: Optional[sp.csr_matrix] = None
+        self._book_ids: Optional[np.ndarray] = None
+        self._loaded_mtime = 0.0
+    
+    # ==================== 离线构建 ====================
+    
+    def build(self, db: Session, top_k: int = None, chunk_size: int = 512) -> Dict[str, Any]:
+        """
+        构建相似度矩阵并保存为npz
+        
+        把每本书表示为加权特征行 X = [√wc·类别 | √wa·作者 | √wr·读者(L2归一化)]，
+        则 X·Xᵀ 即为加权相似度；按行分块计算，每行只保留 top_k 个邻居
+        
+        Returns:
+            统计信息（书籍数、非零元数量、耗时）
+        """
+        top_k = top_k or settings.SIMILARITY_TOP_K
+        started = time.time()
+        
+        books = db.query(Book.id, Book.category_id, Book.author).order_by(Book.id).all()
+        book_ids = np.array([b.id for b in books], dtype=np.int64)
+        n = len(book_ids)
+        if n == 0:
+            return {"books": 0, "nnz": 0, "elapsed": 0.0}
+        
+        rows = np.arange(n)
+        
+        # 类别 one-hot
+        category_codes = {c: i for i, c in enumerate(sorted({b.category_id for b in books if b.category_id is not None}))}
+        has_cat = np.array([b.category_id is not None for b in books])
+        cat_matrix = sp.csr_matrix(
+            (np.ones(has_cat.sum()), (rows[has_cat], [category_codes[b.category_id] for b in books if b.category_id is not None])),
+            shape=(n, max(len(category_codes), 1))
+        )
+        
+        # 作者 one-hot
+        author_codes = {a: i for i, a in enumerate(sorted({b.author for b in books if b.author}))}
+        has_author = np.array([bool(b.author) for b in books])
+        author_matrix = sp.csr_matrix(
+            (np.ones(has_author.sum()), (rows[has_author], [author_codes[b.author] for b in books if b.author])),
+            shape=(n, max(len(author_codes), 1))
+        )
+        
+        # 共同读者：书籍 × 用户 的交互矩阵（交互或评分），行L2归一化后内积即余弦相似度
+        reads = db.query(Interaction.book_id, Interaction.user_id).distinct().union(
+            db.query(Rating.book_id, Rating.user_id).distinct()
+        ).all()
+        read_matrix = sp.csr_matrix((n, 1))
+        if reads:
+            read_books = np.array([r[0] for r in reads], dtype=np.int64)
+            read_users = np.array([r[1] for r in reads], dtype=np.int64)
+            positions = np.searchsorted(book_ids, read_books)
+            valid = (positions < n) & (book_ids[np.minimum(positions, n - 1)] == read_books)
+            user_codes, user_index = np.unique(read_users[valid], return_inverse=True)
+            read_matrix = sp.csr_matrix(
+                (np.ones(valid.sum()), (positions[valid], user_index)),
+                shape=(n, len(user_codes))
+            )
+            read_matrix.data[:] = 1.0  # 去重后的重复项只计一次
+            norms = np.sqrt(np.asarray(read_matrix.multiply(read_matrix).sum(axis=1)).ravel())
+            norms[norms == 0] = 1.0
+            read_matrix = sp.diags(1.0 / norms) @ read_matrix
+        
+        features = sp.hstack([
+            np.sqrt(CATEGORY_WEIGHT) * cat_matrix,
+            np.sqrt(AUTHOR_WEIGHT) * author_matrix,
+            np.sqrt(CO_READ_WEIGHT) * read_matrix
+        ]).tocsr()
+        features_t = features.T.tocsc()
+        
+        # 分块计算 X·Xᵀ，每行保留 top_k
+        data, indices, indptr = [], [], [0]
+        for start in range(0, n, chunk_size):
+            block = (features[start:start + chunk_size] @ features_t).tocsr()
+            for i in range(block.shape[0]):
+                row_start, row_end = block.indptr[i], block.indptr[i + 1]
+                cols = block.indices[row_start:row_end]
+                vals = block.data[row_start:row_end]
+                keep = cols != start + i  # 去掉自身
+                cols, vals = cols[keep], vals[keep]
+                if len(vals) > top_k:
+                    top = np.argpartition(-vals, top_k - 1)[:top_k]
+                    cols, vals = cols[top], vals[top]
+                order = np.argsort(cols)
+                indices.append(cols[order])
+                data.append(vals[order])
+                indptr.append(indptr[-1] + len(cols))
+        
+        matrix = sp.csr_matrix(
+            (
+                np.concatenate(data) if data else np.array([]),
+                np.concatenate(indices) if indices else np.array([], dtype=np.int32),
+                np.array(indptr)
+            ),
+            shape=(n, n),
+            dtype=np.float32
+        )
+        self.save(matrix, book_ids)
+        
+        return {"books": n, "nnz": int(matrix.nnz), "elapsed": round(time.time() - started, 3)}
+    
+    def save(self, matrix: sp.csr_matrix, book_ids: np.ndarray):
+        """保存矩阵（先写临时文件再替换，避免读到半个文件）"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            data=matrix.data,
+            indices=matrix.indices,
+            indptr=matrix.indptr,
+            shape=np.array(matrix.shape),
+            book_ids=book_ids
+        )
+        os.replace(tmp_path, self.path)
+        with self._lock:
+            self._matrix, self._book_ids = matrix, book_ids
+            self._loaded_mtime = os.path.getmtime(self.path)
+    
+    # ==================== 加载 ====================
+    
+    def _load(self) -> bool:
+        """加载矩阵文件（文件更新后自动重新加载）"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return self._matrix is not None
+        
+        if self._matrix is not None and mtime <= self._loaded_mtime:
+            return True
+        
+        with self._lock:
+            if self._matrix is not None and mtime <= self._loaded_mtime:
+                return True
+            try:
+                with np.load(self.path) as f:
+                    self._matrix = sp.csr_matrix(
+                        (f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"])
+                    )
+                    self._book_ids = f["book_ids"]
+                self._loaded_mtime = mtime
+                print(f"Loaded book similarity matrix: {self._matrix.shape[0]} books, {self._matrix.nnz} entries")
+            except Exception as e:
+                print(f"Load similarity matrix error: {e}")
+        return self._matrix is not None
+    
+    # ==================== 负反馈传播 ====================
+    
+    def compute_user_penalties(self, db: Session, user_id: int) -> Dict[int, float]:
+        """
+        计算用户的相似度惩罚：p = S · n
+        
+        n 为用户负反馈向量（强度/3），p 截断到 [0, 1]
+        
+        Returns:
+            {书籍ID: 惩罚值}，只包含非零项
+        """
+        if not self._load():
+            return {}
+        
+        feedbacks = db.query(NegativeFeedback.book_id, NegativeFeedback.strength).filter(
+            NegativeFeedback.user_id == user_id,
+            NegativeFeedback.is_active == True
+        ).all()
+        if not feedbacks:
+            return {}
+        
+        matrix, book_ids = self._matrix, self._book_ids
+        fb_books = np.array([f.book_id for f in feedbacks], dtype=np.int64)
+        fb_strength = np.array([(f.strength or 0) / 3 for f in feedbacks], dtype=np.float32)
+        positions = np.searchsorted(book_ids, fb_books)
+        valid = (positions < len(book_ids)) & (book_ids[np.minimum(positions, len(book_ids) - 1)] == fb_books)
+        if not valid.any():
+            return {}
+        
+        signal = np.zeros(len(book_ids), dtype=np.float32)
+        np.maximum.at(signal, positions[valid], fb_strength[valid])
+        
+        penalty = np.clip(matrix @ signal, 0.0, 1.0)
+        hit = np.flatnonzero(penalty > 1e-4)
+        return {int(book_ids[i]): round(float(penalty[i]), 4) for i in hit}
+    
+    def get_user_penalties(self, db: Session, user_id: int) -> Dict[int, float]:
+        """获取用户的相似度惩罚（Redis缓存，未命中时计算并写入）"""
+        key = self.cache.similarity_penalty_key(user_id)
+        cached = self.cache.hgetall(key)
+        if cached:
+            return {int(k): float(v) for k, v in cached.items() if k.isdigit()}
+        
+        # 矩阵尚未构建或加载失败时不写缓存，矩阵可用后立即生效
+        if not self._load():
+            return {}
+        
+        try:
+            penalties = self.compute_user_penalties(db, user_id)
+        except Exception as e:
+            print(f"Compute similarity penalties error: {e}")
+            return {}
+        
+        def build(pipe):
+            pipe.delete(key)
+            pipe.hset(key, mapping={COMPUTED_FIELD: 1, **{str(b): p for b, p in penalties.items()}})
+            pipe.expire(key, settings.CACHE_L3_TTL)
+        
+        self.cache.execute_pipeline(build, transaction=True)
+        return penalties
+    
+    def invalidate_user(self, user_id: int):
+        """用户负反馈变化后删除惩罚缓存"""
+        self.cache.delete(self.cache.similarity_penalty_key(user_id))
+    
+    def invalidate_users(self, user_ids: Iterable[int]):
+        """批量删除多个用户的惩罚缓存（一次DEL）"""
+        keys = [self.cache.similarity_penalty_key(user_id) for user_id in set(user_ids)]
+        if keys:
+            self.cache.execute_pipeline(lambda pipe: pipe.delete(*keys))
+    
+    @staticmethod
+    def apply_penalty(score: float, penalty: float) -> float:
+        """按惩罚值降权"""
+        return score * (1 - settings.SIMILARITY_PENALTY_WEIGHT * penalty)
+
+
+# 全局相似度服务实例（矩阵在进程内只加载一份）
+similarity_service = SimilarityService()
+
+
+def get_similarity_service() -> SimilarityService:
+    """获取相似度服务实例"""
+    return similarity_service
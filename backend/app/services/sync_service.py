@@ -1,11 +1,35 @@
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 from sqlalchemy.orm import Session
 from neo4j import Session as Neo4jSession
+from app.core.config import settings
 from app.models.sql import User, Book, Category, Interaction, Rating
 
+# 批量同步时按唯一键MERGE，需要唯一约束（同时提供索引）
+CONSTRAINTS = [
+    "CREATE CONSTRAINT user_id IF NOT EXISTS FOR (u:User) REQUIRE u.id IS UNIQUE",
+    "CREATE CONSTRAINT book_id IF NOT EXISTS FOR (b:Book) REQUIRE b.id IS UNIQUE",
+    "CREATE CONSTRAINT author_name IF NOT EXISTS FOR (a:Author) REQUIRE a.name IS UNIQUE",
+    "CREATE CONSTRAINT category_name IF NOT EXISTS FOR (c:Category) REQUIRE c.name IS UNIQUE",
+]
+
 class SyncService:
     def __init__(self, neo4j_session: Neo4jSession):
         self.neo4j = neo4j_session
 
+    @staticmethod
+    def interaction_rel_type(interaction_type: str) -> str:
+        """交互类型 -> 关系类型（CLICKED, COLLECTED, CART, PURCHASE, INTERACTED）"""
+        rel_type = interaction_type.upper()
+        if rel_type not in ["CLICK", "COLLECT", "CART", "PURCHASE"]:
+            rel_type = "INTERACTED"
+        
+        if rel_type == "CLICK":
+            rel_type = "CLICKED"
+        elif rel_type == "COLLECT":
+            rel_type = "COLLECTED"
+        return rel_type
+
     def sync_user(self, user: User):
         query = """
         MERGE (u:User {id: $id})
@@ -48,14 +72,7 @@ class SyncService:
     def sync_interaction(self, user_id: int, book_id: int, interaction_type: str):
         # interaction_type: click, collect, etc.
         # Map types to relationship types: CLICKED, COLLECTED
-        rel_type = interaction_type.upper()
-        if rel_type not in ["CLICK", "COLLECT", "CART", "PURCHASE"]:
-            rel_type = "INTERACTED"
-        
-        if rel_type == "CLICK":
-            rel_type = "CLICKED"
-        elif rel_type == "COLLECT":
-            rel_type = "COLLECTED"
+        rel_type = self.interaction_rel_type(interaction_type)
             
         query = f"""
         MATCH (u:User {{id: $user_id}})
@@ -74,6 +91,144 @@ class SyncService:
         """
         self.neo4j.run(query, user_id=user_id, book_id=book_id, rating=rating)
 
+    # ==================== 批量同步（UNWIND） ====================
+
+    def ensure_constraints(self):
+        """创建批量MERGE依赖的唯一约束（幂等）"""
+        for statement in CONSTRAINTS:
+            self.neo4j.run(statement).consume()
+
+    def _run_batched(self, label: str, query: str, rows: List[Dict[str, Any]], batch_size: int = None) -> Dict[str, Any]:
+        """
+        按 batch_size 分批执行 UNWIND $rows 查询，每批一个托管写事务（失败时由驱动重试）
+        
+        Returns:
+            统计信息（行数、批数、耗时、每秒行数）
+        """
+        batch_size = batch_size or settings.SYNC_BATCH_SIZE
+        started = time.perf_counter()
+        batches = 0
+        for start in range(0, len(rows), batch_size):
+            chunk = rows[start:start + batch_size]
+            self.neo4j.execute_write(lambda tx: tx.run(query, rows=chunk).consume())
+            batches += 1
+        
+        elapsed = time.perf_counter() - started
+        stats = {
+            "rows": len(rows),
+            "batches": batches,
+            "elapsed": round(elapsed, 3),
+            "rows_per_second": round(len(rows) / elapsed, 1) if elapsed > 0 else 0.0
+        }
+        print(f"Synced {stats['rows']} {label} in {stats['batches']} batches, "
+              f"{stats['elapsed']}s ({stats['rows_per_second']} rows/s)")
+        return stats
+
+    def sync_users(self, users: Iterable[User], batch_size: int = None) -> Dict[str, Any]:
+        """批量同步用户（与 sync_user 相同的属性）"""
+        query = """
+        UNWIND $rows AS row
+        MERGE (u:User {id: row.id})
+        SET u.username = row.username,
+            u.gender = row.gender,
+            u.age = row.age,
+            u.preferred_categories = row.preferred_categories
+        """
+        rows = [{
+            "id": user.id,
+            "username": user.username,
+            "gender": user.gender or "Unknown",
+            "age": user.age or 0,
+            "preferred_categories": user.preferred_categories or ""
+        } for user in users]
+        return self._run_batched("users", query, rows, batch_size)
+
+    def sync_books(
+        self,
+        books: Iterable[Book],
+        category_names: Optional[Dict[int, str]] = None,
+        batch_size: int = None
+    ) -> Dict[str, Any]:
+        """
+        批量同步书籍及其作者、类别关系（与 sync_book 相同的结构）
+        
+        Args:
+            category_names: 类别ID -> 名称，未提供时读取 book.category
+        """
+        query = """
+        UNWIND $rows AS row
+        MERGE (b:Book {id: row.id})
+        SET b.title = row.title, b.isbn = row.isbn, b.description = row.description
+        
+        WITH b, row
+        MERGE (a:Author {name: row.author})
+        MERGE (b)-[:WRITTEN_BY]->(a)
+        
+        WITH b, row
+        MERGE (c:Category {name: row.category_name})
+        MERGE (b)-[:BELONGS_TO]->(c)
+        """
+        rows = []
+        for book in books:
+            if category_names is not None:
+                category_name = category_names.get(book.category_id)
+            else:
+                category_name = book.category.name if book.category else None
+            rows.append({
+                "id": book.id,
+                "title": book.title,
+                "isbn": book.isbn,
+                "description": book.description or "",
+                "author": book.author or "Unknown",
+                "category_name": category_name or "Uncategorized"
+            })
+        return self._run_batched("books", query, rows, batch_size)
+
+    def sync_interactions(self, interactions: Iterable[Tuple[int, int, str]], batch_size: int = None) -> Dict[str, Any]:
+        """
+        批量同步交互 (user_id, book_id, interaction_type)
+        
+        关系类型不能参数化，按关系类型分组后每组一条UNWIND查询
+        """
+        groups: Dict[str, List[Dict[str, int]]] = {}
+        for user_id, book_id, interaction_type in interactions:
+            groups.setdefault(self.interaction_rel_type(interaction_type), []).append(
+                {"user_id": user_id, "book_id": book_id}
+            )
+        
+        started = time.perf_counter()
+        totals = {"rows": 0, "batches": 0}
+        for rel_type, rows in groups.items():
+            query = f"""
+            UNWIND $rows AS row
+            MATCH (u:User {{id: row.user_id}})
+            MATCH (b:Book {{id: row.book_id}})
+            MERGE (u)-[r:{rel_type}]->(b)
+            SET r.timestamp = datetime()
+            """
+            stats = self._run_batched(f"{rel_type} interactions", query, rows, batch_size)
+            for key in totals:
+                totals[key] += stats[key]
+        elapsed = time.perf_counter() - started
+        totals["elapsed"] = round(elapsed, 3)
+        totals["rows_per_second"] = round(totals["rows"] / elapsed, 1) if elapsed > 0 else 0.0
+        return totals
+
+    def sync_ratings(self, ratings: Iterable[Tuple[int, int, int]], batch_size: int = None) -> Dict[str, Any]:
+        """批量同步评分 (user_id, book_id, rating)"""
+        query = """
+        UNWIND $rows AS row
+        MATCH (u:User {id: row.user_id})
+        MATCH (b:Book {id: row.book_id})
+        MERGE (u)-[r:RATED]->(b)
+        SET r.score = row.rating, r.timestamp = datetime()
+        """
+        rows = [
+            {"user_id": user_id, "book_id": book_id, "rating": rating}
+            for user_id, book_id, rating in ratings
+        ]
+        return self._run_batched("ratings", query, rows, batch_size)
+
     def sync_search(self, user_id: int, query_text: str):
         # 1. Create/Merge Keyword node
         # 2. Create SEARCHED relationship
@@ -0,0 +1,261 @@
+"""
+Worker指标服务
+Worker进程定期把本进程的指标快照写入Redis（metrics:worker:{id}），
+API进程汇总所有存活Worker的快照并结合实时队列深度，供管理后台和扩缩容使用
+"""
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+from app.core.cache import redis_cache
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.services.event_service import event_service
+
+
+# 存活Worker的ID集合
+WORKER_REGISTRY_KEY = "metrics:workers"
+# 重算结果分类
+OUTCOMES = ("processed", "failed", "deduplicated", "requeued", "skipped")
+# 缓存更新方式
+UPDATE_MODES = ("incremental", "full", "invalidate")
+
+
+def incremental_savings(updates: Dict[str, float], incremental_seconds: float, full_seconds: float) -> Dict[str, Any]:
+    """
+    增量更新占比和节省的时间
+    
+    节省时间按 增量更新次数 × (全量重算平均耗时 - 增量更新平均耗时) 估算
+    """
+    incremental, full = updates.get("incremental", 0), updates.get("full", 0)
+    saved = 0.0
+    if incremental and full:
+        saved = max(incremental * (full_seconds / full - incremental_seconds / incremental), 0.0)
+    return {
+        "incremental_share": round(incremental / (incremental + full), 4) if incremental + full else 0.0,
+        "time_saved_seconds": round(saved, 3)
+    }
+
+
+def summarize_worker_metrics(snapshot: Dict[str, List[dict]]) -> Dict[str, Any]:
+    """
+    从指标快照（MetricsRegistry.snapshot 的格式）提取Worker摘要
+    
+    Returns:
+        入队事件数、各结果的重算次数、按事件类型的成功/失败数、去重与合并节省的重算次数、
+        重算耗时和出队延迟分布、各优先级最早待处理事件的等待时长
+    """
+    def total(name: str, **labels) -> float:
+        return sum(
+            c["value"] for c in snapshot.get("counters", [])
+            if c["name"] == name and all(c["labels"].get(k) == v for k, v in labels.items())
+        )
+    
+    def histograms(name: str, label: str) -> Dict[str, dict]:
+        return {
+            h["labels"].get(label, ""): {k: v for k, v in h.items() if k not in ("name", "labels")}
+            for h in snapshot.get("histograms", []) if h["name"] == name
+        }
+    
+    def histogram_sum(name: str, **labels) -> float:
+        return sum(
+            h["sum"] for h in snapshot.get("histograms", [])
+            if h["name"] == name and all(h["labels"].get(k) == v for k, v in labels.items())
+        )
+    
+    event_types = sorted({
+        c["labels"].get("event_type") for c in snapshot.get("counters", [])
+        if c["name"] == "worker_recomputes_total" and c["labels"].get("event_type")
+    })
+    events_in = total("worker_events_in_total")
+    recomputes = {outcome: total("worker_recomputes_total", outcome=outcome) for outcome in OUTCOMES}
+    coalesced = total("worker_events_coalesced_total")
+    saved = recomputes["deduplicated"] + coalesced
+    updates = {mode: total("worker_updates_total", mode=mode) for mode in UPDATE_MODES}
+    update_seconds = {mode: histogram_sum("worker_update_seconds", mode=mode) for mode in UPDATE_MODES}
+    
+    return {
+        "events_in": events_in,
+        "recomputes": recomputes,
+        "by_event_type": {
+            event_type: {
+                "processed": total("worker_recomputes_total", outcome="processed", event_type=event_type),
+                "failed": total("worker_recomputes_total", outcome="failed", event_type=event_type)
+            }
+            for event_type in event_types
+        },
+        "savings": {
+            "deduplicated": recomputes["deduplicated"],
+            "coalesced": coalesced,
+            "bridge_deduplicated": total("worker_bridge_deduplicated_total"),
+            "saved_ratio": round(saved / events_in, 4) if events_in else 0.0
+        },
+        "updates": {
+            **updates,
+            "seconds": update_seconds,
+            **incremental_savings(updates, update_seconds["incremental"], update_seconds["full"])
+        },
+        "recompute_seconds": histograms("worker_recompute_seconds", "event_type"),
+        "dequeue_lag_seconds": histograms("worker_event_lag_seconds", "priority"),
+        "oldest_pending_seconds": {
+            g["labels"].get("priority"): g["value"]
+            for g in snapshot.get("gauges", []) if g["name"] == "worker_queue_lag_seconds"
+        }
+    }
+
+
+class WorkerMetricsReporter:
+    """Worker指标快照定期上报线程"""
+    
+    def __init__(self):
+        self.cache = redis_cache
+        self.worker_id: Optional[str] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def start(self, worker_id: str, interval: float = None):
+        """启动上报线程"""
+        if self._thread and self._thread.is_alive():
+            print("Worker Metrics Reporter is already running")
+            return
+        
+        self.worker_id = worker_id
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(interval or settings.WORKER_METRICS_INTERVAL,),
+            daemon=True
+        )
+        self._thread.start()
+        print("Worker Metrics Reporter started")
+    
+    def stop(self):
+        """停止上报线程并移除本Worker的快照"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        if self.worker_id:
+            self.cache.delete(self.cache.worker_metrics_key(self.worker_id))
+            self.cache.srem(WORKER_REGISTRY_KEY, self.worker_id)
+        print("Worker Metrics Reporter stopped")
+    
+    def _run(self, interval: float):
+        while True:
+            self.publish(ttl=int(interval * 3))
+            if self._stop.wait(interval):
+                break
+    
+    def publish(self, ttl: int) -> bool:
+        """写入本Worker的指标快照（过期未刷新视为Worker已下线）"""
+        try:
+            snapshot = metrics.snapshot()
+            ok = self.cache.set_json(self.cache.worker_metrics_key(self.worker_id), {
+                "worker_id": self.worker_id,
+                "updated_at": datetime.now().isoformat(),
+                "summary": summarize_worker_metrics(snapshot),
+                "metrics": snapshot
+            }, ttl)
+            self.cache.sadd(WORKER_REGISTRY_KEY, self.worker_id)
+            return ok
+        except Exception as e:
+            print(f"Worker Metrics Reporter error: {e}")
+            return False
+
+
+# 全局Worker指标上报线程
+worker_metrics_reporter = WorkerMetricsReporter()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Worker进程的Prometheus抓取端点（GET /metrics）"""
+    
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass  # 抓取请求不打印访问日志
+
+
+def serve_metrics(port: int) -> ThreadingHTTPServer:
+    """在后台线程中启动Prometheus抓取端点"""
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Worker metrics listening on :{port}/metrics")
+    return server
+
+
+def refresh_queue_gauges() -> Dict[int, Dict[str, float]]:
+    """从Redis读取各优先级的实时队列深度和最早待处理时长，并更新本进程的仪表盘"""
+    status = event_service.get_queue_status()
+    for level, item in status.items():
+        labels = {"priority": str(level)}
+        metrics.set_gauge("worker_queue_depth", item["depth"], labels)
+        metrics.set_gauge("worker_queue_lag_seconds", item["oldest_pending_seconds"], labels)
+    return status
+
+
+def get_worker_stats(include_workers: bool = True) -> Dict[str, Any]:
+    """
+    汇总所有存活Worker的指标
+    
+    Args:
+        include_workers: 是否附带每个Worker的摘要
+    
+    Returns:
+        实时队列深度、各优先级最早待处理事件的等待时长（从Redis服务端计算，没有存活Worker时同样有效）、
+        计数类指标在所有Worker上的合计，以及各Worker的摘要
+    """
+    workers = []
+    for worker_id in sorted(redis_cache.smembers(WORKER_REGISTRY_KEY)):
+        data = redis_cache.get_json(redis_cache.worker_metrics_key(worker_id))
+        if data is None:
+            redis_cache.srem(WORKER_REGISTRY_KEY, worker_id)  # 快照已过期，Worker已下线
+            continue
+        workers.append({"worker_id": worker_id, "updated_at": data.get("updated_at"), **data["summary"]})
+    
+    queue_status = refresh_queue_gauges()
+    depths = {level: item["depth"] for level, item in queue_status.items()}
+    recomputes = {outcome: sum(w["recomputes"].get(outcome, 0) for w in workers) for outcome in OUTCOMES}
+    events_in = sum(w["events_in"] for w in workers)
+    coalesced = sum(w["savings"]["coalesced"] for w in workers)
+    updates = {mode: sum(w.get("updates", {}).get(mode, 0) for w in workers) for mode in UPDATE_MODES}
+    update_seconds = {
+        mode: sum(w.get("updates", {}).get("seconds", {}).get(mode, 0.0) for w in workers)
+        for mode in UPDATE_MODES
+    }
+    oldest = {str(level): item["oldest_pending_seconds"] for level, item in queue_status.items()}
+    
+    stats = {
+        "workers_alive": len(workers),
+        "queue_depth": {str(level): depth for level, depth in depths.items()},
+        "queue_depth_total": sum(depths.values()),
+        "oldest_pending_seconds": oldest,
+        "max_lag_seconds": max(oldest.values(), default=0),
+        "events_in": events_in,
+        "recomputes": recomputes,
+        "error_ratio": round(recomputes["failed"] / (recomputes["processed"] + recomputes["failed"]), 4)
+        if recomputes["processed"] + recomputes["failed"] else 0.0,
+        "savings": {
+            "deduplicated": recomputes["deduplicated"],
+            "coalesced": coalesced,
+            "saved_ratio": round((recomputes["deduplicated"] + coalesced) / events_in, 4) if events_in else 0.0
+        },
+        "updates": {
+            **updates,
+            **incremental_savings(updates, update_seconds["incremental"], update_seconds["full"])
+        },
+        "generated_at": time.time()
+    }
+    if include_workers:
+        stats["workers"] = workers
+    return stats
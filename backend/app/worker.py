@@ -0,0 +1,87 @@
+"""
+独立的推荐计算Worker进程
+消费缓存失效事件并用 RecommendationService 重算推荐，与API进程分开部署、独立扩容；
+多个副本共用同一消费者组，同一用户由用户锁保证同一时刻只有一个副本在计算
+
+运行方式: python -m app.worker [--concurrency 4] [--poll-interval 1.0] [--coalesce-window 1.0] [--pubsub]
+                               [--metrics-port 9100]
+"""
+import argparse
+import signal
+import sys
+import os
+import threading
+
+# Add backend directory to path to allow running directly
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.config import settings
+from app.services.event_service import consumer_name
+from app.services.neighborhood_service import neighborhood_rebuilder
+from app.services.recommendation import RecommendationService
+from app.services.recommendation_worker import queue_worker, start_workers, stop_workers
+from app.services.worker_stats_service import serve_metrics, worker_metrics_reporter
+
+
+def recompute_recommendations(user_id: int, db, neo4j) -> None:
+    """
+    重算用户推荐（强制刷新）
+    
+    RecommendationService 会把展示列表和备选候选池一起写入缓存，这里不再返回结果，
+    避免Worker用截断后的列表覆盖缓存池；后台预计算不计入推荐历史
+    """
+    RecommendationService(db, neo4j).get_recommendations(
+        user_id,
+        limit=settings.RECOMMENDATION_LIMIT,
+        force_refresh=True,
+        record_history=False
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='推荐计算Worker（可多副本部署）')
+    parser.add_argument('--concurrency', type=int, default=settings.WORKER_CONCURRENCY, help='消费线程数')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='单次阻塞读取的最长等待时间（秒）')
+    parser.add_argument('--coalesce-window', type=float, default=settings.WORKER_COALESCE_WINDOW,
+                        help='同一用户事件的合并窗口（秒）')
+    parser.add_argument('--drain-timeout', type=float, default=30.0,
+                        help='收到停止信号后等待进行中的重算完成的最长时间（秒）')
+    parser.add_argument('--pubsub', action='store_true', help='同时订阅Pub/Sub频道并转写入Stream')
+    parser.add_argument('--metrics-port', type=int, default=settings.WORKER_METRICS_PORT,
+                        help='Prometheus抓取端口（0表示不启动）')
+    args = parser.parse_args()
+    
+    stop_event = threading.Event()
+    
+    def handle_signal(signum, frame):
+        print(f"Received signal {signum}, draining...")
+        stop_event.set()
+    
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    worker_metrics_reporter.start(consumer_name())
+    # 增量更新的影响分析依赖本机的书籍邻域表，定期重建
+    neighborhood_rebuilder.start()
+    
+    queue_worker.coalescer.window = args.coalesce_window
+    queue_worker.set_recommendation_function(recompute_recommendations)
+    start_workers(
+        poll_interval=args.poll_interval,
+        concurrency=args.concurrency,
+        enable_pubsub=args.pubsub
+    )
+    
+    while not stop_event.wait(1):
+        pass
+    # 停止读取新事件，完成进行中的重算并处理合并窗口中剩余的事件；
+    # 未确认的事件在 EVENT_STREAM_CLAIM_IDLE 秒后由其他副本接管
+    stop_workers(timeout=args.drain_timeout)
+    neighborhood_rebuilder.stop()
+    worker_metrics_reporter.stop()
+
+
+if __name__ == "__main__":
+    main()
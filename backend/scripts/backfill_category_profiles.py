@@ -0,0 +1,38 @@
+"""
+用户类别画像回填脚本
+从MySQL交互记录聚合每个用户的类别计数，写入Redis画像Hash
+首次上线或Redis被清空后执行（未回填的用户会在首次请求时按需加载）
+
+运行方式: python scripts/backfill_category_profiles.py [--batch-size 1000]
+"""
+import sys
+import os
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.database import SessionLocal
+from app.services.profile_service import ProfileService
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='回填Redis用户类别画像')
+    parser.add_argument('--batch-size', type=int, default=1000, help='每批写入Redis的用户数')
+    args = parser.parse_args()
+    
+    print("=" * 50)
+    print("用户类别画像回填")
+    print("=" * 50)
+    
+    db = SessionLocal()
+    
+    try:
+        stats = ProfileService(db).rebuild_all(batch_size=args.batch_size)
+        print(f"\n✓ 回填完成: {stats['users']} 个用户, {stats['rows']} 条(用户, 类别)计数, 耗时 {stats['elapsed']} 秒")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""
+书籍邻域表构建脚本
+为每本书预计算同类别、同作者和共同读者邻居（各自截断到配置的上限），
+供增量更新的影响分析直接查表；Worker进程也会按 NEIGHBORHOOD_REBUILD_INTERVAL 定期重建
+
+运行方式: python scripts/build_book_neighborhood.py [--chunk-size 512]
+"""
+import sys
+import os
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.database import SessionLocal
+from app.services.neighborhood_service import neighborhood_service
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='构建书籍邻域表')
+    parser.add_argument('--chunk-size', type=int, default=512, help='分块计算共同读者的行数')
+    args = parser.parse_args()
+    
+    print("=" * 50)
+    print("书籍邻域表构建")
+    print("=" * 50)
+    
+    db = SessionLocal()
+    
+    try:
+        stats = neighborhood_service.build(db, chunk_size=args.chunk_size)
+        neighbors = ", ".join(f"{kind} {count}" for kind, count in stats["neighbors"].items())
+        print(f"\n✓ 构建完成: {stats['books']} 本书, 邻居数 ({neighbors}), 耗时 {stats['elapsed']} 秒")
+        print(f"  保存到: {neighborhood_service.path}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
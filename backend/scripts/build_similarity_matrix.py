@@ -0,0 +1,40 @@
+"""
+书籍相似度矩阵构建脚本
+基于同类别、同作者和共同读者离线构建稀疏相似度矩阵（每本书保留top-k邻居），
+供负反馈向相似书籍传播使用；书籍或交互数据大量变化后重新执行
+
+运行方式: python scripts/build_similarity_matrix.py [--top-k 20]
+"""
+import sys
+import os
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.database import SessionLocal
+from app.services.similarity_service import similarity_service
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='构建书籍相似度矩阵')
+    parser.add_argument('--top-k', type=int, default=None, help='每本书保留的邻居数量')
+    parser.add_argument('--chunk-size', type=int, default=512, help='分块计算的行数')
+    args = parser.parse_args()
+    
+    print("=" * 50)
+    print("书籍相似度矩阵构建")
+    print("=" * 50)
+    
+    db = SessionLocal()
+    
+    try:
+        stats = similarity_service.build(db, top_k=args.top_k, chunk_size=args.chunk_size)
+        print(f"\n✓ 构建完成: {stats['books']} 本书, {stats['nnz']} 个非零元, 耗时 {stats['elapsed']} 秒")
+        print(f"  保存到: {similarity_service.path}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
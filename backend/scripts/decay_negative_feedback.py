@@ -0,0 +1,48 @@
+"""
+负反馈时间衰减任务
+按ID区间分块处理所有用户的有效负反馈：强度衰减后移出黑名单或软删除
+支持断点续跑，建议通过cron每天执行一次
+
+运行方式: python scripts/decay_negative_feedback.py [--lambda 0.1] [--chunk-size 5000] [--restart]
+"""
+import sys
+import os
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.database import SessionLocal
+from app.services.negative_feedback_service import NegativeFeedbackService
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='全局负反馈时间衰减')
+    parser.add_argument('--lambda', dest='decay_lambda', type=float, default=0.1, help='衰减系数（按月）')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='每块处理的行数')
+    parser.add_argument('--restart', action='store_true', help='忽略断点，从头开始')
+    args = parser.parse_args()
+    
+    print("=" * 50)
+    print("负反馈时间衰减任务")
+    print("=" * 50)
+    
+    db = SessionLocal()
+    
+    try:
+        service = NegativeFeedbackService(db)
+        stats = service.apply_global_time_decay(
+            decay_lambda=args.decay_lambda,
+            chunk_size=args.chunk_size,
+            resume=not args.restart
+        )
+        print(f"\n扫描: {stats['scanned']} 条")
+        print(f"移出黑名单: {stats['unblacklisted']} 条")
+        print(f"软删除: {stats['deactivated']} 条")
+        print(f"耗时: {stats['elapsed']} 秒 ({stats['rows_per_second']} 行/秒)")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""
+离线推荐评估脚本
+留出每个用户最近的交互作为测试集，用留出点之前的历史回放 RecommendationService，
+对比不同多样性模式的准确率、召回率、NDCG、目录覆盖率、多样性指标和单用户计算耗时
+
+快照说明：最近交互、最近搜索和已看过集合按留出点截断，排除集合在内存中构建，
+评估过程不写推荐缓存、推荐历史和排除位图；
+图谱中的交互边、Redis中的黑名单和类别画像等没有按时间截断，结果会略偏乐观
+
+运行方式: python scripts/evaluate_offline.py [--modes quota,mmr,dpp,none] [--k 10] [--holdout 2]
+                                           [--as-of 2024-06-01] [--workers 4] [--no-llm] [--output report.json]
+"""
+import sys
+import os
+import json
+import math
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from itertools import groupby
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func
+
+from app.core.database import SessionLocal, engine, neo4j_conn
+from app.models.sql import Book, Interaction, Rating, SearchLog
+from app.services.exclusion_service import ExclusionService, ExclusionBitmap
+from app.services.recommendation import RecommendationService
+
+
+# 一个评估任务：(用户ID, 留出点时间, 留出的书籍ID)
+EvalTask = Tuple[int, datetime, List[int]]
+
+# 汇总的多样性指标
+DIVERSITY_KEYS = ("category_entropy", "author_coverage", "year_diversity", "overall_score")
+
+
+# ==================== 回放用推荐服务 ====================
+
+class HoldoutExclusionService(ExclusionService):
+    """
+    按留出点截断的排除集合
+    
+    只在内存中构建，不读写Redis位图（否则会回填线上位图）；
+    去掉留出的书籍，否则测试集会被当作已看过而过滤掉
+    """
+    
+    def __init__(self, db, cutoff: datetime, holdout: Set[int]):
+        super().__init__(db)
+        self.cutoff = cutoff
+        self.holdout = holdout
+    
+    def get_exclusions(self, user_id: int) -> ExclusionBitmap:
+        interacted = self.db.query(Interaction.book_id).filter(
+            Interaction.user_id == user_id,
+            Interaction.created_at < self.cutoff
+        ).distinct().all()
+        rated = self.db.query(Rating.book_id).filter(
+            Rating.user_id == user_id,
+            Rating.created_at < self.cutoff
+        ).distinct().all()
+        
+        exclusions = ExclusionBitmap()
+        exclusions.update(row.book_id for row in interacted)
+        exclusions.update(row.book_id for row in rated)
+        members = self.cache.smembers(self.cache.blacklist_key(user_id))
+        exclusions.update(int(id) for id in members if id.isdigit())
+        
+        for book_id in self.holdout:
+            exclusions.discard(book_id)
+        return exclusions
+
+
+class OfflineRecommendationService(RecommendationService):
+    """评估用推荐服务：历史截断到留出点，不写缓存和推荐历史"""
+    
+    def __init__(self, db, neo4j, cutoff: datetime, holdout: Set[int], use_llm: bool = True):
+        super().__init__(db, neo4j)
+        self.cutoff = cutoff
+        self.use_llm = use_llm
+        self.exclusion_service = HoldoutExclusionService(db, cutoff, holdout)
+    
+    def _get_recent_interactions(self, user_id: int, limit: int = 10) -> List[Interaction]:
+        return self.db.query(Interaction).filter(
+            Interaction.user_id == user_id,
+            Interaction.created_at < self.cutoff
+        ).order_by(Interaction.created_at.desc()).limit(limit).all()
+    
+    def _get_recent_searches(self, user_id: int, limit: int = 3) -> List[SearchLog]:
+        return self.db.query(SearchLog).filter(
+            SearchLog.user_id == user_id,
+            SearchLog.created_at < self.cutoff
+        ).order_by(SearchLog.created_at.desc()).limit(limit).all()
+    
+    def _llm_rerank(self, candidates: List[Dict], history_titles: List[str]) -> List[Dict[str, Any]]:
+        if not self.use_llm:
+            return self._fallback_rerank(candidates)
+        return super()._llm_rerank(candidates, history_titles)
+    
+    def _save_to_cache(self, user_id: int, recommendations: List[Dict]):
+        pass
+    
+    def _update_recommendation_history(self, user_id: int, recommendations: List[Dict]):
+        pass
+
+
+# ==================== 测试集构建 ====================
+
+def build_tasks(
+    db,
+    holdout: int,
+    min_history: int,
+    as_of: Optional[datetime] = None,
+    max_users: int = 0,
+    seed: int = 42
+) -> List[EvalTask]:
+    """
+    按用户留出测试集
+    
+    默认留出每个用户最近的 holdout 次交互；指定 as_of 时留出该时间之后的全部交互。
+    训练部分少于 min_history 次、或留出的书籍都已在训练部分出现过的用户跳过
+    """
+    rows = db.query(
+        Interaction.user_id, Interaction.book_id, Interaction.created_at
+    ).order_by(
+        Interaction.user_id, Interaction.created_at, Interaction.id
+    ).execution_options(stream_results=True, yield_per=10000)
+    
+    tasks: List[EvalTask] = []
+    for user_id, group in groupby(rows, key=lambda r: r.user_id):
+        items = list(group)
+        if as_of:
+            train = [i for i in items if i.created_at < as_of]
+            test = [i for i in items if i.created_at >= as_of]
+        else:
+            train, test = items[:-holdout], items[-holdout:]
+        if len(train) < min_history or not test:
+            continue
+        
+        train_books = {i.book_id for i in train}
+        relevant = list(dict.fromkeys(i.book_id for i in test if i.book_id not in train_books))
+        if relevant:
+            tasks.append((user_id, test[0].created_at, relevant))
+    
+    if max_users and len(tasks) > max_users:
+        tasks = random.Random(seed).sample(tasks, max_users)
+    return tasks
+
+
+# ==================== 指标 ====================
+
+def ranking_metrics(recommended: List[int], relevant: Set[int], k: int) -> Dict[str, float]:
+    """Precision@K、Recall@K、NDCG@K（二值相关性）"""
+    hits = [1 if book_id in relevant else 0 for book_id in recommended[:k]]
+    dcg = sum(h / math.log2(i + 2) for i, h in enumerate(hits))
+    idcg = sum(1 / math.log2(i + 2) for i in range(min(len(relevant), k)))
+    return {
+        "precision": sum(hits) / k,
+        "recall": sum(hits) / len(relevant) if relevant else 0.0,
+        "ndcg": dcg / idcg if idcg else 0.0
+    }
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def _mean(values: List[float]) -> float:
+    return sum(values) / len(values) if values else 0.0
+
+
+def summarize(results: List[Dict[str, Any]], k: int, catalog_size: int) -> Dict[str, Dict[str, float]]:
+    """按多样性模式汇总"""
+    report = {}
+    for mode in dict.fromkeys(r["mode"] for r in results):
+        rows = [r for r in results if r["mode"] == mode]
+        ok = [r for r in rows if not r["error"]]
+        recommended = set()
+        for r in ok:
+            recommended.update(r["recommended"])
+        times = [r["elapsed_ms"] for r in ok]
+        
+        summary = {
+            "users": len(rows),
+            "errors": len(rows) - len(ok),
+            f"precision@{k}": _mean([r["precision"] for r in ok]),
+            f"recall@{k}": _mean([r["recall"] for r in ok]),
+            f"ndcg@{k}": _mean([r["ndcg"] for r in ok]),
+            "coverage": len(recommended) / catalog_size if catalog_size else 0.0
+        }
+        for key in DIVERSITY_KEYS:
+            summary[key] = _mean([r["diversity"][key] for r in ok])
+        summary.update({
+            "time_mean_ms": _mean(times),
+            "time_p50_ms": _percentile(times, 0.5),
+            "time_p95_ms": _percentile(times, 0.95)
+        })
+        report[mode] = {key: round(value, 4) for key, value in summary.items()}
+    return report
+
+
+# ==================== 并行回放 ====================
+
+_worker_options: Dict[str, Any] = {}
+
+
+def init_worker(use_llm: bool):
+    """子进程初始化：fork 继承的 MySQL 连接池和 Neo4j 驱动不能跨进程复用"""
+    engine.dispose(close=False)
+    neo4j_conn.driver = None
+    _worker_options["use_llm"] = use_llm
+
+
+def evaluate_batch(tasks: List[EvalTask], modes: List[str], k: int) -> List[Dict[str, Any]]:
+    """在一个进程内回放一批用户"""
+    use_llm = _worker_options.get("use_llm", True)
+    db = SessionLocal()
+    neo4j = neo4j_conn.get_session()
+    results = []
+    
+    try:
+        for user_id, cutoff, relevant in tasks:
+            holdout = set(relevant)
+            for mode in modes:
+                service = OfflineRecommendationService(db, neo4j, cutoff, holdout, use_llm)
+                started = time.perf_counter()
+                error = False
+                try:
+                    recommendations = service.get_recommendations(
+                        user_id=user_id,
+                        limit=k,
+                        enable_diversity=mode != "none",
+                        diversity_mode=mode,
+                        force_refresh=True
+                    )
+                except Exception as e:
+                    print(f"Evaluate user {user_id} ({mode}) error: {e}")
+                    db.rollback()
+                    recommendations, error = [], True
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                
+                recommended = [r["book"].id for r in recommendations[:k]]
+                diversity = service.diversity_service.calculate_diversity_metrics([
+                    {
+                        "category_name": r.get("category_name") or (r["book"].category.name if r["book"].category else "Unknown"),
+                        "author": r.get("author") or r["book"].author,
+                        "publication_year": r["book"].publication_year
+                    }
+                    for r in recommendations[:k]
+                ])
+                results.append({
+                    "user_id": user_id,
+                    "mode": mode,
+                    "error": error,
+                    "recommended": recommended,
+                    "elapsed_ms": elapsed_ms,
+                    "diversity": diversity,
+                    **ranking_metrics(recommended, holdout, k)
+                })
+    finally:
+        neo4j.close()
+        db.close()
+    
+    return results
+
+
+def run(tasks: List[EvalTask], modes: List[str], k: int, workers: int, batch_size: int, use_llm: bool) -> List[Dict[str, Any]]:
+    batches = [tasks[i:i + batch_size] for i in range(0, len(tasks), batch_size)]
+    results: List[Dict[str, Any]] = []
+    
+    if workers <= 1:
+        init_worker(use_llm)
+        for i, batch in enumerate(batches, 1):
+            results.extend(evaluate_batch(batch, modes, k))
+            print(f"  进度: {i}/{len(batches)} 批")
+        return results
+    
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(use_llm,)) as pool:
+        futures = [pool.submit(evaluate_batch, batch, modes, k) for batch in batches]
+        for i, future in enumerate(as_completed(futures), 1):
+            results.extend(future.result())
+            print(f"  进度: {i}/{len(batches)} 批")
+    return results
+
+
+def print_report(report: Dict[str, Dict[str, float]]):
+    if not report:
+        print("没有可评估的用户")
+        return
+    columns = list(next(iter(report.values())).keys())
+    width = max(len(c) for c in columns) + 2
+    print("\n" + "指标".ljust(width) + "".join(mode.rjust(12) for mode in report))
+    print("-" * (width + 12 * len(report)))
+    for column in columns:
+        print(column.ljust(width) + "".join(f"{report[mode][column]:>12}" for mode in report))
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='离线推荐质量与耗时评估')
+    parser.add_argument('--modes', default='quota,mmr,dpp,none', help='逗号分隔的多样性模式')
+    parser.add_argument('--k', type=int, default=10, help='推荐列表长度K')
+    parser.add_argument('--holdout', type=int, default=2, help='每个用户留出的最近交互数')
+    parser.add_argument('--as-of', type=datetime.fromisoformat, default=None, help='按时间切分：留出该时间之后的交互')
+    parser.add_argument('--min-history', type=int, default=3, help='训练部分的最少交互数')
+    parser.add_argument('--max-users', type=int, default=0, help='最多评估的用户数（0为全部）')
+    parser.add_argument('--seed', type=int, default=42, help='抽样用户的随机种子')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='并行进程数')
+    parser.add_argument('--batch-size', type=int, default=20, help='每个任务包含的用户数')
+    parser.add_argument('--no-llm', action='store_true', help='跳过LLM重排序，按图谱分数取候选')
+    parser.add_argument('--output', default=None, help='把汇总和逐用户结果写入JSON文件')
+    args = parser.parse_args()
+    
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    
+    print("=" * 50)
+    print("离线推荐评估")
+    print("=" * 50)
+    
+    db = SessionLocal()
+    try:
+        tasks = build_tasks(db, args.holdout, args.min_history, args.as_of, args.max_users, args.seed)
+        catalog_size = db.query(func.count(Book.id)).scalar() or 0
+    finally:
+        db.close()
+    
+    print(f"评估用户: {len(tasks)}, 书籍总数: {catalog_size}, 模式: {', '.join(modes)}, K={args.k}")
+    if not tasks:
+        return
+    
+    started = time.time()
+    results = run(tasks, modes, args.k, args.workers, args.batch_size, not args.no_llm)
+    wall = time.time() - started
+    
+    report = summarize(results, args.k, catalog_size)
+    print_report(report)
+    print(f"\n总耗时: {wall:.1f} 秒 ({len(tasks) / wall:.1f} 用户/秒, {args.workers} 进程)")
+    
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "summary": report, "users": results}, f, ensure_ascii=False, indent=2, default=str)
+        print(f"结果已写入: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
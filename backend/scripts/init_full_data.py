@@ -31,6 +31,7 @@ def init_db():
         # 2. Reset Neo4j
         print("Clearing Neo4j Graph...")
         sync_service.clear_graph()
+        sync_service.ensure_constraints()
 
         # 3. Create Categories
         categories_data = ["科幻", "历史", "计算机", "经济管理", "心理学", "悬疑"]
@@ -44,7 +45,9 @@ def init_db():
 
         # 4. Create Books
         books_data = get_books_data()
+        category_names = {cat.id: name for name, cat in categories.items()}
 
+        books = []
         for b_data in books_data:
             book = Book(
                 title=b_data["title"],
@@ -55,11 +58,12 @@ def init_db():
                 cover_url="https://via.placeholder.com/150"
             )
             session.add(book)
-            session.flush()
-            
-            # Sync to Neo4j
-            sync_service.sync_book(book, b_data["cat"])
-        print(f"Created {len(books_data)} books and synced to Neo4j.")
+            books.append(book)
+        session.flush()
+        
+        # Sync to Neo4j in batches
+        stats = sync_service.sync_books(books, category_names)
+        print(f"Created {len(books)} books and synced to Neo4j ({stats['rows_per_second']} rows/s).")
 
         # 5. Create Users
         users = []
@@ -70,29 +74,36 @@ def init_db():
                 hashed_password=get_hash("123456")
             )
             session.add(user)
-            session.flush()
             users.append(user)
-            sync_service.sync_user(user)
-        print(f"Created {len(users)} users and synced to Neo4j.")
+        session.flush()
+        stats = sync_service.sync_users(users)
+        print(f"Created {len(users)} users and synced to Neo4j ({stats['rows_per_second']} rows/s).")
 
         # 6. Create Interactions (Mock History)
+        interactions = []
+        ratings = []
         # User1 likes Sci-Fi
         user1 = users[0]
         sci_fi_books = session.query(Book).join(Category).filter(Category.name == "科幻").all()
         for b in sci_fi_books:
             # Click
             session.add(Interaction(user_id=user1.id, book_id=b.id, interaction_type="click"))
-            sync_service.sync_interaction(user1.id, b.id, "click")
+            interactions.append((user1.id, b.id, "click"))
             # Rate
             session.add(Rating(user_id=user1.id, book_id=b.id, rating=5))
-            sync_service.sync_rating(user1.id, b.id, 5)
+            ratings.append((user1.id, b.id, 5))
 
         # User2 likes History
         user2 = users[1]
         hist_books = session.query(Book).join(Category).filter(Category.name == "历史").all()
         for b in hist_books:
             session.add(Interaction(user_id=user2.id, book_id=b.id, interaction_type="collect"))
-            sync_service.sync_interaction(user2.id, b.id, "collect")
+            interactions.append((user2.id, b.id, "collect"))
+
+        stats = sync_service.sync_interactions(interactions)
+        print(f"Synced {stats['rows']} interactions ({stats['rows_per_second']} rows/s).")
+        stats = sync_service.sync_ratings(ratings)
+        print(f"Synced {stats['rows']} ratings ({stats['rows_per_second']} rows/s).")
 
         session.commit()
         print("Data initialization completed successfully!")
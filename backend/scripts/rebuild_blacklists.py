@@ -0,0 +1,41 @@
+"""
+Redis黑名单全量重建脚本
+从MySQL的有效负反馈重建所有用户的黑名单、类别/作者不喜欢集合
+Redis被清空或迁移后执行（服务启动时检测到冷Redis也会自动执行）
+
+运行方式: python scripts/rebuild_blacklists.py [--batch-size 1000]
+"""
+import sys
+import os
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.database import SessionLocal
+from app.services.blacklist_service import BlacklistService
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='从MySQL全量重建Redis黑名单')
+    parser.add_argument('--batch-size', type=int, default=1000, help='每批写入Redis的负反馈行数')
+    args = parser.parse_args()
+    
+    print("=" * 50)
+    print("Redis黑名单全量重建")
+    print("=" * 50)
+    
+    db = SessionLocal()
+    
+    try:
+        stats = BlacklistService(db).rebuild_all_from_mysql(batch_size=args.batch_size)
+        if stats["completed"]:
+            print(f"\n✓ 重建完成: {stats['users']} 个用户, {stats['rows']} 条负反馈, 耗时 {stats['elapsed']} 秒")
+        else:
+            print("\n✗ 重建未完成，请检查Redis连接或是否有其他重建任务在运行")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()